@@ -0,0 +1,599 @@
+"""
+State and messages shared by the worker processes.
+
+`MemoryBroker` keeps everything in the process, which is enough for a single
+worker. `RedisBroker` speaks the Redis protocol (RESP2) to Redis, Valkey or
+`BrokerServer`, a local stand-in that the launcher starts when several
+workers run without `BROKER_URL` (see `app/main.py`):
+
+    python -m app.broker --port 6390
+
+Only the commands used by the app are implemented: strings and lists with
+expiry, and pub/sub.
+"""
+
+import argparse
+import asyncio
+import logging
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable
+from urllib.parse import urlsplit
+
+from .settings import broker_settings
+
+logger = logging.getLogger("uvicorn.error")
+
+# identifies this process in broadcast messages
+worker_id = uuid.uuid4().hex
+
+
+class ReplyError(Exception):
+    """Error reply of the server"""
+
+
+def encode(*args) -> bytes:
+    """A command, as an array of bulk strings"""
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts += [b"$%d\r\n" % len(data), data, b"\r\n"]
+    return b"".join(parts)
+
+
+def encode_reply(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, ReplyError):
+        return f"-ERR {reply}\r\n".encode()
+    if isinstance(reply, bool | int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, list):
+        return b"*%d\r\n" % len(reply) + b"".join(map(encode_reply, reply))
+    data = str(reply).encode()
+    return b"$%d\r\n" % len(data) + data + b"\r\n"
+
+
+async def read_reply(reader: asyncio.StreamReader):
+    """
+    Next reply, with bulk strings decoded as text.
+    Errors are returned rather than raised, so that pipelined replies stay
+    matched to their commands.
+    """
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Broker connection closed")
+    kind, rest = line[:1], line[1:-2]
+    match kind:
+        case b"+":
+            return rest.decode()
+        case b"-":
+            return ReplyError(rest.decode())
+        case b":":
+            return int(rest)
+        case b"$":
+            if (size := int(rest)) < 0:
+                return None
+            return (await reader.readexactly(size + 2))[:-2].decode()
+        case b"*":
+            if (size := int(rest)) < 0:
+                return None
+            return [await read_reply(reader) for _ in range(size)]
+    raise ConnectionError(f"Unexpected reply from the broker: {line!r}")
+
+
+class Subscription:
+    """Messages published on a channel after subscribing"""
+
+    def __init__(self, channel: str):
+        self.channel = channel
+        self.queue: asyncio.Queue[str] = asyncio.Queue()
+
+    async def get(self, timeout: float | None = None) -> str:
+        """Next message; raises `TimeoutError` after `timeout` seconds"""
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def clear(self) -> None:
+        """Drop the messages received so far (e.g. redundant notifications)"""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> str:
+        return await self.queue.get()
+
+
+class Broker(ABC):
+    """
+    Shared strings, lists and pub/sub channels; keys expire after `ttl` seconds.
+    Subscriptions of the process to a channel share one server subscription.
+    Backends implement the commands, and subscribe to the server if any.
+    """
+
+    # whether other processes see the same state
+    shared = False
+
+    def __init__(self):
+        self.subscriptions: dict[str, set[Subscription]] = {}
+
+    @abstractmethod
+    async def get(self, key: str) -> str | None: ...
+
+    @abstractmethod
+    async def set(self, key: str, value: str, ttl: float | None = None) -> None: ...
+
+    @abstractmethod
+    async def delete(self, *keys: str) -> int: ...
+
+    @abstractmethod
+    async def expire(self, key: str, ttl: float) -> bool: ...
+
+    @abstractmethod
+    async def rpush(self, key: str, *values: str, ttl: float | None = None) -> int:
+        """Append to a list, (re)setting its expiry; returns the new length"""
+
+    @abstractmethod
+    async def lrange(self, key: str, start: int, stop: int = -1) -> list[str]:
+        """Items from `start` to `stop` (included, negative from the end)"""
+
+    @abstractmethod
+    async def publish(self, channel: str, message: str) -> int:
+        """Send a message to the current subscribers; returns their number"""
+
+    async def _subscribe(self, channel: str) -> None:
+        pass
+
+    async def _unsubscribe(self, channel: str) -> None:
+        pass
+
+    def _register(self, channel: str) -> tuple[Subscription, bool]:
+        """A new subscription, and whether it is the first one of the channel"""
+        subscription = Subscription(channel)
+        subscribers = self.subscriptions.setdefault(channel, set())
+        subscribers.add(subscription)
+        return subscription, len(subscribers) == 1
+
+    def _unregister(self, subscription: Subscription) -> bool:
+        """Whether the channel has no subscribers left"""
+        subscribers = self.subscriptions.get(subscription.channel, set())
+        subscribers.discard(subscription)
+        if subscribers:
+            return False
+        self.subscriptions.pop(subscription.channel, None)
+        return True
+
+    def _deliver(self, channel: str, message: str) -> int:
+        subscribers = self.subscriptions.get(channel, ())
+        for subscription in subscribers:
+            subscription.queue.put_nowait(message)
+        return len(subscribers)
+
+    @asynccontextmanager
+    async def subscribe(self, channel: str) -> AsyncIterator[Subscription]:
+        """Receive the messages of a channel; they are only published once ready"""
+        subscription, first = self._register(channel)
+        try:
+            if first:
+                await self._subscribe(channel)
+            yield subscription
+        finally:
+            if self._unregister(subscription):
+                await self._unsubscribe(channel)
+
+    async def listen(self, channel: str, handler: Callable[[str], None]) -> None:
+        """Call `handler` with every message of a channel, until cancelled"""
+        while True:
+            try:
+                async with self.subscribe(channel) as subscription:
+                    async for message in subscription:
+                        try:
+                            handler(message)
+                        except Exception:
+                            logger.exception(f"Could not handle message on {channel}")
+            except (ConnectionError, OSError) as e:
+                logger.warning(f"Broker unavailable ({e}), retrying")
+                await asyncio.sleep(1)
+
+    async def aclose(self) -> None:
+        pass
+
+
+class MemoryBroker(Broker):
+    """State of a single process (or of `BrokerServer`)"""
+
+    def __init__(self):
+        super().__init__()
+        self.values: dict[str, str | list[str]] = {}
+        # key -> expiry on the monotonic clock
+        self.expires: dict[str, float] = {}
+
+    def _value(self, key: str) -> str | list[str] | None:
+        expires = self.expires.get(key)
+        if expires is not None and expires < time.monotonic():
+            self._remove(key)
+        return self.values.get(key)
+
+    def _remove(self, key: str) -> bool:
+        self.expires.pop(key, None)
+        return self.values.pop(key, None) is not None
+
+    def _expire(self, key: str, ttl: float | None) -> None:
+        if ttl is None:
+            self.expires.pop(key, None)
+        else:
+            self.expires[key] = time.monotonic() + ttl
+
+    def sweep(self) -> None:
+        """Remove expired keys that are not read anymore"""
+        now = time.monotonic()
+        for key in [key for key, expires in self.expires.items() if expires < now]:
+            self._remove(key)
+
+    async def get(self, key: str) -> str | None:
+        value = self._value(key)
+        if isinstance(value, list):
+            raise ReplyError(f"{key} holds a list")
+        return value
+
+    async def set(self, key: str, value: str, ttl: float | None = None) -> None:
+        self.values[key] = value
+        self._expire(key, ttl)
+
+    async def delete(self, *keys: str) -> int:
+        return sum(self._remove(key) for key in keys)
+
+    async def expire(self, key: str, ttl: float) -> bool:
+        if self._value(key) is None:
+            return False
+        self._expire(key, ttl)
+        return True
+
+    async def rpush(self, key: str, *values: str, ttl: float | None = None) -> int:
+        items = self._value(key)
+        if items is None:
+            items = self.values[key] = []
+        elif not isinstance(items, list):
+            raise ReplyError(f"{key} does not hold a list")
+        items.extend(values)
+        if ttl is not None:
+            self._expire(key, ttl)
+        return len(items)
+
+    async def lrange(self, key: str, start: int, stop: int = -1) -> list[str]:
+        items = self._value(key)
+        if items is None:
+            return []
+        if not isinstance(items, list):
+            raise ReplyError(f"{key} does not hold a list")
+        return items[start : None if stop == -1 else stop + 1]
+
+    async def publish(self, channel: str, message: str) -> int:
+        return self._deliver(channel, message)
+
+
+class Connection:
+    """
+    A connection to a RESP server. Commands are pipelined: they are written
+    at once and their replies are matched in order by a reader task.
+    """
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        on_message: Callable[[str, str], None] | None = None,
+    ):
+        self.reader = reader
+        self.writer = writer
+        # pub/sub messages, on a subscribed connection
+        self.on_message = on_message
+        self.pending: deque[asyncio.Future] = deque()
+        self.closed = False
+        self.task = asyncio.create_task(self._read())
+
+    @classmethod
+    async def open(
+        cls, url: str, on_message: Callable[[str, str], None] | None = None
+    ) -> "Connection":
+        """Connect to redis://[[user]:password@]host[:port][/db]"""
+        parts = urlsplit(url)
+        reader, writer = await asyncio.open_connection(
+            parts.hostname or "localhost", parts.port or 6379
+        )
+        connection = cls(reader, writer, on_message)
+        if parts.password:
+            credentials = [parts.username] if parts.username else []
+            await connection.execute("AUTH", *credentials, parts.password)
+        if (database := parts.path.strip("/")) and database != "0":
+            await connection.execute("SELECT", database)
+        return connection
+
+    def send(self, *args) -> asyncio.Future:
+        """Write a command; the future is resolved with its reply"""
+        if self.closed:
+            raise ConnectionError("Broker connection closed")
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(future)
+        self.writer.write(encode(*args))
+        return future
+
+    async def execute(self, *args):
+        future = self.send(*args)
+        await self.writer.drain()
+        reply = await future
+        if isinstance(reply, ReplyError):
+            raise reply
+        return reply
+
+    async def _read(self) -> None:
+        error: Exception = ConnectionError("Broker connection closed")
+        try:
+            while True:
+                reply = await read_reply(self.reader)
+                if (
+                    self.on_message is not None
+                    and isinstance(reply, list)
+                    and reply[0] == "message"
+                ):
+                    self.on_message(reply[1], reply[2])
+                    continue
+                future = self.pending.popleft()
+                # the caller may have been cancelled
+                if not future.done():
+                    future.set_result(reply)
+        except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+            error = ConnectionError(f"Broker connection lost: {e}")
+        finally:
+            self.closed = True
+            while self.pending:
+                if not (future := self.pending.popleft()).done():
+                    future.set_exception(error)
+            self.writer.close()
+
+    async def aclose(self) -> None:
+        self.closed = True
+        self.writer.close()
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+
+
+class RedisBroker(Broker):
+    """
+    State on a Redis-protocol server, shared by the processes using it.
+    Commands go through one pipelined connection, subscriptions through another.
+    """
+
+    shared = True
+
+    def __init__(self, url: str, prefix: str = ""):
+        super().__init__()
+        self.url = url
+        self.prefix = prefix
+        self._connection: Connection | None = None
+        self._pubsub: Connection | None = None
+        self._lock = asyncio.Lock()
+        self._closing = False
+
+    async def _connect(self, pubsub: bool = False) -> Connection:
+        connection = self._pubsub if pubsub else self._connection
+        if connection is not None and not connection.closed:
+            return connection
+        async with self._lock:
+            connection = self._pubsub if pubsub else self._connection
+            if connection is not None and not connection.closed:
+                return connection
+            if not pubsub:
+                self._connection = await Connection.open(self.url)
+                return self._connection
+            self._pubsub = await Connection.open(self.url, self._on_message)
+            self._pubsub.task.add_done_callback(self._on_pubsub_lost)
+            # after a reconnection
+            for channel in self.subscriptions:
+                self._pubsub.send("SUBSCRIBE", self.prefix + channel)
+            return self._pubsub
+
+    async def execute(self, *args):
+        connection = await self._connect()
+        return await connection.execute(*args)
+
+    def _on_message(self, channel: str, message: str) -> None:
+        self._deliver(channel.removeprefix(self.prefix), message)
+
+    def _on_pubsub_lost(self, _) -> None:
+        if self._closing or not self.subscriptions:
+            return
+        logger.warning("Broker subscriptions lost, reconnecting")
+        asyncio.create_task(self._resubscribe())
+
+    async def _resubscribe(self) -> None:
+        while not self._closing and self.subscriptions:
+            try:
+                await self._connect(pubsub=True)
+                return
+            except (ConnectionError, OSError):
+                await asyncio.sleep(1)
+
+    async def get(self, key: str) -> str | None:
+        return await self.execute("GET", self.prefix + key)
+
+    async def set(self, key: str, value: str, ttl: float | None = None) -> None:
+        expiry = ["PX", int(ttl * 1000)] if ttl is not None else []
+        await self.execute("SET", self.prefix + key, value, *expiry)
+
+    async def delete(self, *keys: str) -> int:
+        return await self.execute("DEL", *(self.prefix + key for key in keys))
+
+    async def expire(self, key: str, ttl: float) -> bool:
+        return bool(await self.execute("PEXPIRE", self.prefix + key, int(ttl * 1000)))
+
+    async def rpush(self, key: str, *values: str, ttl: float | None = None) -> int:
+        if ttl is None:
+            return await self.execute("RPUSH", self.prefix + key, *values)
+        connection = await self._connect()
+        # both commands in a single round trip
+        length = connection.send("RPUSH", self.prefix + key, *values)
+        expire = connection.send("PEXPIRE", self.prefix + key, int(ttl * 1000))
+        await connection.writer.drain()
+        for reply in await asyncio.gather(length, expire):
+            if isinstance(reply, ReplyError):
+                raise reply
+        return length.result()
+
+    async def lrange(self, key: str, start: int, stop: int = -1) -> list[str]:
+        return await self.execute("LRANGE", self.prefix + key, start, stop)
+
+    async def publish(self, channel: str, message: str) -> int:
+        return await self.execute("PUBLISH", self.prefix + channel, message)
+
+    async def _subscribe(self, channel: str) -> None:
+        connection = await self._connect(pubsub=True)
+        await connection.execute("SUBSCRIBE", self.prefix + channel)
+
+    async def _unsubscribe(self, channel: str) -> None:
+        if self._pubsub is None or self._pubsub.closed:
+            return
+        try:
+            await self._pubsub.execute("UNSUBSCRIBE", self.prefix + channel)
+        except ConnectionError:
+            # subscriptions end with the connection
+            pass
+
+    async def aclose(self) -> None:
+        self._closing = True
+        for connection in (self._connection, self._pubsub):
+            if connection is not None:
+                await connection.aclose()
+
+
+class BrokerServer:
+    """
+    Local stand-in for Redis: a `MemoryBroker` served over RESP, so that
+    the workers of one machine share it without installing anything.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6390):
+        self.host = host
+        self.port = port
+        self.broker = MemoryBroker()
+
+    async def serve(self, ready: threading.Event | None = None) -> None:
+        server = await asyncio.start_server(self._client, self.host, self.port)
+        logger.info(f"Local broker listening on {self.host}:{self.port}")
+        if ready is not None:
+            ready.set()
+        async with server:
+            while True:
+                await asyncio.sleep(1)
+                self.broker.sweep()
+
+    async def _client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        subscriptions: dict[str, tuple[Subscription, asyncio.Task]] = {}
+
+        async def forward(subscription: Subscription) -> None:
+            async for message in subscription:
+                writer.write(encode_reply(["message", subscription.channel, message]))
+
+        try:
+            while True:
+                command = await read_reply(reader)
+                if not isinstance(command, list) or not command:
+                    raise ConnectionError("Invalid command")
+                name, args = command[0].upper(), command[1:]
+                if name in ("SUBSCRIBE", "UNSUBSCRIBE"):
+                    for channel in args:
+                        if name == "SUBSCRIBE" and channel not in subscriptions:
+                            # registered before the reply: no message is missed
+                            subscription, _ = self.broker._register(channel)
+                            task = asyncio.create_task(forward(subscription))
+                            subscriptions[channel] = (subscription, task)
+                        elif name == "UNSUBSCRIBE" and channel in subscriptions:
+                            subscription, task = subscriptions.pop(channel)
+                            self.broker._unregister(subscription)
+                            task.cancel()
+                        reply = [name.lower(), channel, len(subscriptions)]
+                        writer.write(encode_reply(reply))
+                else:
+                    try:
+                        reply = await self._execute(name, args)
+                    except ReplyError as e:
+                        reply = e
+                    except (ValueError, IndexError):
+                        reply = ReplyError(f"invalid arguments for {name}")
+                    writer.write(encode_reply(reply))
+                await writer.drain()
+        except (ConnectionError, OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for subscription, task in subscriptions.values():
+                self.broker._unregister(subscription)
+                task.cancel()
+            writer.close()
+
+    async def _execute(self, name: str, args: list[str]):
+        broker = self.broker
+        match name:
+            case "PING":
+                return "PONG"
+            case "SELECT" | "AUTH":
+                return "OK"
+            case "GET":
+                return await broker.get(args[0])
+            case "SET":
+                ttl = None
+                if len(args) == 4 and args[2].upper() in ("EX", "PX"):
+                    ttl = float(args[3]) / (1000 if args[2].upper() == "PX" else 1)
+                await broker.set(args[0], args[1], ttl)
+                return "OK"
+            case "DEL":
+                return await broker.delete(*args)
+            case "EXPIRE" | "PEXPIRE":
+                ttl = float(args[1]) / (1000 if name == "PEXPIRE" else 1)
+                return await broker.expire(args[0], ttl)
+            case "RPUSH":
+                return await broker.rpush(args[0], *args[1:])
+            case "LRANGE":
+                return await broker.lrange(args[0], int(args[1]), int(args[2]))
+            case "PUBLISH":
+                return await broker.publish(args[0], args[1])
+        raise ReplyError(f"unknown command '{name}'")
+
+
+def start_local_server(port: int) -> str:
+    """Run a `BrokerServer` in a background thread; returns its url"""
+    ready = threading.Event()
+    server = BrokerServer(port=port)
+    threading.Thread(
+        target=asyncio.run, args=(server.serve(ready),), name="broker", daemon=True
+    ).start()
+    if not ready.wait(10):
+        raise RuntimeError(f"Could not start the local broker on port {port}")
+    return f"redis://{server.host}:{server.port}"
+
+
+def create_broker(settings=broker_settings) -> Broker:
+    if settings.URL:
+        return RedisBroker(settings.URL, settings.PREFIX)
+    return MemoryBroker()
+
+
+broker = create_broker()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local broker for the workers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=broker_settings.LOCAL_PORT)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(BrokerServer(args.host, args.port).serve())
+    except KeyboardInterrupt:
+        pass
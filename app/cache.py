@@ -0,0 +1,293 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import AsyncIterator, Callable
+
+from .settings import cache_settings, llm_settings
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def normalize(text: str) -> str:
+    """Prompts differing only in case, unicode form or whitespace share a key"""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+def cache_key(message: str, history: list[tuple[str, str]]) -> str:
+    """Key of a prompt, given the (role, content) of the previous messages"""
+    parts = {
+        "backend": llm_settings.BACKEND,
+        "model": llm_settings.MODEL,
+        "history": [(role, normalize(content)) for role, content in history],
+        "prompt": normalize(message),
+    }
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+
+class LRUCache:
+    """In-process replies, bounded by count, total size and age"""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (expiry on the monotonic clock, chunks, size)
+        self.entries: OrderedDict[str, tuple[float, list[str], int]] = OrderedDict()
+        self.size = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> list[str] | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires, chunks, _ = entry
+        if expires < time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(key)
+        return chunks
+
+    def put(self, key: str, chunks: list[str], ttl: float | None = None) -> None:
+        size = sum(len(chunk) for chunk in chunks)
+        if size > self.max_bytes:
+            return
+        if key in self.entries:
+            self._remove(key)
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self.entries[key] = (expires, chunks, size)
+        self.size += size
+        while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        _, _, size = self.entries.pop(key)
+        self.size -= size
+
+
+class DiskCache:
+    """
+    Replies in a SQLite file, shared by worker processes and kept across
+    restarts. Methods are blocking: call them from a thread.
+    """
+
+    def __init__(self, path: str, max_entries: int):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            path, timeout=5, check_same_thread=False, isolation_level=None
+        )
+        self._conn.execute("PRAGMA journal_mode=wal")
+        self._conn.execute("PRAGMA synchronous=normal")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, chunks TEXT NOT NULL, "
+            "expires REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_response_cache_accessed "
+            "ON response_cache (accessed)"
+        )
+
+    def get(self, key: str) -> tuple[list[str], float] | None:
+        """Chunks and remaining time to live"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT chunks, expires FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            chunks, expires = row
+            if expires < now:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None
+            self._conn.execute(
+                "UPDATE response_cache SET accessed = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(chunks), expires - now
+
+    def put(self, key: str, chunks: list[str], ttl: float) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)",
+                (key, json.dumps(chunks), now + ttl, now),
+            )
+            # least recently used entries above the limit
+            evicted = self._conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                "SELECT key FROM response_cache ORDER BY accessed DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            ).rowcount
+        self.evictions += evicted
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class Flight:
+    """
+    A generation in progress, shared by all the requests for the same key.
+    The generation is cancelled when no request is following it anymore.
+    """
+
+    def __init__(self, source: AsyncIterator[str]):
+        self.chunks: list[str] = []
+        self.finished = False
+        self.error: BaseException | None = None
+        self.followers = 0
+        self._condition = asyncio.Condition()
+        self.task = asyncio.create_task(self._run(source))
+
+    async def _run(self, source: AsyncIterator[str]) -> None:
+        try:
+            async for chunk in source:
+                async with self._condition:
+                    self.chunks.append(chunk)
+                    self._condition.notify_all()
+        except asyncio.CancelledError as e:
+            self.error = e
+            raise
+        except Exception as e:
+            # raised to the followers: the task itself ends normally, or its
+            # exception would be reported as never retrieved
+            self.error = e
+        finally:
+            self.finished = True
+            async with self._condition:
+                self._condition.notify_all()
+
+    async def follow(self) -> AsyncIterator[str]:
+        self.followers += 1
+        position = 0
+        try:
+            while True:
+                while position < len(self.chunks):
+                    yield self.chunks[position]
+                    position += 1
+                if self.finished:
+                    break
+                async with self._condition:
+                    await self._condition.wait_for(
+                        lambda: self.finished or position < len(self.chunks)
+                    )
+            if isinstance(self.error, asyncio.CancelledError):
+                raise RuntimeError("Shared generation was cancelled")
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.followers -= 1
+            if self.followers == 0 and not self.finished:
+                self.task.cancel()
+
+
+class ResponseCache:
+    """
+    Replies to previous prompts, in memory and optionally on disk.
+    Hits are replayed chunk by chunk without delay; concurrent misses
+    for the same key share a single generation.
+    """
+
+    def __init__(self, settings=cache_settings):
+        self.ttl = settings.TTL
+        self.memory = LRUCache(settings.MAX_ENTRIES, settings.MAX_BYTES, settings.TTL)
+        self.disk = (
+            DiskCache(settings.DISK_PATH, settings.DISK_MAX_ENTRIES)
+            if settings.ENABLED and settings.DISK_PATH
+            else None
+        )
+        self.flights: dict[str, Flight] = {}
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.shared = 0
+
+    async def get(self, key: str) -> list[str] | None:
+        chunks = self.memory.get(key)
+        if chunks is not None:
+            self.hits += 1
+            return chunks
+        if self.disk is None:
+            return None
+        entry = await asyncio.to_thread(self.disk.get, key)
+        if entry is None:
+            return None
+        chunks, ttl = entry
+        self.disk_hits += 1
+        self.memory.put(key, chunks, ttl)
+        return chunks
+
+    async def put(self, key: str, chunks: list[str]) -> None:
+        self.memory.put(key, chunks)
+        if self.disk is not None:
+            await asyncio.to_thread(self.disk.put, key, chunks, self.ttl)
+
+    async def stream(
+        self, key: str, generate: Callable[[], AsyncIterator[str]]
+    ) -> AsyncIterator[str]:
+        """
+        Stream the reply for `key`: from the cache, from an identical
+        generation in progress, or from a new one (`generate()`).
+        """
+        chunks = await self.get(key)
+        if chunks is not None:
+            for chunk in chunks:
+                yield chunk
+            return
+        flight = self.flights.get(key)
+        if flight is None:
+            self.misses += 1
+            flight = Flight(self._generate(key, generate()))
+            self.flights[key] = flight
+            flight.task.add_done_callback(lambda _: self.flights.pop(key, None))
+        else:
+            self.shared += 1
+        async for chunk in flight.follow():
+            yield chunk
+
+    async def _generate(
+        self, key: str, source: AsyncIterator[str]
+    ) -> AsyncIterator[str]:
+        # only complete replies are cached
+        chunks = []
+        async for chunk in source:
+            chunks.append(chunk)
+            yield chunk
+        try:
+            await self.put(key, chunks)
+        except Exception:
+            logger.exception("Could not cache reply")
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+
+    def stats(self) -> dict:
+        return {
+            "enabled": cache_settings.ENABLED,
+            "entries": len(self.memory.entries),
+            "bytes": self.memory.size,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "in_flight": len(self.flights),
+            "evictions": self.memory.evictions,
+            "disk_evictions": self.disk.evictions if self.disk else 0,
+            "expirations": self.memory.expirations,
+        }
+
+
+response_cache = ResponseCache()
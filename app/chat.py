@@ -1,60 +1,130 @@
 import asyncio
 import logging
-import random
-import string
+import uuid
+from datetime import datetime
 from typing import Annotated
 
-from fastapi import APIRouter, Body, Depends, Query
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+    WebSocket,
+)
 from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, func
+from sqlalchemy.orm import selectinload
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from .context import assembler
+from .database import archive
 from .database import database as db
-from .schema import ChatMessageSchema, PaginationParameters
+from .database.bulk import export_lines
+from .etags import check_etag, weak_etag
+from .generation import Reply, get_response
+from .live import hub
+from .llm import scheduler
+from .message import delete_messages_where
+from .pagination import newer_than, paginate, set_next_cursor
+from .schema import (
+    BatchResult,
+    ChatInclude,
+    ChatListParameters,
+    ChatMessageSchema,
+    MessageListParameters,
+)
+from .serialization import columns, media_type, rows_response
+from .streams import sse, streams
 
 logger = logging.getLogger("uvicorn.error")
 
 router = APIRouter(prefix="/chats", tags=["chat"])
 
-LETTERS = list(string.ascii_letters + string.digits)
-
-
-async def get_response(message: str, chat_id: str, session: AsyncSession):
-    # here you would call your LLM to get the response
-    response = ""
-    await asyncio.sleep(2)
-    for _ in range(random.randint(20, 100)):
-        stream = "".join(random.choices(LETTERS, k=5))
-        # logger.info(f"{response}")
-        response += stream
-        yield stream
-        await asyncio.sleep(0.075)
-
-    messages = [
-        db.ChatMessage(chat_id=chat_id, role=db.ChatMessageRole.HUMAN, content=message),
-        db.ChatMessage(chat_id=chat_id, role=db.ChatMessageRole.AI, content=response),
-    ]
-    logger.info("Addiding messages to db session")
-    for m in messages:
-        session.add(m)
-    logger.info("Committing messages to db")
-    await session.commit()
+
+def select_chats(include: list[ChatInclude]):
+    """Select chats, loading the requested relationships"""
+    query = select(db.Chat)
+    if ChatInclude.HISTORY in include:
+        query = query.options(selectinload(db.Chat.history))
+    return query
+
+
+async def chat_version(session: AsyncSession, chat_id: uuid.UUID) -> int | None:
+    """
+    Current version of a chat, without loading it.
+    The messages of an archived chat are restored first.
+    """
+    state = await session.exec(
+        select(db.Chat.version, db.Chat.archived).where(db.Chat.id == chat_id)
+    )
+    state = state.one_or_none()
+    if state is None:
+        return None
+    if state.archived:
+        await restore(session, [chat_id])
+        return await chat_version(session, chat_id)
+    return state.version
+
+
+async def restore(session: AsyncSession, chat_ids: list[uuid.UUID]) -> None:
+    """Restore the messages of archived chats, before they are read"""
+    for chat_id in chat_ids:
+        await archive.restore(chat_id)
+        await assembler.invalidate(chat_id)
+    # end the read transaction, so that the next one sees the restored messages
+    await session.rollback()
 
 
-@router.get("")
+async def require_chat(chat_id: uuid.UUID) -> None:
+    """404 if the chat does not exist; its messages are restored if archived"""
+    async with AsyncSession(db.read_engine) as session:
+        if await chat_version(session, chat_id) is None:
+            raise HTTPException(status_code=404, detail="Chat not found")
+
+
+@router.get("", response_model=list[db.ChatWithHistory] | list[db.Chat])
 async def get_chats(
-    pagination: Annotated[PaginationParameters, Query()],
-    session: AsyncSession = Depends(db.get_session),
-) -> list[db.Chat]:
-    """Get list of Chats."""
-    chats = await session.exec(
-        select(db.Chat)
-        .order_by(db.Chat.create_time.desc())
-        .offset(pagination.offset)
-        .limit(pagination.limit)
+    params: Annotated[ChatListParameters, Query()],
+    request: Request,
+    response: Response,
+    session: AsyncSession = Depends(db.get_read_session),
+) -> Response | list[db.ChatWithHistory]:
+    """
+    Get list of Chats.
+    Chats are returned from the newest to the oldest; when `limit` is set
+    and there are more chats, the `X-Next-Cursor` header holds the cursor
+    for the next page.
+    Messages are not returned, unless `include=history` is set.
+    The ETag depends on the ids and versions of the chats in the page, the
+    parameters and the media type.
+    With `Accept: application/x-ndjson`, chats are sent one per line
+    (without history).
+    """
+    versions = await session.exec(
+        paginate(select(db.Chat.id, db.Chat.version), db.Chat, params)
     )
-    chats = chats.all()
-    return chats
+    etag = weak_etag(params.model_dump(), media_type(request), *versions.all())
+    if (not_modified := check_etag(request, response, etag, "Accept")) is not None:
+        return not_modified
+    if ChatInclude.HISTORY not in params.include:
+        # Core rows, encoded at once (see `app/serialization.py`)
+        chats = await session.exec(paginate(select(*columns(db.Chat)), db.Chat, params))
+        chats = chats.all()
+        set_next_cursor(response, chats, params)
+        return rows_response(chats, request, response)
+    query = paginate(select_chats(params.include), db.Chat, params)
+    chats = (await session.exec(query)).all()
+    if archived := [chat.id for chat in chats if chat.archived]:
+        await restore(session, archived)
+        session.expunge_all()
+        chats = (await session.exec(query)).all()
+    set_next_cursor(response, chats, params)
+    return [db.ChatWithHistory.model_validate(chat) for chat in chats]
 
 
 @router.post("")
@@ -69,93 +139,264 @@ async def create_chat(
     return chat
 
 
+@router.delete("")
+async def delete_chats(
+    before: Annotated[
+        datetime, Query(description="Delete chats without messages since this time")
+    ],
+    session: AsyncSession = Depends(db.get_session),
+) -> BatchResult:
+    """
+    Delete the chats whose last message (or creation, if they have none) is
+    older than `before`, with their messages, in one transaction.
+    """
+    inactive = func.coalesce(db.Chat.last_message_time, db.Chat.create_time) < before
+    # messages are deleted by the db cascade, count them first
+    messages = await session.exec(
+        select(func.count()).where(
+            db.ChatMessage.chat_id.in_(select(db.Chat.id).where(inactive))
+        )
+    )
+    messages = messages.one()
+    chat_ids = await session.exec(
+        delete(db.Chat)
+        .where(inactive)
+        .returning(db.Chat.id)
+        .execution_options(synchronize_session=False)
+    )
+    chat_ids = chat_ids.all()
+    await session.commit()
+    await asyncio.gather(*(assembler.invalidate(chat_id) for chat_id in chat_ids))
+    for chat_id in chat_ids:
+        hub.publish(chat_id, {"type": "chat_deleted"})
+    return BatchResult(chats=len(chat_ids), messages=messages)
+
+
+# declared before /{chat_id}, which would match it
+@router.get("/export")
+async def export_chats() -> StreamingResponse:
+    """
+    Export all chats with their messages as NDJSON (one chat per line),
+    in the format accepted by `python -m app.database.bulk import`.
+    """
+    return StreamingResponse(
+        export_lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="chats.jsonl"'},
+    )
+
+
 @router.get("/{chat_id}")
 async def get_chat(
-    chat_id: str, session: AsyncSession = Depends(db.get_session)
-) -> db.Chat:
-    """Get single chat (without messages)"""
-    chat = await session.exec(select(db.Chat).where(db.Chat.id == chat_id))
+    chat_id: uuid.UUID,
+    request: Request,
+    response: Response,
+    include: Annotated[list[ChatInclude], Query()] = [],
+    session: AsyncSession = Depends(db.get_read_session),
+) -> db.ChatWithHistory | db.Chat:
+    """
+    Get single chat (without messages, unless `include=history` is set).
+    The ETag depends on the version of the chat and on `include`.
+    """
+    version = await chat_version(session, chat_id)
+    if version is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    etag = weak_etag(chat_id, version, include)
+    if (not_modified := check_etag(request, response, etag)) is not None:
+        return not_modified
+    chat = await session.exec(select_chats(include).where(db.Chat.id == chat_id))
     chat = chat.one()
+    if ChatInclude.HISTORY in include:
+        return db.ChatWithHistory.model_validate(chat)
     return chat
 
 
 @router.patch("/{chat_id}")
 async def edit_chat_title(
-    chat_id: str,
+    chat_id: uuid.UUID,
     title: Annotated[str, Body(embed=True)],
     session: AsyncSession = Depends(db.get_session),
 ) -> db.Chat:
     chat = await session.exec(select(db.Chat).where(db.Chat.id == chat_id))
-    chat = chat.one()
+    chat = chat.one_or_none()
+    if chat is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
     chat.title = title
+    chat.version = db.Chat.version + 1
     session.add(chat)
     await session.commit()
     await session.refresh(chat)
+    hub.publish(chat_id, {"type": "chat_updated", "title": title})
     return chat
 
 
 @router.delete("/{chat_id}")
-async def delete_chat(chat_id: str, session: AsyncSession = Depends(db.get_session)):
+async def delete_chat(
+    chat_id: uuid.UUID, session: AsyncSession = Depends(db.get_session)
+):
     """Delete chat"""
     chat = await session.exec(select(db.Chat).where(db.Chat.id == chat_id))
-    chat = chat.one()
+    chat = chat.one_or_none()
+    if chat is None:
+        raise HTTPException(status_code=404, detail="Chat not found")
     await session.delete(chat)
     await session.commit()
+    await assembler.invalidate(chat_id)
+    hub.publish(chat_id, {"type": "chat_deleted"})
     return
 
 
 @router.post("/{chat_id}")
 async def chat(
-    chat_id: str,
+    chat_id: uuid.UUID,
     message: ChatMessageSchema,
-    session: AsyncSession = Depends(db.get_session),
 ) -> ChatMessageSchema:
     """Post a message to chat and get the response"""
-    response = "".join(
-        [
-            chunk
-            async for chunk in get_response(
-                message=message.content, chat_id=chat_id, session=session
-            )
-        ]
-    )
-    return ChatMessageSchema(content=response)
+    await require_chat(chat_id)
+    reply = Reply()
+    async for _ in get_response(message=message.content, chat_id=chat_id, reply=reply):
+        pass
+    return ChatMessageSchema(content=reply.text)
 
 
 @router.post("/{chat_id}/stream")
 async def stream(
-    chat_id: str,
+    chat_id: uuid.UUID,
     message: ChatMessageSchema,
-    session: AsyncSession = Depends(db.get_session),
+    request: Request,
+    persisted_ids: bool = False,
 ) -> StreamingResponse:
-    """Post a message to chat and get the response as stream"""
+    """
+    Post a message to chat and get the response as server-sent events.
+    The first event (`start`) holds the stream id, then each chunk is sent as
+    a `message` event; the last event is `done`, `cancelled` or `error`.
+    With `persisted_ids`, the ids of the stored prompt and reply are sent
+    in a `persisted` event (`{"human": id, "ai": id}`) before `done`.
+    """
 
     logger.info(f"Streaming chat {chat_id}")
     logger.info(f"Message: {message.content}")
 
+    # checked before reserving a generation slot, so that an unknown chat is
+    # reported as 404 and overload as 429, before the response starts
+    await require_chat(chat_id)
+    ticket = scheduler.reserve(chat_id)
+    stream = streams.start(
+        chat_id=chat_id,
+        message=message.content,
+        ticket=ticket,
+        persisted_ids=persisted_ids,
+    )
+    stream.attach()
     return StreamingResponse(
-        get_response(message=message.content, chat_id=chat_id, session=session),
+        sse(request, stream),
         media_type="text/event-stream",
+        headers={"X-Stream-Id": str(stream.id), "Cache-Control": "no-cache"},
     )
 
 
-@router.get("/{chat_id}/messages", tags=["message"])
-async def get_messages(
-    chat_id: str,
-    pagination: Annotated[PaginationParameters, Query()],
+@router.get("/{chat_id}/stream/{stream_id}")
+async def resume_stream(
+    chat_id: uuid.UUID,
+    stream_id: uuid.UUID,
+    request: Request,
+    last_event_id: Annotated[int | None, Header()] = None,
+) -> StreamingResponse:
+    """
+    Reconnect to a stream, receiving the events after `Last-Event-ID`.
+    With a shared broker, streams of any worker can be followed.
+    """
+    stream = await streams.find(stream_id)
+    if stream is None or stream.chat_id != chat_id:
+        raise HTTPException(status_code=404, detail="Stream not found or expired")
+    stream.attach()
+    return StreamingResponse(
+        sse(request, stream, last_event_id),
+        media_type="text/event-stream",
+        headers={"X-Stream-Id": str(stream.id), "Cache-Control": "no-cache"},
+    )
+
+
+@router.delete("/{chat_id}/stream/{stream_id}", status_code=204)
+async def cancel_stream(chat_id: uuid.UUID, stream_id: uuid.UUID) -> None:
+    """
+    Stop the generation of a stream; its listeners receive a `cancelled` event.
+    The partial reply is handled as configured by `STREAM_PARTIAL_REPLY`.
+    """
+    stream = await streams.find(stream_id)
+    if stream is None or stream.chat_id != chat_id:
+        raise HTTPException(status_code=404, detail="Stream not found or expired")
+    stream.cancel()
+
+
+@router.websocket("/{chat_id}/ws")
+async def chat_updates(websocket: WebSocket, chat_id: uuid.UUID) -> None:
+    """
+    Live updates of a chat: chunks of every stream, written, edited and
+    deleted messages, title changes and deletion (see `app/live.py`).
+    Clients that fall behind are closed with code 1013 and should resync
+    with `/messages` before reconnecting.
+    """
+    async with AsyncSession(db.read_engine) as session:
+        chat = await session.get(db.Chat, chat_id)
+    if chat is None:
+        await websocket.close(code=1008, reason="Chat not found")
+        return
+    await websocket.accept()
+    await hub.serve(websocket, chat_id)
+
+
+@router.delete("/{chat_id}/messages", tags=["message"])
+async def truncate_chat(
+    chat_id: uuid.UUID,
+    after: Annotated[
+        uuid.UUID | datetime | None,
+        Query(description="Keep the messages up to this message id or timestamp"),
+    ] = None,
     session: AsyncSession = Depends(db.get_session),
-) -> list[db.ChatMessage]:
+) -> BatchResult:
+    """
+    Delete the messages of a chat newer than `after`, or all of them,
+    in a single statement.
+    """
+    await chat_version(session, chat_id)
+    condition = db.ChatMessage.chat_id == chat_id
+    if after is not None:
+        condition &= await newer_than(session, db.ChatMessage, after)
+    return await delete_messages_where(session, condition)
+
+
+@router.get(
+    "/{chat_id}/messages", tags=["message"], response_model=list[db.ChatMessage]
+)
+async def get_messages(
+    chat_id: uuid.UUID,
+    params: Annotated[MessageListParameters, Query()],
+    request: Request,
+    response: Response,
+    session: AsyncSession = Depends(db.get_read_session),
+) -> Response:
     """
     Get chat messages.
     Messages are returned from the newest to the oldest;
     in this way it is possible limit the history to the most recent N messages.
+    Older messages can be fetched with the cursor in the `X-Next-Cursor` header.
+    With `since` (a message id or a timestamp) only newer messages are returned,
+    so that clients can sync the history incrementally.
+    The ETag depends on the version of the chat, the parameters and the
+    media type.
+    With `Accept: application/x-ndjson`, messages are sent one per line.
     """
-    messages = await session.exec(
-        select(db.ChatMessage)
-        .where(db.ChatMessage.chat_id == chat_id)
-        .order_by(db.ChatMessage.create_time.desc())
-        .offset(pagination.offset)
-        .limit(pagination.limit)
-    )
+    version = await chat_version(session, chat_id)
+    if version is not None:
+        etag = weak_etag(chat_id, version, params.model_dump(), media_type(request))
+        if (not_modified := check_etag(request, response, etag, "Accept")) is not None:
+            return not_modified
+    # Core rows, encoded at once (see `app/serialization.py`)
+    query = select(*columns(db.ChatMessage)).where(db.ChatMessage.chat_id == chat_id)
+    if params.since is not None:
+        query = query.where(await newer_than(session, db.ChatMessage, params.since))
+    messages = await session.exec(paginate(query, db.ChatMessage, params))
     messages = messages.all()
-    return messages
+    set_next_cursor(response, messages, params)
+    return rows_response(messages, request, response)
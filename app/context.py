@@ -0,0 +1,265 @@
+"""
+Assembly of the history sent to the LLM with each prompt.
+
+Messages are taken from the newest backward, within a token budget; the ones
+that no longer fit can be folded into a rolling summary. The window of each
+chat (token counts and LLM messages) is cached, so that a turn only reads and
+counts the messages added since the previous one. Edits and deletes of
+messages invalidate the chat (see `app/message.py`), on every worker when
+the broker is shared.
+"""
+
+import asyncio
+import json
+import logging
+import math
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from datetime import datetime
+
+from sqlalchemy import tuple_
+from sqlalchemy.orm import joinedload
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .broker import broker, worker_id
+from .database import database as db
+from .llm import ROLES, LLMMessages
+from .settings import context_settings
+
+logger = logging.getLogger("uvicorn.error")
+
+# messages read at once when loading a chat backward
+PAGE_SIZE = 100
+INVALIDATE_CHANNEL = "context:invalidate"
+
+
+def count_tokens(text: str | None, settings=context_settings) -> int:
+    """Estimated tokens of a message, including its role and separators"""
+    tokens = math.ceil(len(text or "") / settings.CHARS_PER_TOKEN)
+    return tokens + settings.MESSAGE_OVERHEAD
+
+
+@dataclass
+class Entry:
+    """A message of the window, with its position and token count"""
+
+    key: tuple[datetime, uuid.UUID]
+    tokens: int
+    message: dict[str, str]
+
+
+class ChatContext:
+    """Cached window of a chat: the newest messages within the budget"""
+
+    def __init__(self):
+        # oldest first
+        self.window: deque[Entry] = deque()
+        self.tokens = 0
+        self.summary: deque[tuple[str, int]] = deque()
+        self.summary_tokens = 0
+        # newest message seen, the next turn reads messages after it
+        self.last: tuple[datetime, uuid.UUID] | None = None
+        self.loaded = False
+        self.lock = asyncio.Lock()
+        self._prefix: LLMMessages | None = None
+
+    @property
+    def prefix(self) -> LLMMessages:
+        """LLM messages of the window, rebuilt only when it changes"""
+        if self._prefix is None:
+            self._prefix = [entry.message for entry in self.window]
+        return self._prefix
+
+
+class ContextAssembler:
+    def __init__(self, settings=context_settings):
+        self.settings = settings
+        self.chats: OrderedDict[uuid.UUID, ChatContext] = OrderedDict()
+        # stats
+        self.hits = 0
+        self.loads = 0
+        self.invalidations = 0
+        self.read_messages = 0
+
+    @property
+    def window_budget(self) -> int:
+        settings = self.settings
+        budget = settings.MAX_TOKENS - settings.RESERVED_TOKENS
+        return budget - settings.SUMMARY_TOKENS if settings.SUMMARY else budget
+
+    def _entry(self, message: db.ChatMessage) -> Entry:
+        content = message.full_content
+        return Entry(
+            key=(message.create_time, message.id),
+            tokens=count_tokens(content, self.settings),
+            message={"role": ROLES[message.role], "content": content or ""},
+        )
+
+    def _summary_line(self, message: dict[str, str]) -> tuple[str, int]:
+        snippet = " ".join(message["content"].split())
+        if len(snippet) > self.settings.SUMMARY_SNIPPET:
+            snippet = snippet[: self.settings.SUMMARY_SNIPPET] + "…"
+        line = f"{message['role']}: {snippet}"
+        return line, count_tokens(line, self.settings)
+
+    def _summarize(self, chat: ChatContext, message: dict[str, str]) -> None:
+        """Add a message leaving the window to the summary, dropping the oldest"""
+        if not self.settings.SUMMARY:
+            return
+        line = self._summary_line(message)
+        chat.summary.append(line)
+        chat.summary_tokens += line[1]
+        while chat.summary_tokens > self.settings.SUMMARY_TOKENS:
+            _, tokens = chat.summary.popleft()
+            chat.summary_tokens -= tokens
+
+    async def _load(
+        self, session: AsyncSession, chat_id: uuid.UUID, chat: ChatContext
+    ) -> None:
+        """Read the newest messages backward, until the window (and summary) is full"""
+        budget = self.window_budget
+        window_full = False
+        before = None
+        while True:
+            query = (
+                select(db.ChatMessage)
+                .options(joinedload(db.ChatMessage.body))
+                .where(db.ChatMessage.chat_id == chat_id)
+                .order_by(db.ChatMessage.create_time.desc(), db.ChatMessage.id.desc())
+                .limit(PAGE_SIZE)
+            )
+            if before is not None:
+                query = query.where(
+                    tuple_(db.ChatMessage.create_time, db.ChatMessage.id)
+                    < tuple_(*before)
+                )
+            messages = (await session.exec(query)).all()
+            self.read_messages += len(messages)
+            for message in messages:
+                entry = self._entry(message)
+                if chat.last is None:
+                    chat.last = entry.key
+                if not window_full and chat.tokens + entry.tokens <= budget:
+                    chat.window.appendleft(entry)
+                    chat.tokens += entry.tokens
+                    continue
+                # the window is contiguous: older messages only go to the summary
+                window_full = True
+                if not self.settings.SUMMARY:
+                    return
+                line = self._summary_line(entry.message)
+                if chat.summary_tokens + line[1] > self.settings.SUMMARY_TOKENS:
+                    return
+                chat.summary.appendleft(line)
+                chat.summary_tokens += line[1]
+            if len(messages) < PAGE_SIZE:
+                return
+            before = (messages[-1].create_time, messages[-1].id)
+
+    async def _refresh(
+        self, session: AsyncSession, chat_id: uuid.UUID, chat: ChatContext
+    ) -> None:
+        """Add the messages written since the last turn, evicting the oldest"""
+        query = (
+            select(db.ChatMessage)
+            .options(joinedload(db.ChatMessage.body))
+            .where(db.ChatMessage.chat_id == chat_id)
+            .order_by(db.ChatMessage.create_time, db.ChatMessage.id)
+        )
+        if chat.last is not None:
+            query = query.where(
+                tuple_(db.ChatMessage.create_time, db.ChatMessage.id)
+                > tuple_(*chat.last)
+            )
+        messages = (await session.exec(query)).all()
+        self.read_messages += len(messages)
+        if not messages:
+            return
+        budget = self.window_budget
+        for message in messages:
+            entry = self._entry(message)
+            chat.window.append(entry)
+            chat.tokens += entry.tokens
+            chat.last = entry.key
+        while chat.tokens > budget and chat.window:
+            entry = chat.window.popleft()
+            chat.tokens -= entry.tokens
+            self._summarize(chat, entry.message)
+        chat._prefix = None
+
+    def _chat(self, chat_id: uuid.UUID) -> ChatContext:
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = ChatContext()
+            while len(self.chats) > self.settings.CACHE_CHATS:
+                self.chats.popitem(last=False)
+        else:
+            self.chats.move_to_end(chat_id)
+        return chat
+
+    async def assemble(self, chat_id: uuid.UUID, prompt: str) -> LLMMessages:
+        """LLM messages for a new prompt: summary, recent history and the prompt"""
+        chat = self._chat(chat_id)
+        async with chat.lock:
+            async with AsyncSession(db.read_engine) as session:
+                if chat.loaded:
+                    self.hits += 1
+                    await self._refresh(session, chat_id, chat)
+                else:
+                    self.loads += 1
+                    await self._load(session, chat_id, chat)
+                    chat.loaded = True
+            # the prompt takes the place of the oldest messages, if needed
+            available = self.window_budget - count_tokens(prompt, self.settings)
+            tokens = chat.tokens
+            skip = 0
+            while tokens > available and skip < len(chat.window):
+                tokens -= chat.window[skip].tokens
+                skip += 1
+            messages = chat.prefix[skip:] if skip else list(chat.prefix)
+            if chat.summary:
+                summary = "\n".join(line for line, _ in chat.summary)
+                messages.insert(
+                    0,
+                    {
+                        "role": ROLES[db.ChatMessageRole.SYSTEM],
+                        "content": f"Summary of earlier messages:\n{summary}",
+                    },
+                )
+        messages.append({"role": ROLES[db.ChatMessageRole.HUMAN], "content": prompt})
+        return messages
+
+    def _forget(self, chat_id: uuid.UUID) -> None:
+        if self.chats.pop(chat_id, None) is not None:
+            self.invalidations += 1
+
+    async def invalidate(self, chat_id: uuid.UUID) -> None:
+        """Forget the cached window of a chat (e.g. after an edit or delete)"""
+        self._forget(chat_id)
+        if broker.shared:
+            message = {"chat": str(chat_id), "worker": worker_id}
+            await broker.publish(INVALIDATE_CHANNEL, json.dumps(message))
+
+    def _on_invalidate(self, message: str) -> None:
+        message = json.loads(message)
+        if message["worker"] != worker_id:
+            self._forget(uuid.UUID(message["chat"]))
+
+    async def listen(self) -> None:
+        """Apply the invalidations of other workers"""
+        await broker.listen(INVALIDATE_CHANNEL, self._on_invalidate)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.settings.ENABLED,
+            "chats": len(self.chats),
+            "hits": self.hits,
+            "loads": self.loads,
+            "invalidations": self.invalidations,
+            "read_messages": self.read_messages,
+        }
+
+
+assembler = ContextAssembler()
@@ -0,0 +1,222 @@
+"""
+Archival of inactive chats.
+
+The messages of chats without new messages for `MAINTENANCE_ARCHIVE_AFTER_DAYS`
+are moved out of the hot `chatmessage` table into `chatarchive`, as one
+compressed JSON document per chat. The chat row stays (with its summary and
+`archived` set), so chat lists are unchanged; the messages are restored on
+access (`get_chat` with history, `get_messages`, new prompts). Until then,
+they are not found by search. A restored chat is touched (`update_time`), so
+it is only archived again after `MAINTENANCE_ARCHIVE_AFTER_DAYS` without use.
+"""
+
+import asyncio
+import json
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, select, tuple_, update
+
+from .. import metrics
+from ..settings import maintenance_settings
+from . import database as db
+from .compression import compress, decompress
+from .content import full_content, split
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def encode(messages: list[dict]) -> bytes:
+    return json.dumps(messages, separators=(",", ":")).encode()
+
+
+def pack(chats: dict[uuid.UUID, list[dict]], codec: str, level: int) -> list[dict]:
+    """Rows of `chatarchive` (CPU bound: run in a thread)"""
+    rows = []
+    for chat_id, messages in chats.items():
+        for message in messages:
+            if (body := message.pop("body", None)) is not None:
+                message["content"] = full_content(None, *body)
+        document = encode(messages)
+        rows.append(
+            {
+                "chat_id": chat_id,
+                "codec": codec,
+                "data": compress(document, codec, level),
+                "message_count": len(messages),
+                "size": len(document),
+                "archive_time": db.utc_now(),
+            }
+        )
+    return rows
+
+
+def unpack(
+    data: bytes, codec: str, chat_id: uuid.UUID
+) -> tuple[list[dict], list[dict]]:
+    """
+    Rows of `chatmessage` and `messagebody`, from an archived document
+    (CPU bound: run in a thread)
+    """
+    messages, bodies = [], []
+    for message in json.loads(decompress(data, codec)):
+        message_id = uuid.UUID(message["id"])
+        columns, body = split(message["content"])
+        messages.append(
+            {
+                "id": message_id,
+                "chat_id": chat_id,
+                "role": db.ChatMessageRole(message["role"]),
+                "create_time": datetime.fromisoformat(message["create_time"]),
+                "update_time": datetime.fromisoformat(message["update_time"]),
+            }
+            | columns
+        )
+        if body is not None:
+            bodies.append(body | {"message_id": message_id})
+    return messages, bodies
+
+
+def last_activity():
+    return func.coalesce(db.Chat.last_message_time, db.Chat.create_time)
+
+
+async def archive_batch(
+    older_than: timedelta, limit: int, settings=maintenance_settings
+) -> tuple[int, int]:
+    """
+    Archive up to `limit` chats inactive for `older_than`, in one transaction.
+    The chats are claimed first (`archived` is set, and the version bumped for
+    the ETags of lists), so that concurrent runs on other workers skip them.
+    Returns the number of chats and messages.
+    The windows cached by the context assembler stay valid: archived messages
+    are restored unchanged before a chat is used again.
+    """
+    cutoff = db.utc_now() - older_than
+    inactive = (
+        select(db.Chat.id)
+        .where(
+            db.Chat.archived.is_(False),
+            db.Chat.message_count > 0,
+            last_activity() < cutoff,
+            # not restored (or otherwise changed) since
+            db.Chat.update_time < cutoff,
+        )
+        .order_by(last_activity())
+        .limit(limit)
+    )
+    async with db.engine.begin() as conn:
+        claimed = await conn.execute(
+            update(db.Chat)
+            .where(db.Chat.id.in_(inactive), db.Chat.archived.is_(False))
+            # the chat itself did not change
+            .values(
+                archived=True,
+                version=db.Chat.version + 1,
+                update_time=db.Chat.update_time,
+            )
+            .returning(db.Chat.id)
+        )
+        chat_ids = claimed.scalars().all()
+        if not chat_ids:
+            return 0, 0
+        rows = await conn.execute(
+            select(
+                db.ChatMessage.chat_id,
+                db.ChatMessage.id,
+                db.ChatMessage.role,
+                db.ChatMessage.content,
+                db.ChatMessage.create_time,
+                db.ChatMessage.update_time,
+                db.MessageBody.codec,
+                db.MessageBody.data,
+            )
+            .outerjoin(db.MessageBody, db.MessageBody.message_id == db.ChatMessage.id)
+            .where(db.ChatMessage.chat_id.in_(chat_ids))
+            .order_by(
+                db.ChatMessage.chat_id, db.ChatMessage.create_time, db.ChatMessage.id
+            )
+        )
+        chats: dict[uuid.UUID, list[dict]] = {chat_id: [] for chat_id in chat_ids}
+        for row in rows:
+            message = {
+                "id": str(row.id),
+                "role": row.role.value,
+                "content": row.content,
+                "create_time": row.create_time.isoformat(),
+                "update_time": row.update_time.isoformat(),
+            }
+            if row.data is not None:
+                # the full content of a large message, decompressed by `pack`
+                message["body"] = (row.codec, row.data)
+            chats[row.chat_id].append(message)
+        archives = await asyncio.to_thread(
+            pack, chats, settings.COMPRESSION, settings.COMPRESSION_LEVEL
+        )
+        await conn.execute(insert(db.ChatArchive), archives)
+        for chat_id, messages in chats.items():
+            if not messages:
+                continue
+            # up to the last archived message: newer ones (written meanwhile,
+            # on PostgreSQL) are kept, and restored along with the archive
+            last = messages[-1]
+            await conn.execute(
+                delete(db.ChatMessage).where(
+                    db.ChatMessage.chat_id == chat_id,
+                    tuple_(db.ChatMessage.create_time, db.ChatMessage.id)
+                    <= tuple_(
+                        datetime.fromisoformat(last["create_time"]),
+                        uuid.UUID(last["id"]),
+                    ),
+                )
+            )
+    messages = sum(archive["message_count"] for archive in archives)
+    metrics.chats_archived.inc(len(chat_ids))
+    metrics.archived_bytes.inc(sum(a["size"] for a in archives), ("raw",))
+    metrics.archived_bytes.inc(sum(len(a["data"]) for a in archives), ("compressed",))
+    return len(chat_ids), messages
+
+
+async def restore(chat_id: uuid.UUID) -> int:
+    """Move the messages of an archived chat back, returning how many"""
+    start = time.perf_counter()
+    async with db.engine.begin() as conn:
+        # concurrent restores wait for this one, then find nothing to restore
+        archive = await conn.execute(
+            delete(db.ChatArchive)
+            .where(db.ChatArchive.chat_id == chat_id)
+            .returning(db.ChatArchive.codec, db.ChatArchive.data)
+        )
+        archive = archive.one_or_none()
+        messages = bodies = []
+        if archive is not None:
+            messages, bodies = await asyncio.to_thread(
+                unpack, archive.data, archive.codec, chat_id
+            )
+        if messages:
+            # multi-row INSERT statements (see `bulk.Importer.flush`)
+            await conn.execute(
+                insert(db.ChatMessage).returning(db.ChatMessage.id), messages
+            )
+        if bodies:
+            await conn.execute(insert(db.MessageBody), bodies)
+        # touched, so that the next maintenance runs do not archive it again
+        await conn.execute(
+            db.update_chat_summaries({chat_id}).values(
+                archived=False, update_time=db.utc_now()
+            )
+        )
+    if archive is not None:
+        metrics.restore_duration.observe(time.perf_counter() - start)
+        logger.info(f"Restored {len(messages)} archived messages of chat {chat_id}")
+    return len(messages)
+
+
+def export_messages(codec: str, data: bytes) -> list[dict]:
+    """Archived messages, in the export format of `bulk`"""
+    messages = json.loads(decompress(data, codec))
+    for message in messages:
+        del message["update_time"]
+    return messages
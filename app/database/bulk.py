@@ -0,0 +1,329 @@
+"""
+Bulk import and export of conversations, as JSON lines (one chat per line).
+
+Each line is either a chat:
+
+    {"title": "...", "messages": [{"role": "human", "content": "..."}, ...]}
+
+or a ChatML conversation (`{"messages": [...]}` or a bare list of messages,
+with `user`/`assistant`/`system` roles). `id` and `create_time` are optional,
+so an export can be imported back as is.
+
+Input is read line by line and inserted in batches with Core inserts
+(no ORM objects), so memory stays bounded whatever the size of the file:
+
+    python -m app.database.bulk import conversations.jsonl
+    python -m app.database.bulk export backup.jsonl
+    python -m app.database.bulk generate --chats 10000 --messages 100 | \\
+        python -m app.database.bulk import -
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import random
+import string
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import AsyncIterable, AsyncIterator, Iterable, Iterator, TextIO
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from . import database as db
+from .archive import export_messages
+from .content import full_content, split
+
+logger = logging.getLogger("uvicorn.error")
+
+ROLES = {
+    "user": db.ChatMessageRole.HUMAN,
+    "assistant": db.ChatMessageRole.AI,
+    "system": db.ChatMessageRole.SYSTEM,
+} | {role.value: role for role in db.ChatMessageRole}
+
+
+def parse_role(role: str) -> db.ChatMessageRole:
+    try:
+        return ROLES[role.lower()]
+    except KeyError:
+        raise ValueError(f"Unknown role: {role!r}") from None
+
+
+def parse_chat(line: str, number: int) -> dict | None:
+    """Chat of a JSON line, either in the export format or ChatML"""
+    if not line.strip():
+        return None
+    try:
+        chat = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Line {number}: {e}") from None
+    return {"messages": chat} if isinstance(chat, list) else chat
+
+
+async def read_file(path: str, block_size: int = 1024 * 1024) -> AsyncIterator[dict]:
+    """
+    Chats of a JSONL file, or of stdin with `-` (see `parse_chat`).
+    Lines are read in a thread, about `block_size` bytes at a time,
+    so the event loop is never blocked by the file.
+    """
+    f = await asyncio.to_thread(open_file, path, "r")
+    number = 0
+    try:
+        while lines := await asyncio.to_thread(f.readlines, block_size):
+            for line in lines:
+                number += 1
+                if (chat := parse_chat(line, number)) is not None:
+                    yield chat
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+class Importer:
+    """Inserts chats in batches of (at least) `batch_size` messages, or chats"""
+
+    def __init__(self, conn: AsyncConnection, batch_size: int, new_ids: bool = False):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.new_ids = new_ids
+        self.chats: list[dict] = []
+        self.messages: list[dict] = []
+        self.bodies: list[dict] = []
+        self.chat_count = 0
+        self.message_count = 0
+        # chats without a create_time keep the order of the input
+        self._clock = db.utc_now()
+
+    def _tick(self) -> datetime:
+        self._clock += timedelta(microseconds=1)
+        return self._clock
+
+    def _time(self, value: str | None) -> datetime:
+        return datetime.fromisoformat(value) if value else self._tick()
+
+    def _id(self, value: str | None) -> uuid.UUID:
+        return uuid.UUID(value) if value and not self.new_ids else uuid.uuid4()
+
+    async def add(self, chat: dict) -> None:
+        chat_id = self._id(chat.get("id"))
+        create_time = self._time(chat.get("create_time"))
+        self.chats.append(
+            {
+                "id": chat_id,
+                "title": chat.get("title"),
+                "create_time": create_time,
+                "update_time": create_time,
+            }
+        )
+        for message in chat.get("messages", []):
+            message_id = self._id(message.get("id"))
+            message_time = self._time(message.get("create_time"))
+            columns, body = split(message.get("content"))
+            self.messages.append(
+                {
+                    "id": message_id,
+                    "chat_id": chat_id,
+                    "role": parse_role(message["role"]),
+                    "create_time": message_time,
+                    "update_time": message_time,
+                }
+                | columns
+            )
+            if body is not None:
+                self.bodies.append(body | {"message_id": message_id})
+        # chats without messages fill a batch too
+        if max(len(self.chats), len(self.messages)) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if not self.chats:
+            return
+        chats, messages, bodies = self.chats, self.messages, self.bodies
+        self.chats, self.messages, self.bodies = [], [], []
+        conn = self.conn
+        await conn.execute(insert(db.Chat), chats)
+        if messages:
+            # with RETURNING, SQLAlchemy sends the rows as multi-row INSERT
+            # statements ("insertmanyvalues") instead of one statement per row:
+            # FTS5 flushes its pending index at the end of every statement
+            await conn.execute(
+                insert(db.ChatMessage).returning(db.ChatMessage.id), messages
+            )
+        if bodies:
+            await conn.execute(insert(db.MessageBody), bodies)
+        # imported chats keep their times, for archival
+        await conn.execute(
+            db.update_chat_summaries({chat["id"] for chat in chats}).values(
+                update_time=db.Chat.update_time
+            )
+        )
+        await conn.commit()
+        self.chat_count += len(chats)
+        self.message_count += len(messages)
+        logger.info(f"Imported {self.chat_count} chats, {self.message_count} messages")
+
+
+async def import_chats(
+    chats: Iterable[dict] | AsyncIterable[dict],
+    batch_size: int = 10_000,
+    new_ids: bool = False,
+) -> tuple[int, int]:
+    """Insert chats (and their messages), returning how many were imported"""
+    async with db.engine.connect() as conn:
+        importer = Importer(conn, batch_size=batch_size, new_ids=new_ids)
+        if isinstance(chats, AsyncIterable):
+            async for chat in chats:
+                await importer.add(chat)
+        else:
+            for chat in chats:
+                await importer.add(chat)
+        await importer.flush()
+    return importer.chat_count, importer.message_count
+
+
+def export_query():
+    """Chats with their messages, in order: rows of the same chat are contiguous"""
+    return (
+        select(
+            db.Chat.id.label("chat_id"),
+            db.Chat.title,
+            db.Chat.create_time.label("chat_create_time"),
+            db.ChatMessage.id,
+            db.ChatMessage.role,
+            db.ChatMessage.content,
+            db.ChatMessage.create_time,
+            db.MessageBody.codec.label("body_codec"),
+            db.MessageBody.data.label("body"),
+            db.ChatArchive.codec,
+            db.ChatArchive.data,
+        )
+        .outerjoin(db.ChatMessage, db.ChatMessage.chat_id == db.Chat.id)
+        .outerjoin(db.MessageBody, db.MessageBody.message_id == db.ChatMessage.id)
+        .outerjoin(db.ChatArchive, db.ChatArchive.chat_id == db.Chat.id)
+        .order_by(
+            db.Chat.create_time,
+            db.Chat.id,
+            db.ChatMessage.create_time,
+            db.ChatMessage.id,
+        )
+    )
+
+
+async def export_chats(conn: AsyncConnection) -> AsyncIterator[dict]:
+    """
+    All chats with their messages, from the oldest.
+    Rows are fetched through a server-side cursor, one chat at a time is in memory.
+    """
+    result = await conn.stream(export_query().execution_options(yield_per=1000))
+    chat = None
+    async for row in result:
+        if chat is None or chat["id"] != str(row.chat_id):
+            if chat is not None:
+                yield chat
+            chat = {
+                "id": str(row.chat_id),
+                "title": row.title,
+                "create_time": row.chat_create_time.isoformat(),
+                # archived messages are older than the others
+                "messages": (
+                    export_messages(row.codec, row.data) if row.data is not None else []
+                ),
+            }
+        if row.id is not None:
+            chat["messages"].append(
+                {
+                    "id": str(row.id),
+                    "role": row.role.value,
+                    "content": full_content(row.content, row.body_codec, row.body),
+                    "create_time": row.create_time.isoformat(),
+                }
+            )
+    if chat is not None:
+        yield chat
+
+
+async def export_lines(engine=None) -> AsyncIterator[str]:
+    """Export as JSON lines, on a dedicated connection"""
+    async with (engine or db.read_engine).connect() as conn:
+        async for chat in export_chats(conn):
+            yield json.dumps(chat) + "\n"
+
+
+def vocabulary(size: int, rng: random.Random) -> list[str]:
+    return [
+        "".join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10)))
+        for _ in range(size)
+    ]
+
+
+def generate_chats(chats: int, messages: int, words: int = 30) -> Iterator[dict]:
+    """Synthetic chats, alternating human and AI messages (for load tests)"""
+    rng = random.Random(0)
+    words_ = vocabulary(5_000, rng)
+    roles = [db.ChatMessageRole.HUMAN.value, db.ChatMessageRole.AI.value]
+    for i in range(chats):
+        yield {
+            "title": f"Chat {i + 1}",
+            "messages": [
+                {
+                    "role": roles[j % 2],
+                    "content": " ".join(rng.choices(words_, k=words)),
+                }
+                for j in range(messages)
+            ],
+        }
+
+
+def open_file(path: str, mode: str) -> TextIO:
+    if path == "-":
+        return sys.stdin if "r" in mode else sys.stdout
+    return open(path, mode, encoding="utf-8")
+
+
+async def main(args: argparse.Namespace) -> None:
+    start = time.perf_counter()
+    match args.command:
+        case "import":
+            await db.init_db()
+            chats, messages = await import_chats(
+                read_file(args.file),
+                batch_size=args.batch_size,
+                new_ids=args.new_ids,
+            )
+            print(
+                f"Imported {chats} chats, {messages} messages "
+                f"in {time.perf_counter() - start:.1f}s",
+                file=sys.stderr,
+            )
+        case "export":
+            with open_file(args.file, "w") as f:
+                async for line in export_lines():
+                    f.write(line)
+        case "generate":
+            with open_file(args.file, "w") as f:
+                for chat in generate_chats(args.chats, args.messages, args.words):
+                    f.write(json.dumps(chat) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("import", help="import chats from JSON lines")
+    command.add_argument("file", help="JSONL file, or - for stdin")
+    command.add_argument("--batch-size", type=int, default=10_000)
+    command.add_argument(
+        "--new-ids", action="store_true", help="ignore the ids in the input"
+    )
+    command = commands.add_parser("export", help="export all chats as JSON lines")
+    command.add_argument("file", nargs="?", default="-")
+    command = commands.add_parser("generate", help="write synthetic chats")
+    command.add_argument("file", nargs="?", default="-")
+    command.add_argument("--chats", type=int, default=10_000)
+    command.add_argument("--messages", type=int, default=100)
+    command.add_argument("--words", type=int, default=30, help="per message")
+    args = parser.parse_args()
+    asyncio.run(main(args))
@@ -0,0 +1,50 @@
+"""
+Compression codecs of stored data (archived chats, large message contents):
+gzip, or zstd with the optional `zstandard` package.
+"""
+
+import gzip
+import zlib
+from typing import Iterator
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise RuntimeError(
+            "zstd compression requires zstandard: uv sync --extra zstd"
+        ) from None
+    return zstandard
+
+
+def compress(data: bytes, codec: str, level: int) -> bytes:
+    if codec == "zstd":
+        return _zstd().ZstdCompressor(level=level).compress(data)
+    # no timestamp in the header: the same data is compressed to the same bytes
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    if codec == "zstd":
+        return _zstd().ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+def decompress_chunks(data: bytes, codec: str, size: int) -> Iterator[bytes]:
+    """Decompress into chunks of at most `size` bytes, never all at once"""
+    if codec == "zstd":
+        decompressor = _zstd().ZstdDecompressor()
+        yield from decompressor.read_to_iter(data, read_size=size, write_size=size)
+        return
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)  # gzip header
+    pending = data
+    while pending:
+        chunk = decompressor.decompress(pending, size)
+        pending = decompressor.unconsumed_tail
+        if chunk:
+            yield chunk
+        elif decompressor.eof:
+            break
+    if chunk := decompressor.flush():
+        yield chunk
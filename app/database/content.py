@@ -0,0 +1,64 @@
+"""
+Storage of large message contents.
+
+Contents longer than `DATABASE_CONTENT_THRESHOLD` characters are compressed
+into `messagebody`, one row per message, and `chatmessage.content` keeps a
+preview (the first `DATABASE_CONTENT_PREVIEW` characters), with `truncated`
+set. Rows of `chatmessage` stay small, so lists and summaries only ever read
+previews; the full content is read by the LLM context, exports, archival,
+the search index (through the `full_content` SQL function, on SQLite) and
+`/messages/{id}/content`, which streams it in chunks.
+Every message has the length (in characters) and SHA-256 of its full content.
+"""
+
+import hashlib
+from typing import Iterator
+
+from ..settings import database_settings
+from .compression import compress, decompress, decompress_chunks
+
+
+def split(content: str | None, settings=database_settings) -> tuple[dict, dict | None]:
+    """Columns of `chatmessage` for a content, and the `messagebody` row if large"""
+    if content is None:
+        columns = {"content_length": None, "content_hash": None, "truncated": False}
+        return {"content": None} | columns, None
+    encoded = content.encode()
+    columns = {
+        "content": content,
+        "content_length": len(content),
+        "content_hash": hashlib.sha256(encoded).hexdigest(),
+        "truncated": False,
+    }
+    if len(content) <= settings.CONTENT_THRESHOLD:
+        return columns, None
+    codec = settings.CONTENT_COMPRESSION
+    body = {
+        "codec": codec,
+        "data": compress(encoded, codec, settings.CONTENT_COMPRESSION_LEVEL),
+    }
+    columns |= {"content": content[: settings.CONTENT_PREVIEW], "truncated": True}
+    return columns, body
+
+
+def full_content(content: str | None, codec: str | None, data: bytes | None):
+    """Full content of a message, from its preview and body (if any)"""
+    if data is None:
+        return content
+    return decompress(data, codec).decode()
+
+
+def iter_content(
+    content: str | None,
+    codec: str | None,
+    data: bytes | None,
+    settings=database_settings,
+) -> Iterator[bytes]:
+    """Full content of a message as UTF-8, in chunks of bounded size"""
+    if data is not None:
+        yield from decompress_chunks(data, codec, settings.CONTENT_CHUNK_SIZE)
+        return
+    encoded = (content or "").encode()
+    size = settings.CONTENT_CHUNK_SIZE
+    for start in range(0, len(encoded), size):
+        yield encoded[start : start + size]
@@ -1,15 +1,27 @@
 import asyncio
-import json
+import time
 import uuid
 from datetime import datetime, timezone
 from enum import StrEnum, auto
 
-from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy import (
+    DateTime,
+    Index,
+    TypeDecorator,
+    event,
+    func,
+    make_url,
+    select,
+    update,
+)
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 from sqlmodel import Field, Relationship, SQLModel
 from sqlmodel.ext.asyncio.session import AsyncSession
 
-SQLITE_FILE = "database.db"
-SQLITE_URL = f"sqlite+aiosqlite:///{SQLITE_FILE}"
+from .. import metrics, tracing
+from ..settings import database_settings, telemetry_settings
+from . import content as message_content
+from .migrations import run_migrations
 
 
 def utc_now():
@@ -22,62 +34,291 @@ class ChatMessageRole(StrEnum):
     SYSTEM = auto()
 
 
+class UTCDateTime(TypeDecorator):
+    """
+    Timezone-aware datetime, stored in UTC.
+    Backends without timezone support (SQLite) return naive datetimes,
+    which are assumed to be UTC.
+    """
+
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value: datetime | None, dialect):
+        if value is None:
+            return value
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc)
+
+    def process_result_value(self, value: datetime | None, dialect):
+        if value is not None and value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value
+
+
 class Base(SQLModel, table=False):
-    id: str = Field(default_factory=lambda: uuid.uuid4().hex, primary_key=True)
-    create_time: datetime = Field(default_factory=utc_now, nullable=False)
+    # stored as native UUID where available (CHAR(32) hex in SQLite)
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    create_time: datetime = Field(
+        default_factory=utc_now,
+        nullable=False,
+        sa_type=UTCDateTime,
+        sa_column_kwargs={"server_default": func.now()},
+    )
     update_time: datetime = Field(
-        default_factory=utc_now, nullable=False, sa_column_kwargs={"onupdate": utc_now}
+        default_factory=utc_now,
+        nullable=False,
+        sa_type=UTCDateTime,
+        sa_column_kwargs={"server_default": func.now(), "onupdate": utc_now},
     )
 
 
-class Chat(Base, table=True):
+class ChatBase(Base, table=False):
     title: str | None = Field(None, nullable=True)
+    # summary of the history, kept up to date by `update_chat_summaries`
+    message_count: int = Field(
+        0, nullable=False, sa_column_kwargs={"server_default": "0"}
+    )
+    last_message_time: datetime | None = Field(None, nullable=True, sa_type=UTCDateTime)
+    last_message_snippet: str | None = Field(None, nullable=True)
+    # bumped on every change to the chat or its messages (used for ETags)
+    version: int = Field(0, nullable=False, sa_column_kwargs={"server_default": "0"})
+    # messages moved to `ChatArchive`, restored on access (see `archive.py`)
+    archived: bool = Field(
+        False, nullable=False, sa_column_kwargs={"server_default": "0"}
+    )
+
+
+class Chat(ChatBase, table=True):
+    # chat list is sorted by (create_time, id)
+    __table_args__ = (Index("ix_chat_create_time_id", "create_time", "id"),)
+
+    # history is never loaded implicitly: use `selectinload(Chat.history)`
+    # when needed; deletes are cascaded by the db
     history: list["ChatMessage"] = Relationship(
         back_populates="chat",
         cascade_delete=True,
+        passive_deletes=True,
         sa_relationship_kwargs={
-            "lazy": "subquery",
-            "order_by": "asc(ChatMessage.create_time)",
+            "lazy": "raise",
+            "order_by": "[ChatMessage.create_time, ChatMessage.id]",
         },
     )
 
 
+class MessageBody(SQLModel, table=True):
+    """Compressed full content of a large message"""
+
+    message_id: uuid.UUID = Field(
+        primary_key=True, foreign_key="chatmessage.id", ondelete="CASCADE"
+    )
+    # compression of `data` (gzip or zstd)
+    codec: str = Field(nullable=False)
+    data: bytes = Field(nullable=False)
+
+
 class ChatMessage(Base, table=True):
-    chat_id: str = Field(nullable=False, foreign_key="chat.id", ondelete="CASCADE")
+    # messages are always filtered by chat and sorted by (create_time, id)
+    __table_args__ = (
+        Index("ix_chatmessage_chat_id_create_time_id", "chat_id", "create_time", "id"),
+    )
+
+    chat_id: uuid.UUID = Field(
+        nullable=False, foreign_key="chat.id", ondelete="CASCADE"
+    )
     chat: Chat = Relationship(back_populates="history")
     role: ChatMessageRole = Field(nullable=False)
+    # a preview of large contents, whose full text is in `body` (see `content.py`)
     content: str | None = Field(None)
+    content_length: int | None = Field(None, nullable=True)
+    content_hash: str | None = Field(None, nullable=True)
+    truncated: bool = Field(
+        False, nullable=False, sa_column_kwargs={"server_default": "0"}
+    )
+    # never loaded implicitly: use `joinedload(ChatMessage.body)` when needed
+    body: MessageBody | None = Relationship(
+        cascade_delete=True,
+        passive_deletes=True,
+        sa_relationship_kwargs={"lazy": "raise", "uselist": False},
+    )
 
+    def set_content(self, content: str | None) -> None:
+        """Set the content, storing large ones compressed in `body`"""
+        columns, body = message_content.split(content)
+        for name, value in columns.items():
+            setattr(self, name, value)
+        if body is not None:
+            self.body = MessageBody(message_id=self.id, **body)
+
+    @property
+    def full_content(self) -> str | None:
+        """Full content (`body` must be loaded for truncated messages)"""
+        if not self.truncated:
+            return self.content
+        return message_content.full_content(None, self.body.codec, self.body.data)
+
+
+class ChatArchive(SQLModel, table=True):
+    """Messages of an inactive chat, as one compressed JSON document"""
+
+    chat_id: uuid.UUID = Field(
+        primary_key=True, foreign_key="chat.id", ondelete="CASCADE"
+    )
+    # compression of `data` (gzip or zstd)
+    codec: str = Field(nullable=False)
+    data: bytes = Field(nullable=False)
+    message_count: int = Field(nullable=False)
+    # size of the uncompressed document
+    size: int = Field(nullable=False)
+    archive_time: datetime = Field(
+        default_factory=utc_now, nullable=False, sa_type=UTCDateTime
+    )
 
-engine = create_async_engine(SQLITE_URL, echo=True)
+
+class ChatWithHistory(ChatBase):
+    history: list[ChatMessage] = []
+
+
+SNIPPET_LENGTH = 100
+
+
+def update_chat_summaries(chat_ids: set[uuid.UUID]):
+    """Statement recomputing the summary and bumping the version of the given chats"""
+    messages = select(ChatMessage).where(ChatMessage.chat_id == Chat.id)
+    last_message = messages.order_by(
+        ChatMessage.create_time.desc(), ChatMessage.id.desc()
+    ).limit(1)
+    return (
+        update(Chat)
+        .where(Chat.id.in_(chat_ids))
+        .values(
+            message_count=messages.with_only_columns(func.count()).scalar_subquery(),
+            last_message_time=last_message.with_only_columns(
+                ChatMessage.create_time
+            ).scalar_subquery(),
+            last_message_snippet=last_message.with_only_columns(
+                func.substr(ChatMessage.content, 1, SNIPPET_LENGTH)
+            ).scalar_subquery(),
+            version=Chat.version + 1,
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def sqlite_pragmas(read_only: bool = False) -> list[str]:
+    settings = database_settings
+    pragmas = [
+        f"PRAGMA busy_timeout={settings.BUSY_TIMEOUT}",
+        f"PRAGMA mmap_size={settings.MMAP_SIZE}",
+        f"PRAGMA cache_size={settings.CACHE_SIZE}",
+        f"PRAGMA foreign_keys={'ON' if settings.FOREIGN_KEYS else 'OFF'}",
+    ]
+    if not read_only:
+        # journal mode is persistent, and cannot be changed by read-only connections
+        pragmas += [
+            # only applies to new dbs (so it must come before the journal mode),
+            # existing ones are converted by a full VACUUM
+            f"PRAGMA auto_vacuum={settings.AUTO_VACUUM}",
+            f"PRAGMA journal_mode={settings.JOURNAL_MODE}",
+            f"PRAGMA synchronous={settings.SYNCHRONOUS}",
+        ]
+    return pragmas
+
+
+def sqlite_functions(dbapi_connection) -> None:
+    """Register the SQL functions read by the search index (see migration 7)"""
+    dbapi_connection.create_function(
+        "full_content", 3, message_content.full_content, deterministic=True
+    )
+
+
+def create_engine(read_only: bool = False) -> AsyncEngine:
+    """Create the db engine from settings"""
+    settings = database_settings
+    url = make_url(
+        settings.READ_URL if read_only and settings.READ_URL else settings.URL
+    )
+    backend = url.get_backend_name()
+    kwargs = {
+        "echo": settings.ECHO,
+        "pool_size": settings.READ_POOL_SIZE if read_only else settings.POOL_SIZE,
+        "max_overflow": settings.MAX_OVERFLOW,
+        "pool_timeout": settings.POOL_TIMEOUT,
+    }
+    if backend == "sqlite" and read_only:
+        url = url.set(
+            database=f"file:{url.database}", query={"mode": "ro", "uri": "true"}
+        )
+    if backend == "postgresql":
+        server_settings = {"application_name": settings.APPLICATION_NAME}
+        if read_only:
+            server_settings["default_transaction_read_only"] = "on"
+        kwargs |= {
+            "pool_pre_ping": True,
+            "pool_recycle": settings.POOL_RECYCLE,
+            "connect_args": {"server_settings": server_settings},
+        }
+
+    engine = create_async_engine(url, **kwargs)
+    if backend == "sqlite":
+        pragmas = sqlite_pragmas(read_only)
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+            sqlite_functions(dbapi_connection)
+
+    if tracing.tracer is not None and telemetry_settings.TRACE_SQL:
+        tracing.trace_engine(engine)
+    return engine
+
+
+instrumented = telemetry_settings.METRICS or tracing.tracer is not None
+if instrumented:
+    metrics.instrument_sessions()
+engine = create_engine()
+# with a single pool, reads share the connections used for writes
+read_engine = (
+    create_engine(read_only=True)
+    if database_settings.READ_POOL or database_settings.READ_URL
+    else engine
+)
 
 
 async def init_db():
     async with engine.begin() as conn:
         await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.run_sync(run_migrations)
+
+
+async def connect(session: AsyncSession, pool: str) -> None:
+    """Acquire the connection of a session upfront, to time the wait for the pool"""
+    if instrumented:
+        start = time.perf_counter()
+        await session.connection()
+        metrics.session_wait.observe(time.perf_counter() - start, (pool,))
 
 
 async def get_session():
     async with AsyncSession(engine) as session:
+        await connect(session, "write")
+        yield session
+
+
+async def get_read_session():
+    async with AsyncSession(read_engine) as session:
+        await connect(session, "read")
         yield session
 
 
 async def populate_db():
-    with open("conversations.json", "r") as f:
-        conversations = json.load(f)
-    async with AsyncSession(engine) as session:
-        for i, conversation in enumerate(conversations):
-            chat = Chat(title=f"Demo Chat {i+1}")
-            chat.history = [
-                ChatMessage(
-                    chat_id=chat.id,
-                    role=message["role"],
-                    content=message["content"],
-                )
-                for message in conversation
-            ]
-            session.add(chat)
-        await session.commit()
+    from .bulk import import_chats, read_file
+
+    await import_chats(read_file("conversations.jsonl"))
 
 
 if __name__ == "__main__":
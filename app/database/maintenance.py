@@ -0,0 +1,217 @@
+"""
+Periodic maintenance of the db: archival of inactive chats (see `archive.py`),
+then compaction within a time budget.
+
+On SQLite, compaction releases free pages a few at a time
+(`PRAGMA incremental_vacuum`), refreshes the planner statistics
+(`PRAGMA optimize`) and merges the segments of the search index. Incremental
+vacuum needs `auto_vacuum=incremental`: new dbs are created with it, existing
+ones are converted once by a full VACUUM (which locks the db while it runs).
+On PostgreSQL, autovacuum reclaims space and only ANALYZE is run.
+
+With `MAINTENANCE_ENABLED`, the app runs it every `MAINTENANCE_INTERVAL`;
+it can also be run from cron:
+
+    python -m app.database.maintenance run
+    python -m app.database.maintenance vacuum
+"""
+
+import argparse
+import asyncio
+import logging
+import random
+import time
+from datetime import timedelta
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from .. import metrics
+from ..settings import maintenance_settings
+from . import database as db
+from .archive import archive_batch
+from .search import FTS_TABLE
+
+logger = logging.getLogger("uvicorn.error")
+
+# pages of the search index merged per step
+FTS_MERGE_PAGES = 500
+
+
+async def pragma(conn: AsyncConnection, statement: str) -> list:
+    result = await conn.exec_driver_sql(f"PRAGMA {statement}")
+    return result.fetchall() if result.returns_rows else []
+
+
+async def incremental_vacuum(conn: AsyncConnection, deadline: float, pages: int) -> int:
+    """Release free pages until there are none or the deadline, returning bytes"""
+    if (await pragma(conn, "auto_vacuum"))[0][0] != 2:
+        logger.info(
+            "Incremental vacuum is off: run `python -m app.database.maintenance "
+            "vacuum` once to enable it"
+        )
+        return 0
+    page_size = (await pragma(conn, "page_size"))[0][0]
+    reclaimed = 0
+    while time.monotonic() < deadline:
+        free = (await pragma(conn, "freelist_count"))[0][0]
+        if not free:
+            break
+        # one page is released per step of the statement, and its rows have no
+        # columns (which SQLAlchemy does not fetch): step it on the driver
+        raw = await conn.get_raw_connection()
+        cursor = await raw.driver_connection.execute(
+            f"PRAGMA incremental_vacuum({pages})"
+        )
+        await cursor.fetchall()
+        await cursor.close()
+        await conn.commit()
+        released = free - (await pragma(conn, "freelist_count"))[0][0]
+        if released <= 0:
+            break
+        reclaimed += released * page_size
+    return reclaimed
+
+
+async def compact(deadline: float, settings=maintenance_settings) -> int:
+    """Compact the db until the deadline, returning the bytes reclaimed"""
+    async with db.engine.connect() as conn:
+        if conn.dialect.name != "sqlite":
+            await conn.execute(text("ANALYZE"))
+            await conn.commit()
+            return 0
+        reclaimed = await incremental_vacuum(conn, deadline, settings.VACUUM_PAGES)
+        if time.monotonic() < deadline:
+            # ANALYZE of the tables whose statistics are stale, on a sample
+            await pragma(conn, "analysis_limit=400")
+            await pragma(conn, "optimize")
+        if time.monotonic() < deadline:
+            await conn.execute(
+                text(
+                    f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rank) "
+                    f"VALUES ('merge', {FTS_MERGE_PAGES})"
+                )
+            )
+            await conn.commit()
+    metrics.reclaimed_bytes.inc(reclaimed)
+    return reclaimed
+
+
+async def full_vacuum() -> int:
+    """Rebuild the db file (enabling incremental vacuum), returning bytes reclaimed"""
+    async with db.engine.connect() as conn:
+        # VACUUM cannot run in a transaction
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        if conn.dialect.name != "sqlite":
+            await conn.execute(text("VACUUM ANALYZE"))
+            return 0
+        page_size = (await pragma(conn, "page_size"))[0][0]
+        before = (await pragma(conn, "page_count"))[0][0]
+        await pragma(conn, f"auto_vacuum={db.database_settings.AUTO_VACUUM}")
+        await conn.exec_driver_sql("VACUUM")
+        await pragma(conn, "optimize")
+        after = (await pragma(conn, "page_count"))[0][0]
+    reclaimed = max(before - after, 0) * page_size
+    metrics.reclaimed_bytes.inc(reclaimed)
+    return reclaimed
+
+
+class Maintenance:
+    def __init__(self, settings=maintenance_settings):
+        self.settings = settings
+        self.task: asyncio.Task | None = None
+        # stats
+        self.runs = 0
+        self.archived_chats = 0
+        self.archived_messages = 0
+        self.reclaimed_bytes = 0
+        self.last_run: dict | None = None
+
+    async def run(self, budget: float | None = None) -> dict:
+        """Archive inactive chats for half of the budget, then compact the db"""
+        settings = self.settings
+        budget = settings.TIME_BUDGET if budget is None else budget
+        start = time.monotonic()
+        chats = messages = 0
+        if settings.ARCHIVE_AFTER_DAYS > 0:
+            older_than = timedelta(days=settings.ARCHIVE_AFTER_DAYS)
+            while time.monotonic() < start + budget / 2:
+                archived = await archive_batch(
+                    older_than, settings.ARCHIVE_BATCH_SIZE, settings
+                )
+                chats, messages = chats + archived[0], messages + archived[1]
+                if archived[0] < settings.ARCHIVE_BATCH_SIZE:
+                    break
+        reclaimed = await compact(start + budget, settings)
+        self.runs += 1
+        self.archived_chats += chats
+        self.archived_messages += messages
+        self.reclaimed_bytes += reclaimed
+        self.last_run = {
+            "time": db.utc_now().isoformat(),
+            "duration": round(time.monotonic() - start, 3),
+            "archived_chats": chats,
+            "archived_messages": messages,
+            "reclaimed_bytes": reclaimed,
+        }
+        logger.info(
+            f"Maintenance: archived {chats} chats ({messages} messages), "
+            f"reclaimed {reclaimed} bytes"
+        )
+        return self.last_run
+
+    async def _run_forever(self) -> None:
+        # workers started together do not run at the same time
+        await asyncio.sleep(random.uniform(0, min(self.settings.INTERVAL, 60)))
+        while True:
+            try:
+                await self.run()
+            except Exception:
+                logger.exception("Maintenance failed")
+            await asyncio.sleep(self.settings.INTERVAL)
+
+    def start(self) -> None:
+        if self.settings.ENABLED and self.task is None:
+            self.task = asyncio.create_task(self._run_forever())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.settings.ENABLED,
+            "runs": self.runs,
+            "archived_chats": self.archived_chats,
+            "archived_messages": self.archived_messages,
+            "reclaimed_bytes": self.reclaimed_bytes,
+            "last_run": self.last_run,
+        }
+
+
+maintenance = Maintenance()
+
+
+async def main(args: argparse.Namespace) -> None:
+    await db.init_db()
+    match args.command:
+        case "run":
+            print(await maintenance.run(args.budget))
+        case "vacuum":
+            print(f"Reclaimed {await full_vacuum()} bytes")
+    await db.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("run", help="archive and compact, then exit")
+    command.add_argument(
+        "--budget", type=float, default=None, help="seconds (MAINTENANCE_TIME_BUDGET)"
+    )
+    commands.add_parser("vacuum", help="full VACUUM, enables incremental vacuum")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(args))
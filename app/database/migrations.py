@@ -0,0 +1,308 @@
+"""
+Minimal versioned schema migrations.
+
+`create_all` only creates missing tables, so changes to existing tables
+(new indexes, columns, ...) are applied here. Each migration runs once,
+in version order, and is recorded in the `schema_version` table.
+Migrations must be idempotent, since on a fresh db the tables are
+already created with the latest schema.
+"""
+
+import logging
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Callable
+
+from sqlalchemy import (
+    Column,
+    Connection,
+    DateTime,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    inspect,
+    select,
+    text,
+)
+
+from .content import split
+
+logger = logging.getLogger("uvicorn.error")
+
+metadata = MetaData()
+
+schema_version = Table(
+    "schema_version",
+    metadata,
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("apply_time", DateTime(timezone=True), nullable=False),
+)
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    upgrade: Callable[[Connection], None]
+
+
+MIGRATIONS: list[Migration] = []
+
+
+def migration(version: int):
+    """Register a migration function"""
+
+    def decorator(func: Callable[[Connection], None]):
+        MIGRATIONS.append(Migration(version=version, name=func.__name__, upgrade=func))
+        return func
+
+    return decorator
+
+
+def run_migrations(conn: Connection) -> list[int]:
+    """Apply pending migrations, returning the applied versions"""
+    if conn.dialect.name == "postgresql":
+        # several workers may start at the same time
+        conn.execute(text("SELECT pg_advisory_xact_lock(7160251)"))
+    metadata.create_all(conn)
+    applied = set(conn.execute(select(schema_version.c.version)).scalars())
+    pending = sorted(
+        (m for m in MIGRATIONS if m.version not in applied), key=lambda m: m.version
+    )
+    for m in pending:
+        logger.info(f"Applying migration {m.version}: {m.name}")
+        m.upgrade(conn)
+        conn.execute(
+            schema_version.insert().values(
+                version=m.version, name=m.name, apply_time=datetime.now(timezone.utc)
+            )
+        )
+    return [m.version for m in pending]
+
+
+# ================
+# == MIGRATIONS ==
+# ================
+
+
+@migration(1)
+def add_hot_path_indexes(conn: Connection) -> None:
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_chat_create_time_id "
+            "ON chat (create_time, id)"
+        )
+    )
+    conn.execute(
+        text(
+            "CREATE INDEX IF NOT EXISTS ix_chatmessage_chat_id_create_time_id "
+            "ON chatmessage (chat_id, create_time, id)"
+        )
+    )
+
+
+def _add_column(conn: Connection, table: str, column: str, ddl: str) -> None:
+    if column not in {c["name"] for c in inspect(conn).get_columns(table)}:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+
+
+@migration(2)
+def add_chat_summary(conn: Connection) -> None:
+    _add_column(conn, "chat", "message_count", "INTEGER NOT NULL DEFAULT 0")
+    # as `UTCDateTime`: DATETIME on SQLite, TIMESTAMP WITH TIME ZONE on PostgreSQL
+    timestamp = DateTime(timezone=True).compile(dialect=conn.dialect)
+    _add_column(conn, "chat", "last_message_time", timestamp)
+    _add_column(conn, "chat", "last_message_snippet", "VARCHAR")
+    conn.execute(
+        text(
+            """
+            UPDATE chat SET
+                message_count = (
+                    SELECT count(*) FROM chatmessage m WHERE m.chat_id = chat.id
+                ),
+                last_message_time = (
+                    SELECT m.create_time FROM chatmessage m WHERE m.chat_id = chat.id
+                    ORDER BY m.create_time DESC, m.id DESC LIMIT 1
+                ),
+                last_message_snippet = (
+                    SELECT substr(m.content, 1, 100) FROM chatmessage m
+                    WHERE m.chat_id = chat.id
+                    ORDER BY m.create_time DESC, m.id DESC LIMIT 1
+                )
+            """
+        )
+    )
+
+
+@migration(3)
+def add_chat_version(conn: Connection) -> None:
+    _add_column(conn, "chat", "version", "INTEGER NOT NULL DEFAULT 0")
+
+
+@migration(4)
+def add_message_search(conn: Connection) -> None:
+    # full-text index of message contents (SQLite FTS5, external content):
+    # the index holds only the terms, keyed by the rowid of the message
+    if conn.dialect.name != "sqlite":
+        return
+    conn.execute(
+        text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chatmessage_fts USING fts5("
+            "content, content='chatmessage', content_rowid='rowid', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+    )
+    # triggers also fire for the rows deleted by ON DELETE CASCADE
+    conn.execute(
+        text(
+            """
+            CREATE TRIGGER IF NOT EXISTS chatmessage_fts_insert
+            AFTER INSERT ON chatmessage BEGIN
+                INSERT INTO chatmessage_fts (rowid, content)
+                VALUES (new.rowid, new.content);
+            END
+            """
+        )
+    )
+    conn.execute(
+        text(
+            """
+            CREATE TRIGGER IF NOT EXISTS chatmessage_fts_delete
+            AFTER DELETE ON chatmessage BEGIN
+                INSERT INTO chatmessage_fts (chatmessage_fts, rowid, content)
+                VALUES ('delete', old.rowid, old.content);
+            END
+            """
+        )
+    )
+    conn.execute(
+        text(
+            """
+            CREATE TRIGGER IF NOT EXISTS chatmessage_fts_update
+            AFTER UPDATE OF content ON chatmessage BEGIN
+                INSERT INTO chatmessage_fts (chatmessage_fts, rowid, content)
+                VALUES ('delete', old.rowid, old.content);
+                INSERT INTO chatmessage_fts (rowid, content)
+                VALUES (new.rowid, new.content);
+            END
+            """
+        )
+    )
+    # index the existing messages
+    conn.execute(
+        text("INSERT INTO chatmessage_fts (chatmessage_fts) VALUES ('rebuild')")
+    )
+
+
+@migration(5)
+def add_chat_archive(conn: Connection) -> None:
+    # the `chatarchive` table itself is created by `create_all`
+    _add_column(conn, "chat", "archived", "BOOLEAN NOT NULL DEFAULT false")
+
+
+@migration(6)
+def add_message_content(conn: Connection) -> None:
+    # the `messagebody` table itself is created by `create_all`
+    _add_column(conn, "chatmessage", "content_length", "INTEGER")
+    _add_column(conn, "chatmessage", "content_hash", "VARCHAR")
+    _add_column(conn, "chatmessage", "truncated", "BOOLEAN NOT NULL DEFAULT false")
+    # hashes are computed (and large contents compressed) here, in batches
+    while True:
+        rows = conn.execute(
+            text(
+                "SELECT id, content FROM chatmessage "
+                "WHERE content IS NOT NULL AND content_hash IS NULL LIMIT 1000"
+            )
+        ).all()
+        if not rows:
+            break
+        messages, bodies = [], []
+        for message_id, content in rows:
+            columns, body = split(content)
+            messages.append(columns | {"id": message_id})
+            if body is not None:
+                bodies.append(body | {"message_id": message_id})
+        conn.execute(
+            text(
+                "UPDATE chatmessage SET content = :content, "
+                "content_length = :content_length, content_hash = :content_hash, "
+                "truncated = :truncated WHERE id = :id"
+            ),
+            messages,
+        )
+        if bodies:
+            conn.execute(
+                text(
+                    "INSERT INTO messagebody (message_id, codec, data) "
+                    "VALUES (:message_id, :codec, :data)"
+                ),
+                bodies,
+            )
+
+
+@migration(7)
+def index_full_contents(conn: Connection) -> None:
+    # the index of migration 4 only saw the previews of large messages: it now
+    # reads a view of the full contents, decompressed by the `full_content`
+    # SQL function (registered on every connection, see `database.py`)
+    if conn.dialect.name != "sqlite":
+        return
+    for event in ("insert", "delete", "update"):
+        conn.execute(text(f"DROP TRIGGER IF EXISTS chatmessage_fts_{event}"))
+    conn.execute(text("DROP TABLE IF EXISTS chatmessage_fts"))
+    conn.execute(
+        text(
+            """
+            CREATE VIEW IF NOT EXISTS chatmessage_text AS
+            SELECT m.rowid AS rowid, m.id AS id, CASE WHEN m.truncated
+                THEN full_content(NULL, b.codec, b.data) ELSE m.content
+            END AS content
+            FROM chatmessage m LEFT JOIN messagebody b ON b.message_id = m.id
+            """
+        )
+    )
+    conn.execute(
+        text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS chatmessage_fts USING fts5("
+            "content, content='chatmessage_text', content_rowid='rowid', "
+            "tokenize='unicode61 remove_diacritics 2')"
+        )
+    )
+    # whatever the order of the writes to both tables, the text of a message
+    # is removed from the index before each of them and added back after
+    # (triggers also fire for the rows deleted by ON DELETE CASCADE)
+    remove = "INSERT INTO chatmessage_fts (chatmessage_fts, rowid, content) "
+    remove += "SELECT 'delete', rowid, content"
+    add = "INSERT INTO chatmessage_fts (rowid, content) SELECT rowid, content"
+    events = [
+        ("before", "insert", "new", remove),
+        ("after", "insert", "new", add),
+        ("before", "delete", "old", remove),
+        ("after", "delete", "old", add),
+        ("before", "update", "old", remove),
+        ("after", "update", "new", add),
+    ]
+    triggers = [("messagebody", "message_id", *e) for e in events]
+    # a message is not in the view before its insert, nor after its delete
+    triggers += [
+        ("chatmessage", "id", *e)
+        for e in events
+        if e[:2] not in {("before", "insert"), ("after", "delete")}
+    ]
+    for table, key, timing, event, row, statement in triggers:
+        conn.execute(
+            text(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_fts_{timing}_{event}
+                {timing.upper()} {event.upper()} ON {table} BEGIN
+                    {statement} FROM chatmessage_text
+                    WHERE id = {row}.{key} AND content IS NOT NULL;
+                END
+                """
+            )
+        )
+    conn.execute(
+        text("INSERT INTO chatmessage_fts (chatmessage_fts) VALUES ('rebuild')")
+    )
@@ -0,0 +1,95 @@
+"""
+Full-text search over message contents, with SQLite FTS5.
+
+The index holds the full contents of messages, including the compressed
+ones, and is kept in sync by triggers (see migration 7).
+To rebuild it from scratch (e.g. after restoring a backup):
+
+    python -m app.database.search
+"""
+
+import asyncio
+import logging
+import uuid
+
+from sqlalchemy import Select, column, func, literal_column, select, table, text, tuple_
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from . import database as db
+
+logger = logging.getLogger("uvicorn.error")
+
+FTS_TABLE = "chatmessage_fts"
+
+fts = table(FTS_TABLE, column("rowid"), column("rank"))
+
+
+def match_query(words: str) -> str:
+    """
+    FTS5 query matching all `words`; words ending with `*` match as prefixes.
+    Words are quoted, so that user input is never parsed as FTS5 syntax.
+    """
+    terms = []
+    for word in words.split():
+        prefix = word.endswith("*") and len(word) > 1
+        word = word.removesuffix("*") if prefix else word
+        terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms)
+
+
+def search(
+    words: str,
+    chat_id: uuid.UUID | None = None,
+    after: tuple[float, int] | None = None,
+    limit: int = 20,
+) -> Select:
+    """
+    Messages matching `words`, from the best match (lowest bm25 rank).
+    Results are paginated on `(rank, rowid)`, starting `after` a previous result.
+    """
+    match = text(f"{FTS_TABLE} MATCH :match").bindparams(match=match_query(words))
+    snippet = func.snippet(literal_column(FTS_TABLE), 0, "**", "**", "…", 16)
+    query = (
+        select(
+            db.ChatMessage.id,
+            db.ChatMessage.chat_id,
+            db.Chat.title,
+            db.ChatMessage.role,
+            db.ChatMessage.create_time,
+            snippet.label("snippet"),
+            fts.c.rank,
+            fts.c.rowid,
+        )
+        .select_from(fts)
+        .join(db.ChatMessage, literal_column("chatmessage.rowid") == fts.c.rowid)
+        .join(db.Chat, db.Chat.id == db.ChatMessage.chat_id)
+        .where(match)
+        .order_by(fts.c.rank, fts.c.rowid)
+        .limit(limit)
+    )
+    if chat_id is not None:
+        query = query.where(db.ChatMessage.chat_id == chat_id)
+    if after is not None:
+        query = query.where(tuple_(fts.c.rank, fts.c.rowid) > tuple_(*after))
+    return query
+
+
+async def rebuild(conn: AsyncConnection) -> None:
+    """Re-index all messages, then merge the index b-trees"""
+    await conn.execute(
+        text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+    )
+    await conn.execute(
+        text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    )
+
+
+async def main() -> None:
+    await db.init_db()
+    async with db.engine.begin() as conn:
+        await rebuild(conn)
+    logger.info("Search index rebuilt")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
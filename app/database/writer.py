@@ -0,0 +1,173 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ..settings import persistence_settings
+from . import database as db
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def _new_future() -> asyncio.Future:
+    return asyncio.get_running_loop().create_future()
+
+
+@dataclass
+class Turn:
+    """A completed exchange waiting to be written to the db"""
+
+    messages: list[db.ChatMessage]
+    done: asyncio.Future = field(default_factory=_new_future)
+
+
+class MessageWriter:
+    """
+    Write-behind queue for chat messages.
+    Request handlers enqueue completed turns and a single background task
+    writes them in multi-row transactions, so no db session is held while
+    the response is being generated.
+    """
+
+    def __init__(self, queue_size: int, batch_size: int, flush_interval: float):
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: asyncio.Queue[Turn | None] | None = None
+        self._task: asyncio.Task | None = None
+        # stats
+        self.flush_count = 0
+        self.flushed_turns = 0
+        self.failed_turns = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def depth(self) -> int:
+        return 0 if self._queue is None else self._queue.qsize()
+
+    async def start(self) -> None:
+        """Start the background worker"""
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._task = asyncio.create_task(self._run(), name="message-writer")
+
+    async def stop(self) -> None:
+        """Flush everything still in the queue and stop the worker"""
+        if not self.running:
+            return
+        # the sentinel is queued behind pending turns, so they are drained first
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def put(self, messages: list[db.ChatMessage]) -> Turn:
+        """
+        Enqueue messages to be written.
+        Waits if the queue is full (backpressure); await `turn.done`
+        to know when the messages are committed.
+        """
+        if not self.running:
+            raise RuntimeError("Message writer is not running")
+        turn = Turn(messages=messages)
+        await self._queue.put(turn)
+        return turn
+
+    def stats(self) -> dict:
+        return {
+            "running": self.running,
+            "queue_depth": self.depth,
+            "queue_size": self.queue_size,
+            "flush_count": self.flush_count,
+            "flushed_turns": self.flushed_turns,
+            "failed_turns": self.failed_turns,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+            "avg_flush_latency": (
+                self.total_flush_latency / self.flush_count if self.flush_count else 0.0
+            ),
+        }
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            turn = await self._queue.get()
+            if turn is None:
+                break
+            batch = [turn]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    turn = await asyncio.wait_for(self._queue.get(), timeout)
+                except TimeoutError:
+                    break
+                if turn is None:
+                    stopping = True
+                    break
+                batch.append(turn)
+            await self._flush(batch)
+
+    async def _flush(self, batch: list[Turn]) -> None:
+        start = time.perf_counter()
+        written = len(batch)
+        try:
+            await self._write(batch)
+        except Exception:
+            # do not let a single bad turn (e.g. unknown chat) drop the whole batch
+            logger.exception("Batch write failed, retrying turns one by one")
+            for turn in batch:
+                try:
+                    await self._write([turn])
+                except Exception as e:
+                    written -= 1
+                    self.failed_turns += 1
+                    if not turn.done.done():
+                        turn.done.set_exception(e)
+                        # the exception is retrieved by the handler, if still waiting
+                        turn.done.exception()
+                else:
+                    if not turn.done.done():
+                        turn.done.set_result(None)
+        else:
+            for turn in batch:
+                # the handler may have stopped waiting
+                if not turn.done.done():
+                    turn.done.set_result(None)
+
+        latency = time.perf_counter() - start
+        self.flush_count += 1
+        # turns that could not be written are counted in `failed_turns`
+        self.flushed_turns += written
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self.total_flush_latency += latency
+        logger.debug(
+            f"Flushed {written} of {len(batch)} turns in {latency * 1000:.1f}ms"
+        )
+
+    async def _write(self, batch: list[Turn]) -> None:
+        messages = [m for turn in batch for m in turn.messages]
+        async with AsyncSession(db.engine, expire_on_commit=False) as session:
+            session.add_all(messages)
+            await session.flush()
+            await session.exec(db.update_chat_summaries({m.chat_id for m in messages}))
+            await session.commit()
+
+
+writer = MessageWriter(
+    queue_size=persistence_settings.QUEUE_SIZE,
+    batch_size=persistence_settings.BATCH_SIZE,
+    flush_interval=persistence_settings.FLUSH_INTERVAL,
+)
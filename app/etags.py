@@ -0,0 +1,40 @@
+import hashlib
+
+from fastapi import Request, Response
+
+ETAG_HEADER = "ETag"
+
+
+def weak_etag(*parts) -> str:
+    """Weak validator of a representation, from the values it depends on"""
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=8).hexdigest()
+    return f'W/"{digest}"'
+
+
+def if_none_match(request: Request, etag: str) -> bool:
+    """Whether the client already has the representation with `etag`"""
+    header = request.headers.get("If-None-Match")
+    if header is None:
+        return False
+    if header.strip() == "*":
+        return True
+    # weak comparison: the W/ prefix is ignored
+    tags = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag.removeprefix("W/") in tags
+
+
+def check_etag(
+    request: Request, response: Response, etag: str, vary: str | None = None
+) -> Response | None:
+    """
+    Set the ETag of the response (and `Vary`, for the request headers the
+    representation depends on).
+    If the client has it already, return a 304 response to be sent instead.
+    """
+    headers = {ETAG_HEADER: etag, "Cache-Control": "no-cache"}
+    if vary is not None:
+        headers["Vary"] = vary
+    if if_none_match(request, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import AsyncIterator
+
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from . import metrics
+from .cache import cache_key, response_cache
+from .context import assembler
+from .database import database as db
+from .database.writer import writer
+from .live import hub
+from .llm import ROLES, LLMMessages, Ticket, scheduler
+from .settings import cache_settings, context_settings
+from .tracing import span
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class Reply:
+    """
+    Chunks of a generated reply.
+    Each chunk is stored once and shared between what is sent to the client
+    and what is persisted; the full text is joined only once, when needed.
+    """
+
+    def __init__(self):
+        self.chunks: list[str] = []
+        self._text: str | None = None
+
+    def append(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self._text = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = "".join(self.chunks)
+        return self._text
+
+
+async def persist_turn(
+    chat_id: uuid.UUID, message: str, response: str
+) -> list[db.ChatMessage]:
+    """Persist a prompt and its response, returning the written messages"""
+    messages = [
+        db.ChatMessage(chat_id=chat_id, role=db.ChatMessageRole.HUMAN),
+        db.ChatMessage(chat_id=chat_id, role=db.ChatMessageRole.AI),
+    ]
+    for chat_message, content in zip(messages, (message, response)):
+        # large contents are compressed, and their preview is published
+        chat_message.set_content(content)
+    # no db session is held while generating: the turn is handed over
+    # to the background writer, and we only wait for it to be committed
+    logger.info("Queueing messages for the db writer")
+    turn = await writer.put(messages)
+    # a cancelled caller must not cancel the turn: it is written anyway
+    await asyncio.shield(turn.done)
+    update = {
+        "type": "messages",
+        "messages": [message.model_dump(mode="json") for message in messages],
+    }
+    hub.publish(chat_id, update)
+    return messages
+
+
+async def prompt(chat_id: uuid.UUID, message: str) -> LLMMessages:
+    """Messages sent to the LLM: the recent history (if enabled) and the prompt"""
+    if context_settings.ENABLED:
+        return await assembler.assemble(chat_id, message)
+    return [{"role": ROLES[db.ChatMessageRole.HUMAN], "content": message}]
+
+
+async def llm_reply(ticket: Ticket, message: str) -> AsyncIterator[str]:
+    # the history is assembled once the slot is acquired (see `Scheduler.generate`)
+    async for chunk in scheduler.generate(
+        ticket, lambda: prompt(ticket.chat_id, message)
+    ):
+        yield chunk
+
+
+async def recent_history(chat_id: uuid.UUID, limit: int) -> list[db.ChatMessage]:
+    """The last `limit` messages of a chat, from the oldest"""
+    if limit <= 0:
+        return []
+    async with AsyncSession(db.read_engine) as session:
+        messages = await session.exec(
+            select(db.ChatMessage)
+            .where(db.ChatMessage.chat_id == chat_id)
+            .order_by(db.ChatMessage.create_time.desc(), db.ChatMessage.id.desc())
+            .limit(limit)
+        )
+        return list(reversed(messages.all()))
+
+
+async def generate(ticket: Ticket, message: str) -> AsyncIterator[str]:
+    """
+    Stream the reply to `message`, once the scheduler has a free slot.
+    With the response cache enabled, the reply may come from the cache or from
+    an identical generation in progress, and the ticket is not used.
+    """
+    with span("generate", chat_id=str(ticket.chat_id)):
+        start = time.perf_counter()
+        first = None
+        count = 0
+        async for chunk in _generate(ticket, message):
+            if first is None:
+                first = time.perf_counter()
+                metrics.time_to_first_token.observe(first - start)
+            count += 1
+            yield chunk
+        metrics.tokens.inc(count)
+        if count > 1:
+            metrics.tokens_per_second.observe(
+                (count - 1) / (time.perf_counter() - first)
+            )
+
+
+async def _generate(ticket: Ticket, message: str) -> AsyncIterator[str]:
+    if not cache_settings.ENABLED:
+        async for chunk in llm_reply(ticket, message):
+            yield chunk
+        return
+
+    history = await recent_history(ticket.chat_id, cache_settings.HISTORY_WINDOW)
+    # truncated messages are keyed by the hash of their full content
+    key = cache_key(
+        message,
+        [
+            (ROLES[m.role], m.content_hash if m.truncated else m.content)
+            for m in history
+        ],
+    )
+    used = False
+
+    def new_generation() -> AsyncIterator[str]:
+        nonlocal used
+        used = True
+        # the history is only assembled on a cache miss
+        return llm_reply(ticket, message)
+
+    try:
+        async for chunk in response_cache.stream(key, new_generation):
+            yield chunk
+    finally:
+        if not used:
+            ticket.discard()
+
+
+async def get_response(
+    message: str,
+    chat_id: uuid.UUID,
+    reply: Reply | None = None,
+    ticket: Ticket | None = None,
+) -> AsyncIterator[str]:
+    """Generate the response to `message`, then persist both"""
+    reply = Reply() if reply is None else reply
+    ticket = scheduler.reserve(chat_id) if ticket is None else ticket
+    try:
+        with span("get_response", chat_id=str(chat_id)):
+            async for chunk in generate(ticket, message):
+                reply.append(chunk)
+                yield chunk
+            await persist_turn(chat_id, message, reply.text)
+    finally:
+        # cancelled or failed before the generation started
+        ticket.discard()
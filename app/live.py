@@ -0,0 +1,191 @@
+"""
+Live updates of chats, pushed to WebSocket viewers (`/chats/{chat_id}/ws`).
+
+Updates are JSON objects with a `type`:
+- `stream`: an event of a stream, as sent over SSE (`stream_id`, `id`,
+  `event`, `data`), so one generation is followed by every viewer
+- `messages`: messages written to the db
+- `message_updated` (`id`, `content`, `truncated`) and `message_deleted` (`id`)
+- `messages_updated` (`ids`, `content`, `truncated`) and `messages_deleted`
+  (`ids`), after batch operations; large contents are sent as a preview, as
+  in lists (see `app/database/content.py`)
+- `chat_updated` (`title`) and `chat_deleted`
+
+Each update is encoded once and queued for every viewer of the chat; a
+viewer whose buffer is full is disconnected rather than slowing the others
+down. With a shared broker, updates are relayed to the viewers on other workers.
+"""
+
+import asyncio
+import json
+import logging
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from . import metrics
+from .broker import broker, worker_id
+from .settings import stream_settings
+
+logger = logging.getLogger("uvicorn.error")
+
+# close code of viewers that fell behind ("try again later")
+SLOW_VIEWER = 1013
+
+
+def channel(chat_id: uuid.UUID) -> str:
+    return f"chat:{chat_id}"
+
+
+class Viewer:
+    """Updates waiting to be sent to a client; `None` ends them"""
+
+    def __init__(self, buffer: int):
+        self.queue: asyncio.Queue[str | None] = asyncio.Queue(buffer)
+        self.dropped = False
+
+    def put(self, message: str) -> bool:
+        """Queue an update; True if the buffer was full and the viewer is dropped"""
+        if self.dropped:
+            return False
+        try:
+            self.queue.put_nowait(message)
+            return False
+        except asyncio.QueueFull:
+            self.dropped = True
+            self.close()
+            return True
+
+    def close(self) -> None:
+        """Drop pending updates and end the stream of updates"""
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+    async def get(self) -> str | None:
+        return await self.queue.get()
+
+
+class ChatHub:
+    """Viewers of each chat, on this worker"""
+
+    def __init__(self, buffer: int = stream_settings.VIEWER_BUFFER):
+        self.buffer = buffer
+        self.viewers: dict[uuid.UUID, set[Viewer]] = {}
+        # with a shared broker: updates of other workers, per viewed chat
+        self.relays: dict[uuid.UUID, asyncio.Task] = {}
+        # updates waiting to be published on the broker
+        self.outbox: deque[tuple[str, str]] = deque()
+        self._sender: asyncio.Task | None = None
+        # stats
+        self.published = 0
+        self.dropped = 0
+
+    def publish(self, chat_id: uuid.UUID, update: dict) -> None:
+        """Send an update to the viewers of a chat, on every worker"""
+        viewers = self.viewers.get(chat_id)
+        if not viewers and not broker.shared:
+            return
+        message = json.dumps(update)
+        self.published += 1
+        if viewers:
+            self._deliver(chat_id, message)
+        if broker.shared:
+            self.outbox.append((channel(chat_id), f"{worker_id} {message}"))
+            if self._sender is None or self._sender.done():
+                self._sender = asyncio.create_task(self._send())
+
+    def _deliver(self, chat_id: uuid.UUID, message: str) -> None:
+        for viewer in self.viewers.get(chat_id, ()):
+            if viewer.put(message):
+                self.dropped += 1
+                metrics.viewers_dropped.inc()
+                logger.info(f"Dropped a slow viewer of chat {chat_id}")
+
+    async def _send(self) -> None:
+        """Publish queued updates; the commands of a batch are pipelined"""
+        while self.outbox:
+            batch = list(self.outbox)
+            self.outbox.clear()
+            try:
+                await asyncio.gather(
+                    *(broker.publish(name, message) for name, message in batch)
+                )
+            except Exception:
+                logger.exception("Could not relay chat updates to other workers")
+
+    async def _relay(self, chat_id: uuid.UUID, ready: asyncio.Event) -> None:
+        """Deliver the updates published by other workers"""
+        own = f"{worker_id} "
+        try:
+            async with broker.subscribe(channel(chat_id)) as subscription:
+                ready.set()
+                async for message in subscription:
+                    if not message.startswith(own):
+                        self._deliver(chat_id, message.split(" ", 1)[1])
+        except (ConnectionError, OSError) as e:
+            logger.warning(f"No updates of chat {chat_id} from other workers ({e})")
+        finally:
+            ready.set()
+            # the next viewer of the chat subscribes again
+            if self.relays.get(chat_id) is asyncio.current_task():
+                del self.relays[chat_id]
+
+    @asynccontextmanager
+    async def subscribe(self, chat_id: uuid.UUID) -> AsyncIterator[Viewer]:
+        viewer = Viewer(self.buffer)
+        viewers = self.viewers.setdefault(chat_id, set())
+        viewers.add(viewer)
+        try:
+            if broker.shared and chat_id not in self.relays:
+                ready = asyncio.Event()
+                self.relays[chat_id] = asyncio.create_task(self._relay(chat_id, ready))
+                await ready.wait()
+            yield viewer
+        finally:
+            viewers.discard(viewer)
+            if not viewers:
+                self.viewers.pop(chat_id, None)
+                if (relay := self.relays.pop(chat_id, None)) is not None:
+                    relay.cancel()
+
+    async def serve(self, websocket: WebSocket, chat_id: uuid.UUID) -> None:
+        """Send the updates of a chat until the client leaves or falls behind"""
+
+        async def receive() -> None:
+            # client messages are ignored, only the disconnection matters
+            while (await websocket.receive())["type"] != "websocket.disconnect":
+                pass
+            viewer.close()
+
+        async with self.subscribe(chat_id) as viewer:
+            receiver = asyncio.create_task(receive())
+            try:
+                while (message := await viewer.get()) is not None:
+                    await websocket.send_text(message)
+                if viewer.dropped:
+                    await websocket.close(
+                        SLOW_VIEWER, "Too slow: resync with /messages"
+                    )
+            except WebSocketDisconnect:
+                pass
+            finally:
+                receiver.cancel()
+
+    @property
+    def count(self) -> int:
+        return sum(len(viewers) for viewers in self.viewers.values())
+
+    def stats(self) -> dict:
+        return {
+            "chats": len(self.viewers),
+            "viewers": self.count,
+            "published": self.published,
+            "dropped": self.dropped,
+        }
+
+
+hub = ChatHub()
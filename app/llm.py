@@ -0,0 +1,299 @@
+import asyncio
+import json
+import logging
+import random
+import string
+import time
+import uuid
+from collections import deque
+from contextlib import aclosing
+from typing import AsyncIterator, Awaitable, Callable, Protocol
+
+import httpx
+
+from .database import database as db
+from .settings import llm_settings, mock_llm_settings
+
+logger = logging.getLogger("uvicorn.error")
+
+LETTERS = list(string.ascii_letters + string.digits)
+
+# OpenAI-style chat messages: [{"role": "user", "content": "..."}]
+LLMMessages = list[dict[str, str]]
+
+ROLES = {
+    db.ChatMessageRole.HUMAN: "user",
+    db.ChatMessageRole.AI: "assistant",
+    db.ChatMessageRole.SYSTEM: "system",
+}
+
+
+class LLMBackend(Protocol):
+    """Something that streams the reply to a conversation"""
+
+    def generate(self, messages: LLMMessages) -> AsyncIterator[str]: ...
+
+    async def aclose(self) -> None: ...
+
+
+class MockBackend:
+    """Random letters, with configurable latency"""
+
+    def __init__(self, settings=mock_llm_settings):
+        self.settings = settings
+
+    async def generate(self, messages: LLMMessages) -> AsyncIterator[str]:
+        settings = self.settings
+        await asyncio.sleep(settings.FIRST_CHUNK_DELAY)
+        for _ in range(random.randint(settings.MIN_CHUNKS, settings.MAX_CHUNKS)):
+            yield "".join(random.choices(LETTERS, k=settings.CHUNK_SIZE))
+            await asyncio.sleep(settings.CHUNK_DELAY)
+
+    async def aclose(self) -> None:
+        return
+
+
+class OpenAIBackend:
+    """
+    Any server exposing the OpenAI chat completions API
+    (vLLM, llama.cpp, Ollama, ...), through a pooled keep-alive client.
+    """
+
+    def __init__(self, base_url: str, model: str, api_key: str | None = None):
+        self.model = model
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            limits=httpx.Limits(
+                max_connections=llm_settings.MAX_CONNECTIONS,
+                max_keepalive_connections=llm_settings.MAX_CONNECTIONS,
+            ),
+            timeout=httpx.Timeout(llm_settings.REQUEST_TIMEOUT, connect=10),
+        )
+
+    async def generate(self, messages: LLMMessages) -> AsyncIterator[str]:
+        body = {"model": self.model, "messages": messages, "stream": True}
+        async with self.client.stream("POST", "/chat/completions", json=body) as r:
+            r.raise_for_status()
+            async for line in r.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                data = line.removeprefix("data:").strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or [{}]
+                if content := choices[0].get("delta", {}).get("content"):
+                    yield content
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+def create_backend() -> LLMBackend:
+    match llm_settings.BACKEND:
+        case "openai":
+            return OpenAIBackend(
+                base_url=llm_settings.BASE_URL,
+                model=llm_settings.MODEL,
+                api_key=llm_settings.API_KEY,
+            )
+        case _:
+            return MockBackend()
+
+
+class Overloaded(Exception):
+    """Too many generations waiting to be scheduled"""
+
+
+class Timings:
+    """Count, mean and percentiles of the most recent durations"""
+
+    def __init__(self, size: int = 1000):
+        self.count = 0
+        self.total = 0.0
+        self.recent: deque[float] = deque(maxlen=size)
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+
+    def stats(self) -> dict:
+        recent = sorted(self.recent)
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": recent[len(recent) // 2] if recent else 0.0,
+            "p95": recent[int(len(recent) * 0.95)] if recent else 0.0,
+            "max": recent[-1] if recent else 0.0,
+        }
+
+
+class Ticket:
+    """
+    A reserved place in the generation queue.
+    Reserving is synchronous, so requests can be rejected before responding;
+    the generation slot is acquired with `async with ticket`. A ticket that
+    may never be entered (the request failed or was cancelled before) must be
+    given back with `discard`.
+    """
+
+    def __init__(self, scheduler: "Scheduler", chat_id: uuid.UUID):
+        self.scheduler = scheduler
+        self.chat_id = chat_id
+        self.create_time = time.perf_counter()
+        self.entered = False
+        self._acquired: list[asyncio.Semaphore] = []
+        self._waiting = True
+        self._released = False
+
+    def _stop_waiting(self) -> None:
+        if self._waiting:
+            self._waiting = False
+            self.scheduler.waiting -= 1
+
+    async def __aenter__(self) -> "Ticket":
+        if self._released:
+            raise RuntimeError("The generation was cancelled before it started")
+        scheduler = self.scheduler
+        self.entered = True
+        try:
+            async with asyncio.timeout(llm_settings.QUEUE_TIMEOUT):
+                # one generation at a time per chat, then a global slot
+                for semaphore in (
+                    scheduler._chat_semaphore(self.chat_id),
+                    scheduler.slots,
+                ):
+                    await semaphore.acquire()
+                    self._acquired.append(semaphore)
+        except BaseException:
+            self._release()
+            raise
+        finally:
+            self._stop_waiting()
+        scheduler.queue_wait.add(time.perf_counter() - self.create_time)
+        scheduler.running += 1
+        self._start_time = time.perf_counter()
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        scheduler = self.scheduler
+        scheduler.running -= 1
+        scheduler.generation_time.add(time.perf_counter() - self._start_time)
+        self._release()
+
+    def discard(self) -> None:
+        """
+        Give back a place that was never used (e.g. the reply was cached, or
+        the request was cancelled before the generation started).
+        Does nothing once the ticket has been entered, which releases it.
+        """
+        if not self.entered:
+            self._release()
+
+    def _release(self) -> None:
+        if self._released:
+            return
+        self._released = True
+        self._stop_waiting()
+        for semaphore in reversed(self._acquired):
+            semaphore.release()
+        self._acquired = []
+        self.scheduler._forget_chat(self.chat_id)
+
+
+class Scheduler:
+    """
+    Limits concurrent generations, globally and per chat.
+    Requests wait in a bounded queue; when it is full, `Overloaded` is raised.
+    """
+
+    def __init__(
+        self,
+        backend: LLMBackend,
+        max_concurrency: int,
+        max_per_chat: int,
+        max_waiting: int,
+    ):
+        self.backend = backend
+        self.max_per_chat = max_per_chat
+        self.max_waiting = max_waiting
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self._chats: dict[uuid.UUID, tuple[asyncio.Semaphore, int]] = {}
+        self.waiting = 0
+        self.running = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.queue_wait = Timings()
+        self.generation_time = Timings()
+
+    def _chat_semaphore(self, chat_id: uuid.UUID) -> asyncio.Semaphore:
+        return self._chats[chat_id][0]
+
+    def _forget_chat(self, chat_id: uuid.UUID) -> None:
+        semaphore, users = self._chats[chat_id]
+        if users <= 1:
+            del self._chats[chat_id]
+        else:
+            self._chats[chat_id] = (semaphore, users - 1)
+
+    def reserve(self, chat_id: uuid.UUID) -> Ticket:
+        """Reserve a place in the queue, or raise `Overloaded`"""
+        if self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise Overloaded(f"{self.waiting} generations are already waiting")
+        semaphore, users = self._chats.get(
+            chat_id, (asyncio.Semaphore(self.max_per_chat), 0)
+        )
+        self._chats[chat_id] = (semaphore, users + 1)
+        self.waiting += 1
+        return Ticket(self, chat_id)
+
+    async def generate(
+        self, ticket: Ticket, prompt: Callable[[], Awaitable[LLMMessages]]
+    ) -> AsyncIterator[str]:
+        """
+        Wait for a slot, then build the messages with `prompt()` and stream the
+        reply within the request timeout. The messages are built with the slot
+        held, so that the ticket is released whatever happens to them.
+        The deadline is only enforced while waiting for `prompt()` and the
+        backend, so it never cancels the consumer between chunks.
+        """
+        async with ticket:
+            deadline = asyncio.get_running_loop().time() + llm_settings.REQUEST_TIMEOUT
+            messages = await self._before(deadline, prompt())
+            async with aclosing(self.backend.generate(messages)) as chunks:
+                while True:
+                    chunk = await self._before(deadline, anext(chunks, None))
+                    if chunk is None:
+                        break
+                    yield chunk
+
+    async def _before[T](self, deadline: float, awaitable: Awaitable[T]) -> T:
+        """Await within the deadline of a generation, counting timeouts"""
+        try:
+            async with asyncio.timeout_at(deadline):
+                return await awaitable
+        except TimeoutError:
+            self.timeouts += 1
+            raise
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self.backend).__name__,
+            "waiting": self.waiting,
+            "running": self.running,
+            "rejected": self.rejected,
+            "timeouts": self.timeouts,
+            "queue_wait": self.queue_wait.stats(),
+            "generation_time": self.generation_time.stats(),
+        }
+
+
+scheduler = Scheduler(
+    backend=create_backend(),
+    max_concurrency=llm_settings.MAX_CONCURRENCY,
+    max_per_chat=llm_settings.MAX_PER_CHAT,
+    max_waiting=llm_settings.MAX_WAITING,
+)
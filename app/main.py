@@ -1,13 +1,75 @@
-from fastapi import FastAPI
-from fastapi.responses import RedirectResponse
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
 import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, RedirectResponse
 
+from . import metrics, tracing
+from .broker import broker, start_local_server
+from .cache import response_cache
 from .chat import router as chat_router
+from .context import assembler
+from .database import database as db
+from .database.maintenance import maintenance
+from .database.writer import writer
+from .live import hub
+from .llm import Overloaded, scheduler
 from .message import router as message_router
+from .search import router as search_router
+from .settings import broker_settings, server_settings, telemetry_settings
+from .streams import streams
+
+logger = logging.getLogger("uvicorn.error")
+
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # create tables and bring existing dbs up to date
+    await db.init_db()
+    await writer.start()
+    maintenance.start()
+    # requests of other workers
+    listeners = []
+    if broker.shared:
+        listeners = [
+            asyncio.create_task(streams.listen()),
+            asyncio.create_task(assembler.listen()),
+        ]
+    yield
+    await maintenance.stop()
+    for listener in listeners:
+        listener.cancel()
+    await asyncio.gather(*listeners, return_exceptions=True)
+    # cancel running generations, then drain pending turns
+    await streams.shutdown()
+    await writer.stop()
+    await scheduler.backend.aclose()
+    await broker.aclose()
+    response_cache.close()
+    tracing.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+if telemetry_settings.METRICS:
+    app.add_middleware(metrics.MetricsMiddleware)
+    metrics.streams_in_flight.set_function(lambda: streams.stats()["running"])
+    metrics.generations_waiting.set_function(lambda: scheduler.waiting)
+    metrics.generations_running.set_function(lambda: scheduler.running)
+    metrics.writer_queue_depth.set_function(lambda: writer.depth)
+    metrics.viewers.set_function(lambda: hub.count)
 app.include_router(chat_router)
 app.include_router(message_router)
+app.include_router(search_router)
+
+
+@app.exception_handler(Overloaded)
+async def overloaded(request: Request, exc: Overloaded) -> JSONResponse:
+    return JSONResponse(
+        status_code=429, content={"detail": str(exc)}, headers={"Retry-After": "1"}
+    )
 
 
 @app.get("/", include_in_schema=False)
@@ -15,5 +77,49 @@ async def home() -> RedirectResponse:
     return RedirectResponse("/docs")
 
 
+@app.get("/metrics", tags=["status"], response_class=PlainTextResponse)
+async def get_metrics() -> PlainTextResponse:
+    """Metrics of this process, in the Prometheus text format"""
+    if not telemetry_settings.METRICS:
+        return PlainTextResponse("Metrics are disabled", status_code=404)
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+
+@app.get("/status", tags=["status"])
+async def status() -> dict:
+    """Background workers status"""
+    return {
+        "persistence": writer.stats(),
+        "streams": streams.stats(),
+        "llm": scheduler.stats(),
+        "cache": response_cache.stats(),
+        "context": assembler.stats(),
+        "live": hub.stats(),
+        "maintenance": maintenance.stats(),
+    }
+
+
 if __name__ == "__main__":
-    uvicorn.run(app, reload=True, reload_excludes=["streamlit/*"])
+    # workers are supervised by uvicorn: SIGHUP restarts them one at a time
+    # (graceful reload), SIGTTIN/SIGTTOU add or remove one
+    settings = server_settings
+    workers = 1 if settings.RELOAD else settings.WORKERS
+    if workers > 1 and db.engine.dialect.name == "sqlite":
+        logger.warning("SQLite allows a single writer: consider PostgreSQL")
+    if workers > 1:
+        # migrate once, rather than in every worker at the same time
+        asyncio.run(db.init_db())
+        asyncio.run(db.engine.dispose())
+    if workers > 1 and not broker_settings.URL:
+        # read by the workers, which import the settings again
+        os.environ["BROKER_URL"] = start_local_server(broker_settings.LOCAL_PORT)
+    uvicorn.run(
+        "app.main:app",
+        host=settings.HOST,
+        port=settings.PORT,
+        # reload is only supported with a single worker
+        workers=None if settings.RELOAD else settings.WORKERS,
+        reload=settings.RELOAD,
+        reload_excludes=["streamlit_ui/*", "gradio_ui/*"] if settings.RELOAD else None,
+        timeout_graceful_shutdown=settings.GRACEFUL_TIMEOUT,
+    )
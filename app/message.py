@@ -1,11 +1,24 @@
+import asyncio
 import logging
+import uuid
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import ColumnElement, Row, and_, delete, insert, literal, update
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
+from .context import assembler
 from .database import database as db
-from .schema import ChatMessageSchema
+from .database.content import iter_content, split
+from .etags import ETAG_HEADER, if_none_match
+from .live import hub
+from .schema import (
+    BatchResult,
+    ChatMessageSchema,
+    MessageBatchUpdate,
+    MessageSelection,
+)
 
 logger = logging.getLogger("uvicorn.error")
 
@@ -14,7 +27,7 @@ router = APIRouter(prefix="/messages", tags=["message"])
 
 @router.get("/{message_id}")
 async def get_message(
-    message_id: str, session: AsyncSession = Depends(db.get_session)
+    message_id: uuid.UUID, session: AsyncSession = Depends(db.get_read_session)
 ) -> db.ChatMessage:
     """Get single message in chat"""
     message = await session.exec(
@@ -24,24 +37,97 @@ async def get_message(
     return message
 
 
+@router.get("/{message_id}/content")
+async def get_message_content(
+    message_id: uuid.UUID,
+    request: Request,
+    session: AsyncSession = Depends(db.get_read_session),
+) -> StreamingResponse:
+    """
+    Full content of a message, as text streamed in chunks (lists only return
+    a preview of large messages, with `truncated` set).
+    The ETag is the SHA-256 of the content (`content_hash`).
+    """
+    message = await session.exec(
+        select(
+            db.ChatMessage.content,
+            db.ChatMessage.content_hash,
+            db.MessageBody.codec,
+            db.MessageBody.data,
+        )
+        .outerjoin(db.MessageBody, db.MessageBody.message_id == db.ChatMessage.id)
+        .where(db.ChatMessage.id == message_id)
+    )
+    message = message.one_or_none()
+    if message is None:
+        raise HTTPException(status_code=404, detail="Message not found")
+    headers = {"Cache-Control": "no-cache"}
+    if message.content_hash is not None:
+        # strong validator: the bytes only depend on the hash
+        headers[ETAG_HEADER] = etag = f'"{message.content_hash}"'
+        if if_none_match(request, etag):
+            return Response(status_code=304, headers=headers)
+    # decompressed chunk by chunk (in a thread): the full text is never in memory
+    return StreamingResponse(
+        iter_content(message.content, message.codec, message.data),
+        media_type="text/plain; charset=utf-8",
+        headers=headers,
+    )
+
+
+async def replace_bodies(
+    session: AsyncSession, condition: ColumnElement[bool], body: dict | None
+) -> None:
+    """Replace the stored full contents of the messages matching `condition`"""
+    ids = select(db.ChatMessage.id).where(condition)
+    await session.exec(
+        delete(db.MessageBody)
+        .where(db.MessageBody.message_id.in_(ids))
+        .execution_options(synchronize_session=False)
+    )
+    if body is not None:
+        await session.exec(
+            insert(db.MessageBody).from_select(
+                ["message_id", "codec", "data"],
+                ids.add_columns(
+                    literal(body["codec"]),
+                    literal(body["data"], db.MessageBody.data.type),
+                ),
+            )
+        )
+
+
 @router.patch("/{message_id}")
 async def update_message(
-    message_id: str, content: str, session: AsyncSession = Depends(db.get_session)
+    message_id: uuid.UUID, content: str, session: AsyncSession = Depends(db.get_session)
 ) -> ChatMessageSchema:
     """Update message in chat"""
     message = await session.exec(
         select(db.ChatMessage).where(db.ChatMessage.id == message_id)
     )
     message = message.one()
-    message.content = content
+    columns, body = split(content)
+    await replace_bodies(session, db.ChatMessage.id == message_id, body)
+    message.sqlmodel_update(columns)
     session.add(message)
+    await session.flush()
+    chat_id = message.chat_id
+    await session.exec(db.update_chat_summaries({chat_id}))
     await session.commit()
+    await assembler.invalidate(chat_id)
+    update = {
+        "type": "message_updated",
+        "id": str(message_id),
+        "content": columns["content"],
+        "truncated": columns["truncated"],
+    }
+    hub.publish(chat_id, update)
     return ChatMessageSchema(content=content)
 
 
 @router.delete("/{message_id}")
 async def delete_message(
-    message_id: str, session: AsyncSession = Depends(db.get_session)
+    message_id: uuid.UUID, session: AsyncSession = Depends(db.get_session)
 ):
     """Get single message in chat"""
     message = await session.exec(
@@ -49,5 +135,99 @@ async def delete_message(
     )
     message = message.one()
     await session.delete(message)
+    await session.flush()
+    chat_id = message.chat_id
+    await session.exec(db.update_chat_summaries({chat_id}))
     await session.commit()
+    await assembler.invalidate(chat_id)
+    hub.publish(chat_id, {"type": "message_deleted", "id": str(message_id)})
     return
+
+
+def selected(selection: MessageSelection) -> ColumnElement[bool]:
+    """Filter on the messages of a selection"""
+    conditions = []
+    if selection.ids is not None:
+        conditions.append(db.ChatMessage.id.in_(selection.ids))
+    if selection.chat_id is not None:
+        conditions.append(db.ChatMessage.chat_id == selection.chat_id)
+    if selection.since is not None:
+        conditions.append(db.ChatMessage.create_time >= selection.since)
+    if selection.until is not None:
+        conditions.append(db.ChatMessage.create_time < selection.until)
+    return and_(*conditions)
+
+
+def by_chat(rows: list[Row]) -> dict[uuid.UUID, list[str]]:
+    """Ids of the affected messages, from (id, chat_id) rows"""
+    chats = {}
+    for message_id, chat_id in rows:
+        chats.setdefault(chat_id, []).append(str(message_id))
+    return chats
+
+
+async def apply(session: AsyncSession, statement) -> dict[uuid.UUID, list[str]]:
+    """
+    Run a delete or update of messages, refresh the summaries of their chats
+    and commit: two statements in one transaction, whatever the number of rows
+    """
+    rows = await session.exec(
+        statement.returning(db.ChatMessage.id, db.ChatMessage.chat_id)
+    )
+    chats = by_chat(rows.all())
+    if chats:
+        await session.exec(db.update_chat_summaries(set(chats)))
+    await session.commit()
+    await asyncio.gather(*(assembler.invalidate(chat_id) for chat_id in chats))
+    return chats
+
+
+async def delete_messages_where(
+    session: AsyncSession, condition: ColumnElement[bool]
+) -> BatchResult:
+    statement = (
+        delete(db.ChatMessage)
+        .where(condition)
+        .execution_options(synchronize_session=False)
+    )
+    chats = await apply(session, statement)
+    for chat_id, ids in chats.items():
+        hub.publish(chat_id, {"type": "messages_deleted", "ids": ids})
+    return BatchResult(chats=len(chats), messages=sum(map(len, chats.values())))
+
+
+@router.post("/delete")
+async def delete_messages(
+    selection: MessageSelection, session: AsyncSession = Depends(db.get_session)
+) -> BatchResult:
+    """
+    Delete many messages at once: by id and/or chat, optionally created
+    within `[since, until)`. Returns the number of deleted messages.
+    """
+    return await delete_messages_where(session, selected(selection))
+
+
+@router.patch("")
+async def update_messages(
+    batch: MessageBatchUpdate, session: AsyncSession = Depends(db.get_session)
+) -> BatchResult:
+    """Set the content of many messages at once (selected as for `/delete`)"""
+    # a large content is compressed once, and stored for each message
+    columns, body = split(batch.content)
+    await replace_bodies(session, selected(batch), body)
+    statement = (
+        update(db.ChatMessage)
+        .where(selected(batch))
+        .values(columns)
+        .execution_options(synchronize_session=False)
+    )
+    chats = await apply(session, statement)
+    for chat_id, ids in chats.items():
+        update_ = {
+            "type": "messages_updated",
+            "ids": ids,
+            "content": columns["content"],
+            "truncated": columns["truncated"],
+        }
+        hub.publish(chat_id, update_)
+    return BatchResult(chats=len(chats), messages=sum(map(len, chats.values())))
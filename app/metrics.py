@@ -0,0 +1,253 @@
+"""
+Prometheus metrics, served at /metrics in the text exposition format.
+Metrics are kept per process: with several workers, each one is scraped
+separately. Recording is a dict lookup and a few additions, cheap enough
+to stay on in production (see `benchmarks/telemetry_overhead.py`).
+"""
+
+import time
+from bisect import bisect_left
+from typing import Callable
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from . import tracing
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# seconds
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+registry: list["Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        self.values: dict[tuple, float] = {}
+        registry.append(self)
+
+    def samples(self) -> list[str]:
+        return [
+            f"{self.name}{_labels(self.label_names, labels)} {value}"
+            for labels, value in self.values.items()
+        ]
+
+    def render(self) -> list[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ] + self.samples()
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, labels: tuple = ()) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self.function: Callable[[], float] | None = None
+
+    def set(self, value: float, labels: tuple = ()) -> None:
+        self.values[labels] = value
+
+    def inc(self, amount: float = 1, labels: tuple = ()) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, labels: tuple = ()) -> None:
+        self.inc(-amount, labels)
+
+    def set_function(self, function: Callable[[], float]) -> None:
+        """Read the value when scraped (e.g. a queue depth)"""
+        self.function = function
+
+    def samples(self) -> list[str]:
+        if self.function is not None:
+            return [f"{self.name} {self.function()}"]
+        return super().samples()
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        # labels -> count per bucket (the last one is +Inf), then the sum
+        self.values: dict[tuple, list[float]] = {}
+
+    def observe(self, value: float, labels: tuple = ()) -> None:
+        state = self.values.get(labels)
+        if state is None:
+            state = self.values[labels] = [0] * (len(self.buckets) + 2)
+        state[bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def samples(self) -> list[str]:
+        lines = []
+        for labels, state in self.values.items():
+            count = 0
+            for bound, bucket in zip((*self.buckets, "+Inf"), state):
+                count += bucket
+                le = _labels(self.label_names, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{le} {count}")
+            label_text = _labels(self.label_names, labels)
+            lines.append(f"{self.name}_sum{label_text} {state[-1]}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+def render() -> str:
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+# requests
+request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Time to send the full response (including streamed bodies)",
+    ("method", "route", "status"),
+)
+requests_in_flight = Gauge("http_requests_in_flight", "Requests being served")
+
+# generation
+streams_in_flight = Gauge("chat_streams_in_flight", "Streams still generating")
+time_to_first_token = Histogram(
+    "llm_time_to_first_token_seconds",
+    "Time from the request to the first chunk, including the queue wait",
+)
+tokens = Counter("llm_tokens_total", "Chunks generated (or replayed from the cache)")
+tokens_per_second = Histogram(
+    "llm_tokens_per_second",
+    "Chunk rate of each generation, after the first chunk",
+    buckets=RATE_BUCKETS,
+)
+generations_waiting = Gauge("llm_generations_waiting", "Generations waiting a slot")
+generations_running = Gauge("llm_generations_running", "Generations running")
+viewers = Gauge("chat_viewers", "WebSocket viewers of chats")
+viewers_dropped = Counter(
+    "chat_viewers_dropped_total", "Viewers disconnected for falling behind"
+)
+
+# db
+session_wait = Histogram(
+    "db_session_wait_seconds", "Time to get a connection for a session", ("pool",)
+)
+commit_duration = Histogram(
+    "db_commit_duration_seconds", "Time to flush and commit a session"
+)
+chats_archived = Counter("db_chats_archived_total", "Chats moved to the archive")
+archived_bytes = Counter(
+    "db_archived_bytes_total",
+    "Size of the archived messages, before and after compression",
+    ("kind",),
+)
+restore_duration = Histogram(
+    "db_restore_duration_seconds", "Time to restore the messages of an archived chat"
+)
+reclaimed_bytes = Counter(
+    "db_reclaimed_bytes_total", "Free pages released to the filesystem, in bytes"
+)
+writer_queue_depth = Gauge("db_writer_queue_depth", "Turns waiting to be written")
+
+
+class MetricsMiddleware:
+    """
+    Records the latency of every request, labelled by route template.
+    Plain ASGI (not `BaseHTTPMiddleware`), so streamed bodies are not buffered.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            requests_in_flight.dec()
+            # set by the router, unmatched paths are grouped to bound cardinality
+            route = scope.get("route")
+            request_duration.observe(
+                time.perf_counter() - start,
+                (scope["method"], route.path if route else "unmatched", status),
+            )
+
+
+def instrument_sessions() -> None:
+    """Time (and trace) the flush and commit of every session"""
+    tracer = tracing.tracer
+
+    @event.listens_for(Session, "before_commit")
+    def before_commit(session):
+        if tracer is not None:
+            session.info["commit_span"] = tracer.start_span("db.commit")
+        session.info["commit_start"] = time.perf_counter()
+
+    @event.listens_for(Session, "after_commit")
+    def after_commit(session):
+        start = session.info.pop("commit_start", None)
+        if start is not None:
+            commit_duration.observe(time.perf_counter() - start)
+        if (span := session.info.pop("commit_span", None)) is not None:
+            span.end()
+
+    @event.listens_for(Session, "after_rollback")
+    def after_rollback(session):
+        session.info.pop("commit_start", None)
+        if (span := session.info.pop("commit_span", None)) is not None:
+            span.set_attribute("db.rollback", True)
+            span.end()
@@ -0,0 +1,58 @@
+import uuid
+from datetime import datetime
+
+from fastapi import HTTPException, Response
+from sqlalchemy import ColumnElement, tuple_
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlmodel.sql.expression import SelectOfScalar
+
+from .database import database as db
+from .schema import Cursor, PaginationParameters
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def paginate(
+    query: SelectOfScalar, model: type[db.Base], pagination: PaginationParameters
+) -> SelectOfScalar:
+    """
+    Sort `query` from the newest to the oldest row and apply pagination.
+    With a cursor, rows are filtered on `(create_time, id)` (keyset pagination),
+    so the cost of a page does not depend on how deep it is.
+    """
+    query = query.order_by(model.create_time.desc(), model.id.desc())
+    if pagination.cursor is not None:
+        cursor = Cursor.decode(pagination.cursor)
+        query = query.where(
+            tuple_(model.create_time, model.id) < tuple_(cursor.create_time, cursor.id)
+        )
+    return query.offset(pagination.offset).limit(pagination.limit)
+
+
+def set_next_cursor(
+    response: Response, rows: list[db.Base], pagination: PaginationParameters
+) -> None:
+    """Add the cursor of the next page to the response headers, if any"""
+    if pagination.offset is not None or pagination.limit is None:
+        return
+    if len(rows) < pagination.limit:
+        return
+    last = rows[-1]
+    cursor = Cursor(create_time=last.create_time, id=last.id)
+    response.headers[NEXT_CURSOR_HEADER] = cursor.encode()
+
+
+async def newer_than(
+    session: AsyncSession, model: type[db.Base], since: uuid.UUID | datetime
+) -> ColumnElement[bool]:
+    """Filter on rows created after the row with id `since`, or after a timestamp"""
+    if isinstance(since, datetime):
+        return model.create_time > since
+    anchor = await session.exec(
+        select(model.create_time, model.id).where(model.id == since)
+    )
+    anchor = anchor.one_or_none()
+    if anchor is None:
+        raise HTTPException(status_code=404, detail=f"{model.__name__} not found")
+    return tuple_(model.create_time, model.id) > tuple_(*anchor)
@@ -1,15 +1,53 @@
-from pydantic import BaseModel, Field, field_validator
+import base64
+import uuid
+from datetime import datetime
+from enum import StrEnum, auto
+from typing import Self
+
+from pydantic import BaseModel, Field, field_validator, model_validator
+
+from .database import database as db
+
+
+class ChatInclude(StrEnum):
+    """Optional relationships to be returned with a chat"""
+
+    HISTORY = auto()
 
 
 class ChatMessageSchema(BaseModel):
     content: str
 
 
+class OpaqueCursor(BaseModel):
+    """Cursor sent to clients as an opaque string"""
+
+    def encode(self) -> str:
+        return base64.urlsafe_b64encode(self.model_dump_json().encode()).decode()
+
+    @classmethod
+    def decode(cls, value: str) -> Self:
+        try:
+            return cls.model_validate_json(base64.urlsafe_b64decode(value.encode()))
+        except ValueError as e:
+            raise ValueError("Invalid cursor") from e
+
+
+class Cursor(OpaqueCursor):
+    """Position of the last returned row, for keyset pagination"""
+
+    create_time: datetime
+    id: uuid.UUID
+
+
 class PaginationParameters(BaseModel):
     model_config = {"extra": "forbid"}
 
     offset: int | None = Field(None, ge=0)
     limit: int | None = Field(None, ge=0)
+    cursor: str | None = Field(
+        None, description="Opaque cursor returned in the `X-Next-Cursor` header"
+    )
 
     @field_validator("offset", "limit", mode="after")
     @classmethod
@@ -17,3 +55,93 @@ class PaginationParameters(BaseModel):
         if isinstance(value, int) and value < 1:
             value = None
         return value
+
+    @field_validator("cursor", mode="after")
+    @classmethod
+    def validate_cursor(cls, value: str | None) -> str | None:
+        if value:
+            Cursor.decode(value)
+        return value or None
+
+    @model_validator(mode="after")
+    def validate_mode(self) -> "PaginationParameters":
+        if self.offset is not None and self.cursor is not None:
+            raise ValueError("`offset` and `cursor` cannot be used together")
+        return self
+
+
+class ChatListParameters(PaginationParameters):
+    include: list[ChatInclude] = []
+
+
+class MessageListParameters(PaginationParameters):
+    since: uuid.UUID | datetime | None = Field(
+        None,
+        description="Only messages newer than this message id or timestamp",
+    )
+
+
+class MessageSelection(BaseModel):
+    """Messages selected by id and/or chat, optionally within a time range"""
+
+    model_config = {"extra": "forbid"}
+
+    ids: list[uuid.UUID] | None = Field(None, min_length=1, max_length=10_000)
+    chat_id: uuid.UUID | None = None
+    since: datetime | None = Field(None, description="Created at or after this time")
+    until: datetime | None = Field(None, description="Created before this time")
+
+    @model_validator(mode="after")
+    def validate_selection(self) -> "MessageSelection":
+        if self.ids is None and self.chat_id is None:
+            raise ValueError("Select messages by `ids`, `chat_id` or both")
+        return self
+
+
+class MessageBatchUpdate(MessageSelection):
+    content: str
+
+
+class BatchResult(BaseModel):
+    """Rows affected by a batch operation"""
+
+    # chats deleted, or whose messages were changed
+    chats: int = 0
+    messages: int = 0
+
+
+class SearchCursor(OpaqueCursor):
+    """Position of the last returned search result"""
+
+    rank: float
+    rowid: int
+
+
+class SearchParameters(BaseModel):
+    model_config = {"extra": "forbid"}
+
+    q: str = Field(min_length=1, description="Words to search for")
+    chat_id: uuid.UUID | None = Field(None, description="Only search in this chat")
+    limit: int = Field(20, ge=1, le=100)
+    cursor: str | None = Field(
+        None, description="Opaque cursor returned in the `X-Next-Cursor` header"
+    )
+
+    @field_validator("cursor", mode="after")
+    @classmethod
+    def validate_cursor(cls, value: str | None) -> str | None:
+        if value:
+            SearchCursor.decode(value)
+        return value or None
+
+
+class SearchResult(BaseModel):
+    message_id: uuid.UUID
+    chat_id: uuid.UUID
+    chat_title: str | None
+    role: db.ChatMessageRole
+    create_time: datetime
+    # matching terms are wrapped in `**`
+    snippet: str
+    # lower is better
+    rank: float
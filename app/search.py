@@ -0,0 +1,54 @@
+import logging
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .database import database as db
+from .database.search import search as search_messages
+from .pagination import NEXT_CURSOR_HEADER
+from .schema import SearchCursor, SearchParameters, SearchResult
+
+logger = logging.getLogger("uvicorn.error")
+
+router = APIRouter(prefix="/search", tags=["search"])
+
+
+@router.get("")
+async def search(
+    params: Annotated[SearchParameters, Query()],
+    response: Response,
+    session: AsyncSession = Depends(db.get_read_session),
+) -> list[SearchResult]:
+    """
+    Search messages containing all the words in `q`, from the best match.
+    Words ending with `*` match as prefixes (e.g. `pyth*`).
+    When there are more results, the `X-Next-Cursor` header holds the cursor
+    for the next page.
+    """
+    if db.read_engine.dialect.name != "sqlite":
+        raise HTTPException(status_code=501, detail="Search requires SQLite (FTS5)")
+    after = None
+    if params.cursor is not None:
+        cursor = SearchCursor.decode(params.cursor)
+        after = (cursor.rank, cursor.rowid)
+    rows = await session.exec(
+        search_messages(params.q, params.chat_id, after, params.limit)
+    )
+    rows = rows.all()
+    if len(rows) == params.limit:
+        last = rows[-1]
+        cursor = SearchCursor(rank=last.rank, rowid=last.rowid)
+        response.headers[NEXT_CURSOR_HEADER] = cursor.encode()
+    return [
+        SearchResult(
+            message_id=row.id,
+            chat_id=row.chat_id,
+            chat_title=row.title,
+            role=row.role,
+            create_time=row.create_time,
+            snippet=row.snippet,
+            rank=row.rank,
+        )
+        for row in rows
+    ]
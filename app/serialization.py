@@ -0,0 +1,77 @@
+"""
+Fast path of the list endpoints.
+
+Lists are selected as Core rows (only the columns that are returned, no ORM
+instances) and encoded by orjson in one pass, rather than validated and
+serialized by pydantic one object at a time. The JSON is the same as the
+response model's. With `Accept: application/x-ndjson`, rows are streamed one
+per line, encoded in batches, so large pages are never encoded at once.
+See `benchmarks/serialization.py`.
+"""
+
+import uuid
+from typing import Iterator, Sequence
+
+import orjson
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import Row
+from sqlmodel import SQLModel
+
+JSON = "application/json"
+NDJSON = "application/x-ndjson"
+# UTC times end with "Z", as with pydantic
+OPTIONS = orjson.OPT_UTC_Z
+# rows encoded per chunk of an NDJSON stream
+NDJSON_BATCH = 1_000
+
+
+def default(value):
+    """Types orjson does not encode natively"""
+    # asyncpg returns its own subclass of uuid.UUID
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError
+
+
+def columns(model: type[SQLModel]) -> list:
+    """Columns of the fields of a table model, in the order pydantic dumps them"""
+    return [getattr(model, name) for name in model.model_fields]
+
+
+def encode(rows: Sequence[Row]) -> bytes:
+    """JSON array of objects, one per row"""
+    if not rows:
+        return b"[]"
+    fields = rows[0]._fields
+    return orjson.dumps(
+        [dict(zip(fields, row)) for row in rows], default=default, option=OPTIONS
+    )
+
+
+def ndjson_lines(rows: Sequence[Row]) -> Iterator[bytes]:
+    fields = rows[0]._fields if rows else ()
+    newline = OPTIONS | orjson.OPT_APPEND_NEWLINE
+    for start in range(0, len(rows), NDJSON_BATCH):
+        yield b"".join(
+            orjson.dumps(dict(zip(fields, row)), default=default, option=newline)
+            for row in rows[start : start + NDJSON_BATCH]
+        )
+
+
+def media_type(request: Request) -> str:
+    """Media type of the rows sent in response to a request"""
+    return NDJSON if NDJSON in request.headers.get("Accept", "") else JSON
+
+
+def rows_response(
+    rows: Sequence[Row], request: Request, response: Response
+) -> Response:
+    """
+    Response with the rows, as JSON or NDJSON (if accepted by the client),
+    with the headers already set on `response` (ETag, next cursor)
+    """
+    headers = dict(response.headers)
+    if media_type(request) == NDJSON:
+        return StreamingResponse(ndjson_lines(rows), media_type=NDJSON, headers=headers)
+    return Response(encode(rows), media_type=JSON, headers=headers)
@@ -0,0 +1,393 @@
+import asyncio
+import json
+import logging
+import re
+import uuid
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+from fastapi import Request
+
+from .broker import broker, worker_id
+from .generation import Reply, generate, persist_turn
+from .live import hub
+from .llm import Ticket
+from .settings import stream_settings
+
+logger = logging.getLogger("uvicorn.error")
+
+LINE_ENDINGS = re.compile(r"\r\n|\r|\n")
+
+
+@dataclass(frozen=True)
+class Event:
+    """Server-sent event; `id` is the position of the event in its stream"""
+
+    id: int
+    data: str
+    event: str | None = None
+
+    def encode(self) -> bytes:
+        lines = [f"id: {self.id}"]
+        if self.event is not None:
+            lines.append(f"event: {self.event}")
+        # multi-line data is split over several `data:` fields, on every line
+        # ending of SSE (a trailing one gives an empty last field)
+        lines += [f"data: {line}" for line in LINE_ENDINGS.split(self.data)]
+        return ("\n".join(lines) + "\n\n").encode()
+
+    def dumps(self) -> str:
+        return json.dumps([self.id, self.data, self.event])
+
+    @classmethod
+    def loads(cls, value: str) -> "Event":
+        return cls(*json.loads(value))
+
+
+HEARTBEAT = b": heartbeat\n\n"
+FINAL_EVENTS = {"done", "cancelled", "error"}
+# attach, detach and cancel requests for streams running on another worker
+CONTROL_CHANNEL = "streams:control"
+# with a shared broker, a stream whose worker died expires after this
+ORPHAN_TTL = 300
+
+
+def stream_key(stream_id: uuid.UUID) -> str:
+    """Broker list of a stream: its metadata, then its events"""
+    return f"stream:{stream_id}"
+
+
+class Stream:
+    """
+    Generation of a reply, running in the background.
+    Events are kept in a replay buffer, so clients can (re)connect at any time
+    and receive everything after the last event they have seen.
+    """
+
+    def __init__(
+        self,
+        chat_id: uuid.UUID,
+        message: str,
+        ticket: Ticket,
+        persisted_ids: bool = False,
+    ):
+        self.id = uuid.uuid4()
+        self.chat_id = chat_id
+        self.message = message
+        self.ticket = ticket
+        self.persisted_ids = persisted_ids
+        self.events: list[Event] = []
+        self.finished = False
+        self.listeners = 0
+        self._condition = asyncio.Condition()
+        self._cancel_handle: asyncio.TimerHandle | None = None
+        self._notification: asyncio.Task | None = None
+        self.task = asyncio.create_task(self._run(), name=f"stream-{self.id}")
+        self.task.add_done_callback(self._done)
+
+    def _append(self, data: str, event: str | None) -> None:
+        self.events.append(Event(id=len(self.events), data=data, event=event))
+        # and to the WebSocket viewers of the chat
+        update = {
+            "type": "stream",
+            "stream_id": str(self.id),
+            "id": len(self.events) - 1,
+            "event": event or "message",
+            "data": data,
+        }
+        hub.publish(self.chat_id, update)
+
+    async def publish(self, data: str, event: str | None = None) -> None:
+        async with self._condition:
+            self._append(data, event)
+            self._condition.notify_all()
+
+    async def _finish(self, data: str, event: str) -> None:
+        async with self._condition:
+            self._append(data, event)
+            self.finished = True
+            self._condition.notify_all()
+
+    async def _run(self) -> None:
+        reply = Reply()
+        persisting = False
+        try:
+            await self.publish(str(self.id), event="start")
+            async for chunk in generate(self.ticket, self.message):
+                reply.append(chunk)
+                await self.publish(chunk)
+            persisting = True
+            human, ai = await persist_turn(self.chat_id, self.message, reply.text)
+            if self.persisted_ids:
+                ids = {"human": str(human.id), "ai": str(ai.id)}
+                await self.publish(json.dumps(ids), event="persisted")
+        except asyncio.CancelledError:
+            logger.info(f"Stream {self.id} cancelled")
+            partial = stream_settings.PARTIAL_REPLY == "persist" and reply.chunks
+            if partial and not persisting:
+                try:
+                    await persist_turn(self.chat_id, self.message, reply.text)
+                except Exception:
+                    logger.exception(
+                        f"Could not persist the partial reply of {self.id}"
+                    )
+            await self._finish("", event="cancelled")
+            raise
+        except Exception as e:
+            logger.exception(f"Stream {self.id} failed")
+            await self._finish(str(e), event="error")
+        else:
+            await self._finish("", event="done")
+        finally:
+            # cancelled or failed before the generation started
+            self.ticket.discard()
+
+    def _done(self, task: asyncio.Task) -> None:
+        # a task cancelled before its first step never runs `_run`, so it is
+        # finished here; followers (and the mirror) may be waiting already,
+        # and the condition can only be notified with its lock held
+        if not self.finished:
+            self.ticket.discard()
+            self._append("", event="cancelled")
+            self.finished = True
+            self._notification = asyncio.create_task(self._notify())
+
+    async def _notify(self) -> None:
+        async with self._condition:
+            self._condition.notify_all()
+
+    def cancel(self) -> None:
+        # once: a second cancellation would interrupt the partial reply handling
+        if not self.finished and not self.task.cancelling():
+            self.task.cancel()
+
+    def attach(self) -> None:
+        """Register a listener"""
+        self.listeners += 1
+        if self._cancel_handle is not None:
+            self._cancel_handle.cancel()
+            self._cancel_handle = None
+
+    def detach(self) -> None:
+        """Unregister a listener, cancelling the generation if nobody is left"""
+        self.listeners -= 1
+        if self.listeners > 0 or self.finished:
+            return
+        grace = stream_settings.DISCONNECT_GRACE
+        if grace > 0:
+            loop = asyncio.get_running_loop()
+            self._cancel_handle = loop.call_later(grace, self.cancel)
+        else:
+            self.cancel()
+
+    async def follow(
+        self, last_event_id: int | None = None, heartbeat: float | None = None
+    ) -> AsyncIterator[Event | None]:
+        """
+        Yield events after `last_event_id`, until the stream is finished.
+        `None` is yielded when no event was published for `heartbeat` seconds.
+        """
+        position = 0 if last_event_id is None else last_event_id + 1
+        while True:
+            while position < len(self.events):
+                yield self.events[position]
+                position += 1
+            if self.finished:
+                return
+            try:
+                async with self._condition:
+                    await asyncio.wait_for(
+                        self._condition.wait_for(
+                            lambda: self.finished or position < len(self.events)
+                        ),
+                        heartbeat,
+                    )
+            except TimeoutError:
+                yield None
+
+
+class RemoteStream:
+    """
+    A stream running on another worker, followed through the broker.
+    Listeners and cancellations are forwarded to the worker running it.
+    """
+
+    def __init__(self, manager: "StreamManager", id: uuid.UUID, chat_id: uuid.UUID):
+        self.manager = manager
+        self.id = id
+        self.chat_id = chat_id
+
+    def attach(self) -> None:
+        self.manager.control(self.id, "attach")
+
+    def detach(self) -> None:
+        self.manager.control(self.id, "detach")
+
+    def cancel(self) -> None:
+        self.manager.control(self.id, "cancel")
+
+    async def follow(
+        self, last_event_id: int | None = None, heartbeat: float | None = None
+    ) -> AsyncIterator[Event | None]:
+        """Same as `Stream.follow`"""
+        position = 0 if last_event_id is None else last_event_id + 1
+        key = stream_key(self.id)
+        # subscribed before reading, so that no notification is missed
+        async with broker.subscribe(key) as notifications:
+            while True:
+                # the first item is the metadata
+                for value in await broker.lrange(key, position + 1):
+                    event = Event.loads(value)
+                    yield event
+                    position += 1
+                    if event.event in FINAL_EVENTS:
+                        return
+                try:
+                    await notifications.get(heartbeat)
+                    notifications.clear()
+                except TimeoutError:
+                    if not await broker.lrange(key, 0, 0):
+                        yield Event(id=position, data="Stream lost", event="error")
+                        return
+                    yield None
+
+
+class StreamManager:
+    """
+    Registry of running and recently finished streams.
+    With a shared broker, the events of local streams are copied to it, so
+    that streams can be followed and cancelled from any worker.
+    """
+
+    def __init__(self):
+        self.streams: dict[uuid.UUID, Stream] = {}
+        self.mirrors: set[asyncio.Task] = set()
+        self._requests: set[asyncio.Task] = set()
+
+    def start(
+        self,
+        chat_id: uuid.UUID,
+        message: str,
+        ticket: Ticket,
+        persisted_ids: bool = False,
+    ) -> Stream:
+        stream = Stream(
+            chat_id=chat_id,
+            message=message,
+            ticket=ticket,
+            persisted_ids=persisted_ids,
+        )
+        self.streams[stream.id] = stream
+        stream.task.add_done_callback(lambda _: self._expire(stream))
+        if broker.shared:
+            mirror = asyncio.create_task(self._mirror(stream))
+            self.mirrors.add(mirror)
+            mirror.add_done_callback(self.mirrors.discard)
+        return stream
+
+    def get(self, stream_id: uuid.UUID) -> Stream | None:
+        """A stream of this worker"""
+        return self.streams.get(stream_id)
+
+    async def find(self, stream_id: uuid.UUID) -> Stream | RemoteStream | None:
+        """A stream of any worker"""
+        stream = self.streams.get(stream_id)
+        if stream is not None or not broker.shared:
+            return stream
+        metadata = await broker.lrange(stream_key(stream_id), 0, 0)
+        if not metadata:
+            return None
+        chat_id = uuid.UUID(json.loads(metadata[0])["chat_id"])
+        return RemoteStream(self, stream_id, chat_id)
+
+    async def _mirror(self, stream: Stream) -> None:
+        """Copy the events of a stream to the broker, in batches"""
+        key = stream_key(stream.id)
+        metadata = json.dumps({"chat_id": str(stream.chat_id), "worker": worker_id})
+        try:
+            await broker.rpush(key, metadata, ttl=ORPHAN_TTL)
+            position = 0
+            while True:
+                async with stream._condition:
+                    await stream._condition.wait_for(
+                        lambda: position < len(stream.events)
+                    )
+                # events published while the previous batch was written
+                batch = stream.events[position:]
+                position += len(batch)
+                finished = stream.finished and position == len(stream.events)
+                ttl = stream_settings.REPLAY_TTL if finished else ORPHAN_TTL
+                await broker.rpush(key, *(event.dumps() for event in batch), ttl=ttl)
+                await broker.publish(key, str(position))
+                if finished:
+                    return
+        except Exception:
+            logger.exception(f"Could not share stream {stream.id}")
+
+    def control(self, stream_id: uuid.UUID, action: str) -> None:
+        """Ask the worker running a stream to attach, detach or cancel"""
+        request = json.dumps({"stream": str(stream_id), "action": action})
+        task = asyncio.create_task(broker.publish(CONTROL_CHANNEL, request))
+        self._requests.add(task)
+        task.add_done_callback(self._requests.discard)
+
+    def _on_control(self, message: str) -> None:
+        request = json.loads(message)
+        stream = self.streams.get(uuid.UUID(request["stream"]))
+        if stream is None:
+            return
+        match request["action"]:
+            case "attach":
+                stream.attach()
+            case "detach":
+                stream.detach()
+            case "cancel":
+                stream.cancel()
+
+    async def listen(self) -> None:
+        """Handle the requests of other workers for the streams of this one"""
+        await broker.listen(CONTROL_CHANNEL, self._on_control)
+
+    def _expire(self, stream: Stream) -> None:
+        # keep finished streams around for a while, for late reconnections
+        loop = asyncio.get_running_loop()
+        loop.call_later(stream_settings.REPLAY_TTL, self.streams.pop, stream.id, None)
+
+    async def shutdown(self) -> None:
+        """Cancel running generations, waiting for partial replies to be handled"""
+        running = [s.task for s in self.streams.values() if not s.task.done()]
+        for task in running:
+            task.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+        # the final events, for followers on other workers
+        if self.mirrors:
+            await asyncio.wait(self.mirrors, timeout=5)
+
+    def stats(self) -> dict:
+        return {
+            "running": sum(not s.finished for s in self.streams.values()),
+            "buffered": len(self.streams),
+        }
+
+
+streams = StreamManager()
+
+
+async def sse(
+    request: Request, stream: Stream | RemoteStream, last_event_id: int | None = None
+) -> AsyncIterator[bytes]:
+    """
+    Send stream events to a client.
+    The listener must be attached before the response starts; it is detached
+    when the client disconnects or the stream is finished.
+    """
+    try:
+        async for event in stream.follow(
+            last_event_id, heartbeat=stream_settings.HEARTBEAT_INTERVAL
+        ):
+            if await request.is_disconnected():
+                logger.info(f"Client disconnected from stream {stream.id}")
+                break
+            yield HEARTBEAT if event is None else event.encode()
+    finally:
+        stream.detach()
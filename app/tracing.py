@@ -0,0 +1,89 @@
+"""
+Optional OpenTelemetry tracing.
+With `TELEMETRY_TRACES_FILE` set, spans are written to that file as JSON lines
+(requires `uv sync --extra telemetry`); otherwise `span` is a no-op.
+"""
+
+import logging
+import os
+from contextlib import nullcontext
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .settings import telemetry_settings
+
+logger = logging.getLogger("uvicorn.error")
+
+
+def create_tracer(settings=telemetry_settings):
+    if not settings.TRACES_FILE:
+        return None, None
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import (
+            BatchSpanProcessor,
+            ConsoleSpanExporter,
+        )
+        from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    except ImportError:
+        raise RuntimeError(
+            "TELEMETRY_TRACES_FILE requires OpenTelemetry: uv sync --extra telemetry"
+        ) from None
+
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": "python-chat-ui"}),
+        sampler=ParentBased(TraceIdRatioBased(settings.TRACES_SAMPLE_RATIO)),
+    )
+    exporter = ConsoleSpanExporter(
+        out=open(settings.TRACES_FILE, "a", encoding="utf-8"),
+        formatter=lambda span: span.to_json(indent=None) + os.linesep,
+    )
+    # spans are exported in a background thread, off the request path
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    logger.info(f"Writing traces to {settings.TRACES_FILE}")
+    return provider, provider.get_tracer("app")
+
+
+provider, tracer = create_tracer()
+
+
+def span(name: str, **attributes):
+    """Context manager recording a span (and making it current), if tracing is on"""
+    if tracer is None:
+        return nullcontext()
+    return tracer.start_as_current_span(name, attributes=attributes)
+
+
+def trace_engine(engine: AsyncEngine) -> None:
+    """
+    A span for every SQL statement.
+    Statement events cost a few percent per request, so they are only
+    registered with tracing on.
+    """
+    system = engine.dialect.name
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, many):
+        conn.info["span"] = tracer.start_span(
+            "db.query", attributes={"db.system": system, "db.statement": statement}
+        )
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, many):
+        if (span := conn.info.pop("span", None)) is not None:
+            span.end()
+
+    @event.listens_for(engine.sync_engine, "handle_error")
+    def handle_error(context):
+        conn = context.connection
+        if conn is not None and (span := conn.info.pop("span", None)) is not None:
+            span.record_exception(context.original_exception)
+            span.end()
+
+
+def shutdown() -> None:
+    """Export pending spans"""
+    if provider is not None:
+        provider.shutdown()
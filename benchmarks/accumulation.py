@@ -0,0 +1,101 @@
+"""
+Microbenchmark of reply accumulation for long generations.
+
+Compares the previous pipeline (`response += chunk` while streaming, then
+joining all chunks again in the non-stream endpoint) with `Reply`, which
+stores each chunk once and joins them once. Reports time and peak memory
+(tracemalloc) for both the stream and the non-stream endpoint.
+
+    python -m benchmarks.accumulation --tokens 100000
+"""
+
+import argparse
+import asyncio
+import random
+import string
+import time
+import tracemalloc
+
+from app.generation import Reply
+
+LETTERS = string.ascii_letters + string.digits
+
+
+async def llm(chunks: list[str]):
+    for chunk in chunks:
+        yield chunk
+
+
+async def legacy_response(chunks: list[str], persisted: list[str]):
+    response = ""
+    async for chunk in llm(chunks):
+        response += chunk
+        yield chunk
+    persisted.append(response)
+
+
+async def reply_response(chunks: list[str], persisted: list[str], reply: Reply):
+    async for chunk in llm(chunks):
+        reply.append(chunk)
+        yield chunk
+    persisted.append(reply.text)
+
+
+async def legacy_stream(chunks: list[str]):
+    persisted = []
+    # starlette encodes each str chunk once, while sending it
+    async for chunk in legacy_response(chunks, persisted):
+        chunk.encode()
+
+
+async def legacy_chat(chunks: list[str]):
+    persisted = []
+    "".join([chunk async for chunk in legacy_response(chunks, persisted)])
+
+
+async def reply_stream(chunks: list[str]):
+    persisted = []
+    async for chunk in reply_response(chunks, persisted, Reply()):
+        chunk.encode()
+
+
+async def reply_chat(chunks: list[str]):
+    persisted = []
+    reply = Reply()
+    async for _ in reply_response(chunks, persisted, reply):
+        pass
+    reply.text
+
+
+def measure(func, chunks: list[str]) -> tuple[float, float]:
+    """Run `func` returning (time in ms, peak memory in MiB)"""
+    # tracing slows down allocations, so time and memory are measured separately
+    start = time.perf_counter()
+    asyncio.run(func(chunks))
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    asyncio.run(func(chunks))
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed * 1000, peak / 2**20
+
+
+def main(tokens: int, chunk_size: int):
+    chunks = ["".join(random.choices(LETTERS, k=chunk_size)) for _ in range(tokens)]
+    print(f"{'pipeline':<16} {'time (ms)':>10} {'peak (MiB)':>11}")
+    for name, func in {
+        "legacy stream": legacy_stream,
+        "reply stream": reply_stream,
+        "legacy chat": legacy_chat,
+        "reply chat": reply_chat,
+    }.items():
+        elapsed, peak = measure(func, chunks)
+        print(f"{name:<16} {elapsed:>10.1f} {peak:>11.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--tokens", type=int, default=100_000)
+    parser.add_argument("--chunk-size", type=int, default=5)
+    args = parser.parse_args()
+    main(args.tokens, args.chunk_size)
@@ -0,0 +1,131 @@
+"""
+Cost of preparing the history sent with a prompt, by conversation length.
+
+Seeds a temporary SQLite db with chats of increasing length, then times:
+- naive: load every message of the chat and count its tokens on each turn
+- cold: the assembler on a chat it has not cached yet (newest messages only)
+- warm: the assembler after a new turn was written (only the new messages)
+
+    python -m benchmarks.context --lengths 100 1000 10000 100000
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from pathlib import Path
+
+
+async def seed(n_messages: int) -> uuid.UUID:
+    from sqlalchemy import insert
+
+    from app.database import database as db
+    from app.database.bulk import generate_chats
+
+    chat = next(generate_chats(1, n_messages, words=40))
+    chat_id = uuid.uuid4()
+    start = db.utc_now()
+    rows = [
+        {
+            "id": uuid.uuid4(),
+            "chat_id": chat_id,
+            "role": db.ChatMessageRole(message["role"]),
+            "content": message["content"],
+            "create_time": start + timedelta(microseconds=i),
+            "update_time": start + timedelta(microseconds=i),
+        }
+        for i, message in enumerate(chat["messages"])
+    ]
+    async with db.engine.begin() as conn:
+        await conn.execute(insert(db.Chat), [{"id": chat_id, "title": "Benchmark"}])
+        for offset in range(0, len(rows), 50_000):
+            await conn.execute(insert(db.ChatMessage), rows[offset : offset + 50_000])
+    return chat_id
+
+
+async def add_turn(chat_id: uuid.UUID) -> None:
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
+    from app.database import database as db
+
+    async with AsyncSession(db.engine) as session:
+        session.add(db.ChatMessage(chat_id=chat_id, role="human", content="a prompt"))
+        session.add(db.ChatMessage(chat_id=chat_id, role="ai", content="a reply"))
+        await session.commit()
+
+
+async def naive(chat_id: uuid.UUID, prompt: str) -> list:
+    """Everything loaded and counted, then trimmed to the budget"""
+    from sqlmodel import select
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
+    from app.context import assembler, count_tokens
+    from app.database import database as db
+    from app.llm import ROLES
+
+    async with AsyncSession(db.read_engine) as session:
+        messages = await session.exec(
+            select(db.ChatMessage)
+            .where(db.ChatMessage.chat_id == chat_id)
+            .order_by(db.ChatMessage.create_time, db.ChatMessage.id)
+        )
+        messages = messages.all()
+    available = assembler.window_budget - count_tokens(prompt)
+    kept = []
+    for message in reversed(messages):
+        available -= count_tokens(message.content)
+        if available < 0:
+            break
+        kept.append({"role": ROLES[message.role], "content": message.content})
+    return kept[::-1] + [{"role": "user", "content": prompt}]
+
+
+async def timed(coroutine_function, repeat: int, setup=None) -> float:
+    """Median time in ms (setup is not timed)"""
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            await setup()
+        start = time.perf_counter()
+        await coroutine_function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+async def main(lengths: list[int], repeat: int):
+    from app.context import assembler
+    from app.database import database as db
+
+    await db.init_db()
+    print(f"{'messages':>9} {'naive (ms)':>11} {'cold (ms)':>10} {'warm (ms)':>10}")
+    for length in lengths:
+        chat_id = await seed(length)
+
+        async def cold():
+            await assembler.invalidate(chat_id)
+            await assembler.assemble(chat_id, "prompt")
+
+        naive_ms = await timed(lambda: naive(chat_id, "prompt"), repeat)
+        cold_ms = await timed(cold, repeat)
+        warm_ms = await timed(
+            lambda: assembler.assemble(chat_id, "prompt"),
+            repeat,
+            setup=lambda: add_turn(chat_id),
+        )
+        print(f"{length:>9} {naive_ms:>11.2f} {cold_ms:>10.2f} {warm_ms:>10.2f}")
+    await db.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[100, 1000, 10_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        # settings are read on import, so the app is only imported after this
+        os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{Path(tmp) / 'bench.db'}"
+        asyncio.run(main(args.lengths, args.repeat))
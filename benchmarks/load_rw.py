@@ -0,0 +1,147 @@
+"""
+Concurrent read/write load test for the chat API.
+
+Writers post prompts to /chats/{id}/stream while readers poll
+/chats/{id}/messages; per-endpoint latency percentiles are reported.
+With --compare the test runs twice in subprocesses, once with the legacy
+engine profile (rollback journal, full sync, statement echo) and once
+with the current settings.
+
+    python -m benchmarks.load_rw --compare --duration 20
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+LEGACY_PROFILE = {
+    "DATABASE_JOURNAL_MODE": "delete",
+    "DATABASE_SYNCHRONOUS": "full",
+    "DATABASE_ECHO": "true",
+    "DATABASE_READ_POOL": "false",
+}
+TUNED_PROFILE = {"DATABASE_READ_POOL": "true"}
+# keep generation short, so that the db is the bottleneck
+MOCK_LLM = {
+    "MOCK_LLM_FIRST_CHUNK_DELAY": "0.05",
+    "MOCK_LLM_CHUNK_DELAY": "0.005",
+    "MOCK_LLM_MIN_CHUNKS": "10",
+    "MOCK_LLM_MAX_CHUNKS": "20",
+}
+# arguments forwarded to the subprocesses
+ARGS = ("writers", "readers", "chats", "duration")
+
+
+def percentiles(timings: list[float]) -> dict[str, float]:
+    if len(timings) < 2:
+        return {"count": len(timings)}
+    q = statistics.quantiles(timings, n=100)
+    return {
+        "count": len(timings),
+        "p50": q[49] * 1000,
+        "p95": q[94] * 1000,
+        "p99": q[98] * 1000,
+    }
+
+
+async def writer_loop(client: httpx.AsyncClient, chat_id: str, stop: float, timings):
+    while time.perf_counter() < stop:
+        start = time.perf_counter()
+        async with client.stream(
+            "POST", f"/chats/{chat_id}/stream", json={"content": "hello"}
+        ) as r:
+            async for _ in r.aiter_bytes():
+                pass
+        timings.append(time.perf_counter() - start)
+
+
+async def reader_loop(client: httpx.AsyncClient, chat_id: str, stop: float, timings):
+    while time.perf_counter() < stop:
+        start = time.perf_counter()
+        r = await client.get(f"/chats/{chat_id}/messages", params={"limit": 50})
+        r.raise_for_status()
+        timings.append(time.perf_counter() - start)
+
+
+async def run(writers: int, readers: int, chats: int, duration: float) -> dict:
+    # imported here, so that settings are read from the environment set by --compare
+    from app.main import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+            chat_ids = [(await c.post("/chats")).json()["id"] for _ in range(chats)]
+            write_timings, read_timings = [], []
+            stop = time.perf_counter() + duration
+            await asyncio.gather(
+                *[
+                    writer_loop(c, chat_ids[i % chats], stop, write_timings)
+                    for i in range(writers)
+                ],
+                *[
+                    reader_loop(c, chat_ids[i % chats], stop, read_timings)
+                    for i in range(readers)
+                ],
+            )
+    return {
+        "stream": percentiles(write_timings),
+        "messages": percentiles(read_timings),
+    }
+
+
+def compare(args) -> None:
+    results = {}
+    for name, profile in {"legacy": LEGACY_PROFILE, "tuned": TUNED_PROFILE}.items():
+        with tempfile.TemporaryDirectory() as tmp:
+            output = Path(tmp) / "result.json"
+            env = os.environ | MOCK_LLM | profile
+            env["DATABASE_URL"] = f"sqlite+aiosqlite:///{Path(tmp) / 'load.db'}"
+            subprocess.run(
+                [sys.executable, "-m", "benchmarks.load_rw", "--output", str(output)]
+                + [f"--{k}={v}" for k, v in vars(args).items() if k in ARGS],
+                env=env,
+                check=True,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            results[name] = json.loads(output.read_text())
+
+    print(
+        f"{'endpoint':<10} {'profile':<8} {'count':>7} {'p50':>9} {'p95':>9} {'p99':>9}"
+    )
+    for endpoint in ("stream", "messages"):
+        for name, result in results.items():
+            r = result[endpoint]
+            print(
+                f"{endpoint:<10} {name:<8} {r['count']:>7} "
+                f"{r.get('p50', 0):>9.1f} {r.get('p95', 0):>9.1f} {r.get('p99', 0):>9.1f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--writers", type=int, default=50)
+    parser.add_argument("--readers", type=int, default=50)
+    parser.add_argument("--chats", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--compare", action="store_true")
+    parser.add_argument("--output", type=Path, help="write results as JSON")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(args)
+    else:
+        result = asyncio.run(run(args.writers, args.readers, args.chats, args.duration))
+        if args.output:
+            args.output.write_text(json.dumps(result))
+        else:
+            print(json.dumps(result, indent=2))
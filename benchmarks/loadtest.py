@@ -0,0 +1,584 @@
+"""
+Load test of the chat API with a mixed workload and a reproducible report.
+
+The app runs in-process (default) or in a uvicorn subprocess (--server),
+on a temporary SQLite db seeded with `app.database.bulk`, with the mock LLM
+configured by --first-chunk-delay / --token-rate. A pool of clients draws
+operations from a weighted mix (--mix) for --duration seconds:
+
+- stream: post a prompt to /chats/{id}/stream and read the events
+- history: read the last 50 messages of a chat
+- list: walk the first --pages pages of the chat list
+- edit: change the title of a chat
+- delete: delete the last message of a chat
+
+The report (JSON and Markdown) holds throughput and latency percentiles per
+operation, time to first byte / first token and inter-chunk latency of
+streams, and db write lock waits. With --baseline, a previous JSON report,
+regressions beyond --tolerance are listed and the exit status is 1.
+
+    python -m benchmarks.loadtest --duration 30 --output report
+    python -m benchmarks.loadtest --duration 30 --baseline report.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from urllib.parse import unquote
+
+import httpx
+
+OPERATIONS = ("stream", "history", "list", "edit", "delete")
+DEFAULT_MIX = "stream=2,history=4,list=2,edit=1,delete=1"
+# latency differences below this are noise, whatever the ratio
+NOISE_MS = 1.0
+
+
+def percentiles(timings: list[float]) -> dict[str, float]:
+    """Summary of timings (in seconds), in milliseconds"""
+    if not timings:
+        return {"count": 0}
+    summary = {
+        "count": len(timings),
+        "mean": statistics.fmean(timings) * 1000,
+        "max": max(timings) * 1000,
+    }
+    if len(timings) < 2:
+        return summary | {"p50": summary["mean"]}
+    q = statistics.quantiles(timings, n=100, method="inclusive")
+    return summary | {"p50": q[49] * 1000, "p95": q[94] * 1000, "p99": q[98] * 1000}
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation: {name!r}")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+class StreamingASGITransport(httpx.AsyncBaseTransport):
+    """
+    In-process transport streaming the response body while the app runs
+    (`httpx.ASGITransport` returns it only once the app is done, which would
+    hide the time to first token).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = b"".join([part async for part in request.stream])
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": request.method,
+            "headers": [(k.lower(), v) for k, v in request.headers.raw],
+            "scheme": request.url.scheme,
+            "path": unquote(request.url.path),
+            "raw_path": request.url.raw_path.split(b"?")[0],
+            "query_string": request.url.query,
+            "server": (request.url.host, request.url.port or 80),
+            "client": ("127.0.0.1", 123),
+            "root_path": "",
+        }
+        chunks: asyncio.Queue[bytes | None] = asyncio.Queue()
+        started = asyncio.get_running_loop().create_future()
+        disconnected = asyncio.Event()
+        request_sent = False
+
+        async def receive() -> dict:
+            nonlocal request_sent
+            if not request_sent:
+                request_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            await disconnected.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message: dict) -> None:
+            if message["type"] == "http.response.start":
+                started.set_result(message)
+            elif message["type"] == "http.response.body":
+                if message.get("body"):
+                    chunks.put_nowait(message["body"])
+                if not message.get("more_body", False):
+                    chunks.put_nowait(None)
+
+        async def run() -> None:
+            try:
+                await self.app(scope, receive, send)
+            except Exception as e:
+                if not started.done():
+                    started.set_exception(e)
+            finally:
+                chunks.put_nowait(None)
+
+        task = asyncio.create_task(run())
+        start = await started
+        return httpx.Response(
+            start["status"],
+            headers=start.get("headers", []),
+            stream=ASGIResponseStream(chunks, task, disconnected),
+        )
+
+
+class ASGIResponseStream(httpx.AsyncByteStream):
+    def __init__(self, chunks: asyncio.Queue, task: asyncio.Task, disconnected):
+        self.chunks = chunks
+        self.task = task
+        self.disconnected = disconnected
+
+    async def __aiter__(self):
+        while (chunk := await self.chunks.get()) is not None:
+            yield chunk
+
+    async def aclose(self) -> None:
+        self.disconnected.set()
+        await self.task
+
+
+class Results:
+    def __init__(self):
+        self.latency: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, dict[str, int]] = defaultdict(lambda: defaultdict(int))
+        self.ttfb: list[float] = []
+        self.ttft: list[float] = []
+        self.inter_chunk: list[float] = []
+        self.chunks = 0
+        self.write_lock: list[float] = []
+
+    def error(self, operation: str, reason: str) -> None:
+        self.errors[operation][reason] += 1
+
+
+class Client:
+    """One client of the pool, running operations until `stop`"""
+
+    def __init__(
+        self,
+        http: httpx.AsyncClient,
+        chat_ids: list[str],
+        weights: dict[str, float],
+        pages: int,
+        rng: random.Random,
+        results: Results,
+    ):
+        self.http = http
+        self.chat_ids = chat_ids
+        self.operations = list(weights)
+        self.weights = list(weights.values())
+        self.pages = pages
+        self.rng = rng
+        self.results = results
+
+    async def run(self, stop: float) -> None:
+        while time.perf_counter() < stop:
+            operation = self.rng.choices(self.operations, self.weights)[0]
+            chat_id = self.rng.choice(self.chat_ids)
+            try:
+                await getattr(self, operation)(chat_id)
+            except httpx.HTTPStatusError as e:
+                self.results.error(operation, str(e.response.status_code))
+            except (httpx.HTTPError, ValueError) as e:
+                self.results.error(operation, type(e).__name__)
+
+    async def timed(self, operation: str, request) -> httpx.Response:
+        start = time.perf_counter()
+        response = await request
+        response.raise_for_status()
+        self.results.latency[operation].append(time.perf_counter() - start)
+        return response
+
+    async def stream(self, chat_id: str) -> None:
+        results = self.results
+        prompt = f"prompt {self.rng.randrange(1_000_000)}"
+        start = time.perf_counter()
+        async with self.http.stream(
+            "POST", f"/chats/{chat_id}/stream", json={"content": prompt}
+        ) as r:
+            r.raise_for_status()
+            results.ttfb.append(time.perf_counter() - start)
+            event, last_chunk, outcome = None, None, None
+            async for line in r.aiter_lines():
+                if line.startswith("event:"):
+                    event = line.removeprefix("event:").strip()
+                elif line.startswith("data:") and event is None:
+                    now = time.perf_counter()
+                    if last_chunk is None:
+                        results.ttft.append(now - start)
+                    else:
+                        results.inter_chunk.append(now - last_chunk)
+                    last_chunk = now
+                    results.chunks += 1
+                elif not line and event is not None:
+                    if event in ("done", "cancelled", "error"):
+                        outcome = event
+                    event = None
+        if outcome != "done":
+            results.error("stream", outcome or "incomplete")
+            return
+        results.latency["stream"].append(time.perf_counter() - start)
+
+    async def history(self, chat_id: str) -> None:
+        await self.timed(
+            "history", self.http.get(f"/chats/{chat_id}/messages", params={"limit": 50})
+        )
+
+    async def list(self, chat_id: str) -> None:
+        params = {"limit": 20}
+        for _ in range(self.pages):
+            r = await self.timed("list", self.http.get("/chats", params=params))
+            cursor = r.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+            params["cursor"] = cursor
+
+    async def edit(self, chat_id: str) -> None:
+        title = f"Chat {self.rng.randrange(1_000_000)}"
+        await self.timed(
+            "edit", self.http.patch(f"/chats/{chat_id}", json={"title": title})
+        )
+
+    async def delete(self, chat_id: str) -> None:
+        r = await self.http.get(f"/chats/{chat_id}/messages", params={"limit": 1})
+        r.raise_for_status()
+        if messages := r.json():
+            await self.timed(
+                "delete", self.http.delete(f"/messages/{messages[0]['id']}")
+            )
+
+
+def mock_llm_env(args) -> dict[str, str]:
+    return {
+        "MOCK_LLM_FIRST_CHUNK_DELAY": str(args.first_chunk_delay),
+        "MOCK_LLM_CHUNK_DELAY": str(1 / args.token_rate),
+        "MOCK_LLM_MIN_CHUNKS": str(args.min_chunks),
+        "MOCK_LLM_MAX_CHUNKS": str(args.max_chunks),
+    }
+
+
+def watch_write_lock(engine, timings: list[float]) -> None:
+    """
+    Record the time of write statements: SQLite takes the write lock on the
+    first write of a transaction, so it includes the wait for other writers.
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine.sync_engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info["statement_start"] = time.perf_counter()
+
+    @event.listens_for(engine.sync_engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip()[:6].upper() in ("INSERT", "UPDATE", "DELETE"):
+            timings.append(time.perf_counter() - conn.info.pop("statement_start"))
+
+
+async def seed(chats: int, messages: int) -> list[str]:
+    """Fill the db with synthetic chats, returning their ids"""
+    from sqlalchemy import select
+
+    from app.database import database as db
+    from app.database.bulk import generate_chats, import_chats
+
+    await db.init_db()
+    await import_chats(generate_chats(chats, messages))
+    async with db.engine.connect() as conn:
+        chat_ids = (await conn.execute(select(db.Chat.id))).scalars().all()
+    return [str(chat_id) for chat_id in chat_ids]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+async def wait_ready(http: httpx.AsyncClient, process: subprocess.Popen) -> None:
+    for _ in range(200):
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode}")
+        try:
+            (await http.get("/status")).raise_for_status()
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.05)
+    raise RuntimeError("Server did not start")
+
+
+async def drive(http: httpx.AsyncClient, args, chat_ids, results) -> float:
+    weights = parse_mix(args.mix)
+    clients = [
+        Client(
+            http, chat_ids, weights, args.pages, random.Random(args.seed + i), results
+        )
+        for i in range(args.clients)
+    ]
+    start = time.perf_counter()
+    await asyncio.gather(*[client.run(start + args.duration) for client in clients])
+    return time.perf_counter() - start
+
+
+async def run(args) -> dict:
+    results = Results()
+    limits = httpx.Limits(max_connections=args.clients)
+    timeout = httpx.Timeout(60)
+    chat_ids = await seed(args.chats, args.messages)
+    if args.server:
+        from app.database import database as db
+
+        await db.engine.dispose()
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", f"--port={port}"]
+            + ["--log-level=warning"],
+            env=os.environ.copy(),
+        )
+        try:
+            async with httpx.AsyncClient(
+                base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=timeout
+            ) as http:
+                await wait_ready(http, process)
+                elapsed = await drive(http, args, chat_ids, results)
+                status = (await http.get("/status")).json()
+        finally:
+            process.terminate()
+            process.wait()
+    else:
+        from app.database import database as db
+        from app.main import app
+
+        watch_write_lock(db.engine, results.write_lock)
+        async with app.router.lifespan_context(app):
+            async with httpx.AsyncClient(
+                transport=StreamingASGITransport(app),
+                base_url="http://test",
+                limits=limits,
+                timeout=timeout,
+            ) as http:
+                elapsed = await drive(http, args, chat_ids, results)
+                status = (await http.get("/status")).json()
+    return report(args, results, elapsed, status)
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(args, results: Results, elapsed: float, status: dict) -> dict:
+    operations = {}
+    for operation in OPERATIONS:
+        latency = results.latency.get(operation, [])
+        errors = results.errors.get(operation, {})
+        if not latency and not errors:
+            continue
+        operations[operation] = {
+            "throughput": len(latency) / elapsed,
+            "errors": dict(errors),
+            "latency": percentiles(latency),
+        }
+    config = {
+        k: v for k, v in vars(args).items() if k not in ("output", "baseline")
+    } | mock_llm_env(args)
+    return {
+        "config": config,
+        "environment": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "elapsed": elapsed,
+        "throughput": sum(len(t) for t in results.latency.values()) / elapsed,
+        "operations": operations,
+        "stream": {
+            "ttfb": percentiles(results.ttfb),
+            "ttft": percentiles(results.ttft),
+            "inter_chunk": percentiles(results.inter_chunk),
+            "tokens_per_second": results.chunks / elapsed,
+        },
+        # only measured in-process
+        "db": {
+            "write_lock": percentiles(results.write_lock) if not args.server else None,
+            "persistence": status.get("persistence"),
+        },
+    }
+
+
+def metrics(report: dict) -> dict[str, tuple[float, bool]]:
+    """Compared metrics: name -> (value, higher is better)"""
+    values = {"throughput": (report["throughput"], True)}
+    for operation, result in report["operations"].items():
+        values[f"{operation} throughput"] = (result["throughput"], True)
+        for p in ("p50", "p95", "p99"):
+            if p in result["latency"]:
+                values[f"{operation} {p}"] = (result["latency"][p], False)
+    for name in ("ttfb", "ttft", "inter_chunk"):
+        for p in ("p50", "p95", "p99"):
+            if p in report["stream"][name]:
+                values[f"stream {name} {p}"] = (report["stream"][name][p], False)
+    return values
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[dict]:
+    rows = []
+    current = metrics(report)
+    for name, (before, higher_is_better) in metrics(baseline).items():
+        if name not in current:
+            continue
+        after = current[name][0]
+        change = (after - before) / before if before else 0.0
+        if higher_is_better:
+            regression = change < -tolerance
+        else:
+            regression = change > tolerance and after - before > NOISE_MS
+        rows.append(
+            {
+                "metric": name,
+                "baseline": before,
+                "current": after,
+                "change": change,
+                "regression": regression,
+            }
+        )
+    return rows
+
+
+def config_differences(report: dict, baseline: dict) -> list[str]:
+    """Settings of the baseline run that differ, making the comparison unfair"""
+    ignored = ("tolerance",)
+    config, before = report["config"], baseline["config"]
+    return [
+        f"{k}: {before.get(k)} -> {v}"
+        for k, v in config.items()
+        if k not in ignored and before.get(k) != v
+    ]
+
+
+def markdown(
+    report: dict, comparison: list[dict] | None, differences: list[str] = ()
+) -> str:
+    config, env = report["config"], report["environment"]
+    lines = [
+        "# Load test",
+        "",
+        f"Commit `{env['commit']}`, Python {env['python']}, {env['cpus']} CPUs, "
+        f"{'uvicorn' if config['server'] else 'in-process'}; "
+        f"{config['clients']} clients for {report['elapsed']:.1f}s, mix "
+        f"`{config['mix']}`, {config['chats']} chats x {config['messages']} messages.",
+        "",
+        f"Throughput: {report['throughput']:.1f} requests/s, "
+        f"{report['stream']['tokens_per_second']:.1f} tokens/s.",
+        "",
+        "| operation | req/s | errors | p50 (ms) | p95 (ms) | p99 (ms) | max (ms) |",
+        "|---|---:|---:|---:|---:|---:|---:|",
+    ]
+
+    def row(name: str, throughput: str, errors: str, latency: dict) -> str:
+        cells = [f"{latency.get(p, 0):.1f}" for p in ("p50", "p95", "p99", "max")]
+        return f"| {name} | {throughput} | {errors} | {' | '.join(cells)} |"
+
+    for operation, result in report["operations"].items():
+        errors = sum(result["errors"].values())
+        lines.append(
+            row(
+                operation, f"{result['throughput']:.1f}", str(errors), result["latency"]
+            )
+        )
+    for name in ("ttfb", "ttft", "inter_chunk"):
+        lines.append(row(f"stream {name}", "", "", report["stream"][name]))
+    if report["db"]["write_lock"] is not None:
+        lines.append(row("db write lock", "", "", report["db"]["write_lock"]))
+
+    if comparison is not None:
+        regressions = [r for r in comparison if r["regression"]]
+        lines += [
+            "",
+            "## Baseline comparison",
+            "",
+            f"{len(regressions)} regression(s) beyond "
+            f"{report['config']['tolerance']:.0%}.",
+            "",
+        ]
+        if differences:
+            lines += ["Settings differ from the baseline run:", ""]
+            lines += [f"- {difference}" for difference in differences]
+            lines.append("")
+        lines += [
+            "| metric | baseline | current | change | |",
+            "|---|---:|---:|---:|---|",
+        ]
+        for r in comparison:
+            lines.append(
+                f"| {r['metric']} | {r['baseline']:.1f} | {r['current']:.1f} "
+                f"| {r['change']:+.1%} | {'**regression**' if r['regression'] else ''} |"
+            )
+    return "\n".join(lines) + "\n"
+
+
+def main(args) -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        # settings are read on import, so the app is only imported after this
+        os.environ.update(mock_llm_env(args))
+        os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{Path(tmp) / 'load.db'}"
+        result = asyncio.run(run(args))
+
+    comparison, differences = None, []
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        comparison = compare(result, baseline, args.tolerance)
+        differences = config_differences(result, baseline)
+        result["comparison"] = comparison
+    summary = markdown(result, comparison, differences)
+    if args.output:
+        args.output.with_suffix(".json").write_text(json.dumps(result, indent=2))
+        args.output.with_suffix(".md").write_text(summary)
+    print(summary)
+    return 1 if comparison and any(r["regression"] for r in comparison) else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--server", action="store_true", help="run uvicorn")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="operation=weight,...")
+    parser.add_argument("--pages", type=int, default=3, help="per chat list walk")
+    parser.add_argument("--seed", type=int, default=0)
+    # seeded db
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=50, help="per chat")
+    # mock LLM
+    parser.add_argument("--first-chunk-delay", type=float, default=0.2)
+    parser.add_argument("--token-rate", type=float, default=50, help="chunks/s")
+    parser.add_argument("--min-chunks", type=int, default=10)
+    parser.add_argument("--max-chunks", type=int, default=30)
+    # report
+    parser.add_argument("--output", type=Path, help="write OUTPUT.json and .md")
+    parser.add_argument("--baseline", type=Path, help="previous JSON report")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    parse_mix(args.mix)
+    sys.exit(main(args))
@@ -0,0 +1,104 @@
+"""
+Compare offset and cursor (keyset) pagination of chat messages.
+
+Seeds a temporary SQLite db with a single chat holding N messages,
+then times the page query at increasing depths with both strategies.
+
+    python -m benchmarks.pagination --messages 1000000 --limit 100
+"""
+
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from pathlib import Path
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.database import database as db
+from app.pagination import paginate
+from app.schema import Cursor, PaginationParameters
+
+PAGES = [1, 10, 100, 1_000, 10_000]
+
+
+async def seed(engine, n_messages: int, batch_size: int = 50_000) -> uuid.UUID:
+    chat = db.Chat(title="Benchmark")
+    start = db.utc_now()
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.execute(insert(db.Chat), [chat.model_dump()])
+        for offset in range(0, n_messages, batch_size):
+            rows = [
+                {
+                    "id": uuid.uuid4(),
+                    "create_time": start + timedelta(microseconds=i),
+                    "update_time": start + timedelta(microseconds=i),
+                    "chat_id": chat.id,
+                    "role": db.ChatMessageRole.HUMAN,
+                    "content": f"message {i}",
+                }
+                for i in range(offset, min(offset + batch_size, n_messages))
+            ]
+            await conn.execute(insert(db.ChatMessage), rows)
+    return chat.id
+
+
+async def time_query(session: AsyncSession, query, repeat: int) -> float:
+    """Median latency of `query` in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        (await session.exec(query)).all()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+async def main(n_messages: int, limit: int, repeat: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{Path(tmp) / 'bench.db'}")
+        start = time.perf_counter()
+        chat_id = await seed(engine, n_messages)
+        print(f"Seeded {n_messages} messages in {time.perf_counter() - start:.1f}s")
+
+        base = select(db.ChatMessage).where(db.ChatMessage.chat_id == chat_id)
+        print(f"{'page':>8} {'offset (ms)':>12} {'cursor (ms)':>12}")
+        async with AsyncSession(engine) as session:
+            for page in PAGES:
+                if (page - 1) * limit >= n_messages:
+                    break
+                offset = PaginationParameters(offset=(page - 1) * limit, limit=limit)
+                offset_ms = await time_query(
+                    session, paginate(base, db.ChatMessage, offset), repeat
+                )
+                # the cursor a client would hold after walking to this page
+                cursor = None
+                if page > 1:
+                    previous = PaginationParameters(
+                        offset=(page - 1) * limit - 1, limit=1
+                    )
+                    last = (
+                        await session.exec(paginate(base, db.ChatMessage, previous))
+                    ).one()
+                    cursor = Cursor(create_time=last.create_time, id=last.id).encode()
+                keyset = PaginationParameters(cursor=cursor, limit=limit)
+                cursor_ms = await time_query(
+                    session, paginate(base, db.ChatMessage, keyset), repeat
+                )
+                print(f"{page:>8} {offset_ms:>12.2f} {cursor_ms:>12.2f}")
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.messages, args.limit, args.repeat))
@@ -0,0 +1,119 @@
+"""
+Compare full-text search (FTS5) with `LIKE '%...%'` scans of message contents.
+
+Seeds a temporary SQLite db with N messages of random words over a few
+thousand chats, builds the search index, then times the first page of
+results for rare, common and prefix queries with both strategies.
+
+    python -m benchmarks.search --messages 1000000
+"""
+
+import argparse
+import asyncio
+import random
+import statistics
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from pathlib import Path
+
+from sqlalchemy import event, insert
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.database import database as db
+from app.database.migrations import run_migrations
+from app.database.search import search
+
+VOCABULARY = [f"word{i}" for i in range(20_000)]
+# (label, FTS5 words, LIKE pattern)
+QUERIES = [
+    ("rare word", "word19999", "%word19999%"),
+    ("common word", "word1", "%word1 %"),
+    ("two words", "word12 word345", "%word12 %word345%"),
+    ("prefix", "word1999*", "%word1999%"),
+]
+
+
+def sentence(rng: random.Random) -> str:
+    # zipf-like distribution: low numbered words are much more frequent
+    n = len(VOCABULARY)
+    words = [VOCABULARY[min(int(rng.paretovariate(1.2)) - 1, n - 1)] for _ in range(8)]
+    words += rng.choices(VOCABULARY, k=12)
+    rng.shuffle(words)
+    return " ".join(words)
+
+
+async def seed(engine, n_messages: int, n_chats: int, batch_size: int = 50_000):
+    rng = random.Random(0)
+    chats = [db.Chat(title=f"Chat {i}") for i in range(n_chats)]
+    start = db.utc_now()
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        await conn.execute(insert(db.Chat), [chat.model_dump() for chat in chats])
+        for offset in range(0, n_messages, batch_size):
+            rows = [
+                {
+                    "id": uuid.uuid4(),
+                    "create_time": start + timedelta(microseconds=i),
+                    "update_time": start + timedelta(microseconds=i),
+                    "chat_id": chats[i % n_chats].id,
+                    "role": db.ChatMessageRole.HUMAN,
+                    "content": sentence(rng),
+                }
+                for i in range(offset, min(offset + batch_size, n_messages))
+            ]
+            await conn.execute(insert(db.ChatMessage), rows)
+        # creates the index of the seeded messages
+        await conn.run_sync(run_migrations)
+
+
+async def time_query(session: AsyncSession, query, repeat: int) -> float:
+    """Median latency of `query` in milliseconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        (await session.exec(query)).all()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+async def main(n_messages: int, n_chats: int, limit: int, repeat: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{Path(tmp) / 'bench.db'}")
+        event.listen(
+            engine.sync_engine,
+            "connect",
+            lambda connection, record: db.sqlite_functions(connection),
+        )
+        start = time.perf_counter()
+        await seed(engine, n_messages, n_chats)
+        print(
+            f"Seeded and indexed {n_messages} messages in {time.perf_counter() - start:.1f}s"
+        )
+
+        print(f"{'query':<12} {'fts (ms)':>10} {'like (ms)':>10}")
+        async with AsyncSession(engine) as session:
+            for label, words, pattern in QUERIES:
+                fts_ms = await time_query(session, search(words, limit=limit), repeat)
+                like = (
+                    select(db.ChatMessage)
+                    .where(db.ChatMessage.content.like(pattern))
+                    .order_by(db.ChatMessage.create_time.desc())
+                    .limit(limit)
+                )
+                like_ms = await time_query(session, like, repeat)
+                print(f"{label:<12} {fts_ms:>10.2f} {like_ms:>10.2f}")
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--chats", type=int, default=5_000)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    asyncio.run(main(args.messages, args.chats, args.limit, args.repeat))
@@ -0,0 +1,135 @@
+"""
+CPU time and allocations of a large page of messages, on both sides.
+
+Seeds a temporary SQLite db with one chat of --messages messages, then
+measures a page holding all of them:
+- server, from the query to the response body: ORM instances validated and
+  dumped by pydantic (what FastAPI does with a response model), and Core rows
+  encoded by orjson (`app/serialization.py`)
+- client, from the body to the models: `json.loads` then a model per message,
+  and `TypeAdapter(list[Message]).validate_json` (`chat_client`)
+CPU time is the median of --repeat runs; allocations are the peak traced by
+tracemalloc, in a separate run.
+
+    python -m benchmarks.serialization --messages 10000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+import tracemalloc
+import uuid
+from pathlib import Path
+
+
+async def seed(messages: int, words: int) -> uuid.UUID:
+    from sqlalchemy import select
+
+    from app.database import database as db
+    from app.database.bulk import generate_chats, import_chats
+
+    await db.init_db()
+    await import_chats(generate_chats(1, messages, words=words))
+    async with db.engine.connect() as conn:
+        return (await conn.execute(select(db.Chat.id))).scalar()
+
+
+def server_paths(chat_id: uuid.UUID) -> dict:
+    from pydantic import TypeAdapter
+    from sqlmodel import select
+    from sqlmodel.ext.asyncio.session import AsyncSession
+
+    from app.database import database as db
+    from app.serialization import columns, encode
+
+    messages = TypeAdapter(list[db.ChatMessage])
+    order = (db.ChatMessage.create_time.desc(), db.ChatMessage.id.desc())
+
+    async def orm_pydantic() -> bytes:
+        async with AsyncSession(db.engine) as session:
+            query = select(db.ChatMessage).where(db.ChatMessage.chat_id == chat_id)
+            rows = (await session.exec(query.order_by(*order))).all()
+        # as FastAPI: validate with the response model, dump, then JSONResponse
+        content = messages.dump_python(
+            messages.validate_python(rows, from_attributes=True), mode="json"
+        )
+        return json.dumps(
+            content, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode()
+
+    async def core_orjson() -> bytes:
+        async with AsyncSession(db.engine) as session:
+            query = select(*columns(db.ChatMessage)).where(
+                db.ChatMessage.chat_id == chat_id
+            )
+            rows = (await session.exec(query.order_by(*order))).all()
+        return encode(rows)
+
+    return {"ORM + pydantic": orm_pydantic, "Core rows + orjson": core_orjson}
+
+
+def client_paths() -> dict:
+    from pydantic import TypeAdapter
+
+    from chat_client.models import Message
+
+    messages = TypeAdapter(list[Message])
+
+    async def model_per_message(body: bytes) -> list:
+        return [Message.model_validate(message) for message in json.loads(body)]
+
+    async def validate_json(body: bytes) -> list:
+        return messages.validate_json(body)
+
+    return {
+        "json.loads + model_validate": model_per_message,
+        "TypeAdapter.validate_json": validate_json,
+    }
+
+
+async def measure(path, args: tuple, repeat: int) -> tuple[float, float]:
+    """Median CPU time (ms) and peak of allocations (MiB)"""
+    await path(*args)  # warm up
+    timings = []
+    for _ in range(repeat):
+        start = time.process_time()
+        await path(*args)
+        timings.append((time.process_time() - start) * 1000)
+    tracemalloc.start()
+    await path(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return statistics.median(timings), peak / 2**20
+
+
+async def main(messages: int, words: int, repeat: int) -> None:
+    from app.database import database as db
+
+    chat_id = await seed(messages, words)
+    body = None
+    print(f"{'':<7}{'path':<30} {'cpu (ms)':>9} {'peak (MiB)':>11}")
+    for name, path in server_paths(chat_id).items():
+        cpu, peak = await measure(path, (), repeat)
+        print(f"{'server':<7}{name:<30} {cpu:>9.1f} {peak:>11.1f}")
+        body = await path()
+    for name, path in client_paths().items():
+        cpu, peak = await measure(path, (body,), repeat)
+        print(f"{'client':<7}{name:<30} {cpu:>9.1f} {peak:>11.1f}")
+    print(f"{messages} messages, {len(body) / 2**20:.1f} MiB of JSON")
+    await db.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=10_000)
+    parser.add_argument("--words", type=int, default=40, help="per message")
+    parser.add_argument("--repeat", type=int, default=7)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        # settings are read on import, so the app is only imported after this
+        os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{Path(tmp) / 'bench.db'}"
+        asyncio.run(main(args.messages, args.words, args.repeat))
@@ -0,0 +1,111 @@
+"""
+Cost of a rerun of the Streamlit UI, by chat length.
+
+Seeds a temporary SQLite db with one chat per length, serves it with uvicorn,
+then drives `streamlit_ui/main.py` with Streamlit's `AppTest`: each chat is
+selected and the script is rerun --repeat times. The windowed view (the last
+UI_MESSAGE_PAGE_SIZE messages) is compared with rendering the whole chat.
+
+    python -m benchmarks.streamlit_rerun --lengths 50 500 2000
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from benchmarks.loadtest import free_port
+
+UI_DIR = Path(__file__).parent.parent / "streamlit_ui"
+
+
+async def seed(lengths: list[int]) -> dict[int, str]:
+    """One chat per length, returning their ids"""
+    from sqlalchemy import select
+
+    from app.database import database as db
+    from app.database.bulk import generate_chats, import_chats
+
+    await db.init_db()
+    for length in lengths:
+        chat = next(generate_chats(1, length, words=40))
+        await import_chats([chat | {"title": str(length)}])
+    async with db.engine.connect() as conn:
+        rows = await conn.execute(select(db.Chat.id, db.Chat.title))
+        chats = {int(title): str(chat_id) for chat_id, title in rows}
+    await db.engine.dispose()
+    return chats
+
+
+def wait_ready(base_url: str, process: subprocess.Popen) -> None:
+    for _ in range(200):
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with status {process.returncode}")
+        try:
+            httpx.get(f"{base_url}/status").raise_for_status()
+            return
+        except httpx.TransportError:
+            time.sleep(0.05)
+    raise RuntimeError("Server did not start")
+
+
+def rerun_ms(chat_id: str, window: int, repeat: int) -> float:
+    """Median time of a rerun with the chat selected"""
+    from settings import ui_settings
+    from streamlit.testing.v1 import AppTest
+
+    ui_settings.MESSAGE_PAGE_SIZE = ui_settings.MESSAGE_WINDOW = window
+    at = AppTest.from_file(str(UI_DIR / "main.py"), default_timeout=60).run()
+    at.button(key=chat_id).click().run()
+    if at.exception:
+        raise RuntimeError(at.exception[0].message)
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        at.run()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main(lengths: list[int], repeat: int):
+    from settings import ui_settings
+
+    window = ui_settings.MESSAGE_PAGE_SIZE
+    chats = asyncio.run(seed(lengths))
+    port = free_port()
+    os.environ["BACKEND_BASE_URL"] = base_url = f"http://127.0.0.1:{port}"
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", f"--port={port}"]
+        + ["--log-level=warning"],
+        env=os.environ.copy(),
+    )
+    try:
+        wait_ready(base_url, process)
+        print(f"{'messages':>9} {'all (ms)':>9} {f'last {window} (ms)':>14}")
+        for length in lengths:
+            all_ms = rerun_ms(chats[length], max(length, 1), repeat)
+            windowed_ms = rerun_ms(chats[length], window, repeat)
+            print(f"{length:>9} {all_ms:>9.1f} {windowed_ms:>14.1f}")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--lengths", type=int, nargs="+", default=[50, 200, 500])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    # the UI imports its modules from its own directory
+    sys.path.insert(0, str(UI_DIR))
+    with tempfile.TemporaryDirectory() as tmp:
+        # settings are read on import, so the app is only imported after this
+        os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{Path(tmp) / 'bench.db'}"
+        main(args.lengths, args.repeat)
@@ -0,0 +1,140 @@
+"""
+Overhead of metrics and tracing on request throughput.
+
+Runs the same sequential workload (history reads, chat list, title edits and
+non-streamed chats against an instant mock LLM) in-process, in subprocesses
+with telemetry off, with metrics, and with metrics and tracing (when
+OpenTelemetry is installed). Configurations are alternated for --repeat
+rounds and the median CPU time per request is compared with telemetry off.
+
+    python -m benchmarks.telemetry_overhead --requests 2000 --repeat 7
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from importlib.util import find_spec
+from pathlib import Path
+
+import httpx
+
+WORKLOAD = {
+    "TELEMETRY_METRICS": "true",
+    "MOCK_LLM_FIRST_CHUNK_DELAY": "0",
+    "MOCK_LLM_CHUNK_DELAY": "0",
+    "MOCK_LLM_MIN_CHUNKS": "20",
+    "MOCK_LLM_MAX_CHUNKS": "20",
+    "PERSISTENCE_FLUSH_INTERVAL": "0",
+}
+CONFIGS = {
+    "off": {"TELEMETRY_METRICS": "false"},
+    "metrics": {},
+    "metrics + traces": {"TELEMETRY_TRACES_FILE": "{tmp}/traces.jsonl"},
+    "metrics + 10% traces": {
+        "TELEMETRY_TRACES_FILE": "{tmp}/traces.jsonl",
+        "TELEMETRY_TRACES_SAMPLE_RATIO": "0.1",
+    },
+}
+
+
+async def run(requests: int) -> float:
+    """
+    Mean CPU time per request in ms (settings are read from the environment).
+    CPU time of the process (all threads) is much less noisy than wall time
+    on shared machines, and the workload never waits on anything else.
+    """
+    from app.database.bulk import generate_chats, import_chats
+    from app.main import app
+
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        await import_chats(generate_chats(20, 50))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+            chat_ids = [chat["id"] for chat in (await c.get("/chats")).json()]
+
+            async def request(i: int) -> None:
+                chat_id = chat_ids[i % len(chat_ids)]
+                match i % 4:
+                    case 0:
+                        r = await c.get(f"/chats/{chat_id}/messages?limit=50")
+                    case 1:
+                        r = await c.get("/chats", params={"limit": 20})
+                    case 2:
+                        r = await c.patch(f"/chats/{chat_id}", json={"title": str(i)})
+                    case _:
+                        r = await c.post(f"/chats/{chat_id}", json={"content": "hi"})
+                r.raise_for_status()
+
+            # warm up caches and code paths
+            for i in range(100):
+                await request(i)
+            start = time.process_time()
+            for i in range(requests):
+                await request(i)
+            return (time.process_time() - start) / requests * 1000
+
+
+def main(requests: int, repeat: int, max_overhead: float) -> int:
+    configs = dict(CONFIGS)
+    if find_spec("opentelemetry.sdk") is None:
+        print("OpenTelemetry is not installed: skipping traces", file=sys.stderr)
+        configs = {k: v for k, v in configs.items() if "traces" not in k}
+
+    timings = {name: [] for name in configs}
+    for _ in range(repeat):
+        # alternate configurations, so that they share the same machine noise
+        for name, config in configs.items():
+            with tempfile.TemporaryDirectory() as tmp:
+                env = (
+                    os.environ
+                    | WORKLOAD
+                    | {k: v.format(tmp=tmp) for k, v in config.items()}
+                )
+                env["DATABASE_URL"] = f"sqlite+aiosqlite:///{Path(tmp) / 'bench.db'}"
+                result = subprocess.run(
+                    [sys.executable, "-m", "benchmarks.telemetry_overhead"]
+                    + ["--run", f"--requests={requests}"],
+                    env=env,
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                )
+            timings[name].append(json.loads(result.stdout.splitlines()[-1]))
+
+    baseline = statistics.median(timings["off"])
+    print(f"{'config':<22} {'min':>7} {'median':>7} {'overhead':>9}  (cpu ms/request)")
+    noise = statistics.pstdev(timings["off"]) / baseline
+    failed = False
+    for name, values in timings.items():
+        overhead = statistics.median(values) / baseline - 1
+        print(
+            f"{name:<22} {min(values):>7.3f} {statistics.median(values):>7.3f} "
+            f"{overhead:>+9.1%}"
+        )
+        failed |= name == "metrics" and overhead > max_overhead
+    print(f"rounds with telemetry off vary by {noise:.1%} (standard deviation)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument(
+        "--max-overhead",
+        type=float,
+        default=0.02,
+        help="exit with status 1 if metrics cost more than this",
+    )
+    parser.add_argument("--run", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        print(json.dumps(asyncio.run(run(args.requests))))
+    else:
+        sys.exit(main(args.requests, args.repeat, args.max_overhead))
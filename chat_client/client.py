@@ -0,0 +1,637 @@
+"""
+Client of the backend API, shared by the Streamlit and Gradio UIs.
+
+`ChatClient` (blocking) and `AsyncChatClient` keep a pool of keep-alive
+connections (HTTP/2 if `h2` is installed), retry idempotent requests and
+requests rejected before being processed with jittered backoff, revalidate
+GET responses with their ETag, and resume dropped streams with `Last-Event-ID`.
+"""
+
+import asyncio
+import random
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+from importlib.util import find_spec
+from typing import AsyncIterator, Iterator
+
+import httpx
+from pydantic import TypeAdapter
+
+from .models import BatchResult, Chat, Message, Page, SearchResult, StreamEvent
+from .settings import ClientConfig, client_settings
+
+IDEMPOTENT = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# errors raised before the request was sent
+NOT_SENT = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class StreamError(Exception):
+    """The generation failed, or the stream could not be resumed"""
+
+
+class SSEParser:
+    """Incremental parser of server-sent events, fed line by line"""
+
+    def __init__(self):
+        self.event = "message"
+        self.data: list[str] = []
+        self.id: int | None = None
+
+    def feed(self, line: str) -> StreamEvent | None:
+        """The event ended by this line, if any"""
+        if not line:
+            event = None
+            if self.data:
+                event = StreamEvent(self.event, "\n".join(self.data), self.id)
+            self.event, self.data = "message", []
+            return event
+        # lines starting with ":" are heartbeats
+        if line.startswith(":"):
+            return None
+        field, _, value = line.partition(":")
+        value = value.removeprefix(" ")
+        match field:
+            case "event":
+                self.event = value
+            case "data":
+                self.data.append(value)
+            case "id":
+                self.id = int(value) if value.isdigit() else None
+        return None
+
+
+class Retry:
+    """When and after how long a failed request is sent again"""
+
+    def __init__(self, attempts: int, backoff: float, max_backoff: float):
+        self.attempts = max(attempts, 1)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def should_retry(
+        self,
+        method: str,
+        error: Exception | None = None,
+        response: httpx.Response | None = None,
+    ) -> bool:
+        if error is not None:
+            if isinstance(error, NOT_SENT):
+                return True
+            return method in IDEMPOTENT and isinstance(error, httpx.TransportError)
+        # rejected before any work (e.g. too many generations)
+        if response.status_code == 429:
+            return True
+        return method in IDEMPOTENT and response.status_code in (502, 503, 504)
+
+    def delay(self, attempt: int, response: httpx.Response | None = None) -> float:
+        """Seconds before the next attempt (full jitter, unless the server says)"""
+        if response is not None:
+            try:
+                return float(response.headers["Retry-After"])
+            except (KeyError, ValueError):
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+
+# ETag, headers and body of a response
+ETagEntry = tuple[str, httpx.Headers, bytes]
+
+
+def _cache_key(request: httpx.Request) -> tuple[str, str]:
+    return request.headers.get("Accept", ""), str(request.url)
+
+
+class ETagCache:
+    """
+    Last GET responses that carry an ETag, revalidated with `If-None-Match`:
+    when nothing changed the backend answers 304 and the cached body is reused.
+    Entries are keyed on the `Accept` header too, the backend sends
+    `Vary: Accept`.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        # (accept, url) -> (etag, headers, body)
+        self.entries: OrderedDict[tuple[str, str], ETagEntry] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def prepare(self, request: httpx.Request) -> ETagEntry | None:
+        """
+        Add `If-None-Match` if the response is cached; the entry is returned,
+        to be passed to `resolve` (it may be evicted in between)
+        """
+        with self.lock:
+            cached = self.entries.get(_cache_key(request))
+        if cached is not None:
+            request.headers["If-None-Match"] = cached[0]
+        return cached
+
+    def resolve(
+        self,
+        request: httpx.Request,
+        response: httpx.Response,
+        cached: ETagEntry | None,
+    ) -> httpx.Response:
+        key = _cache_key(request)
+        if response.status_code == 304 and cached is not None:
+            self._store(key, cached)
+            _, headers, content = cached
+            return httpx.Response(
+                200, headers=headers, content=content, request=request
+            )
+        etag = response.headers.get("ETag")
+        if response.status_code != 200 or etag is None:
+            return response
+        # the body is already decoded
+        headers = httpx.Headers(response.headers)
+        headers.pop("Content-Encoding", None)
+        headers.pop("Content-Length", None)
+        self._store(key, (etag, headers, response.content))
+        return response
+
+    def _store(self, key: tuple[str, str], entry: ETagEntry) -> None:
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class StreamState:
+    """Requests of a stream: the first one, then resumptions after the last event"""
+
+    def __init__(self, chat_id: uuid.UUID, content: str, persisted_ids: bool):
+        self.chat_id = chat_id
+        self.content = content
+        self.persisted_ids = persisted_ids
+        self.stream_id: str | None = None
+        self.last_event_id: int | None = None
+
+    def request(self) -> tuple[str, str, dict]:
+        if self.stream_id is None:
+            return (
+                "POST",
+                f"/chats/{self.chat_id}/stream",
+                {
+                    "json": {"content": self.content},
+                    "params": {"persisted_ids": self.persisted_ids},
+                },
+            )
+        headers = {}
+        if self.last_event_id is not None:
+            headers["Last-Event-ID"] = str(self.last_event_id)
+        return (
+            "GET",
+            f"/chats/{self.chat_id}/stream/{self.stream_id}",
+            {"headers": headers},
+        )
+
+    def handle(self, event: StreamEvent) -> bool:
+        """Whether the stream is finished"""
+        if event.id is not None:
+            self.last_event_id = event.id
+        match event.event:
+            case "start":
+                self.stream_id = event.data
+            case "error":
+                raise StreamError(event.data)
+        return event.event in ("done", "cancelled")
+
+
+# lists are parsed and validated in one pass over the body, in pydantic-core
+CHATS = TypeAdapter(list[Chat])
+MESSAGES = TypeAdapter(list[Message])
+SEARCH_RESULTS = TypeAdapter(list[SearchResult])
+
+
+def _chats(response: httpx.Response) -> Page[Chat]:
+    return Page[Chat](
+        items=CHATS.validate_json(response.content),
+        next_cursor=response.headers.get("X-Next-Cursor"),
+    )
+
+
+def _messages(response: httpx.Response) -> Page[Message]:
+    return Page[Message](
+        items=MESSAGES.validate_json(response.content),
+        next_cursor=response.headers.get("X-Next-Cursor"),
+    )
+
+
+def _str(value) -> str:
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+def _selection(
+    ids: list[uuid.UUID] | None,
+    chat_id: uuid.UUID | None,
+    since: datetime | None,
+    until: datetime | None,
+) -> dict:
+    selection = {"ids": ids, "chat_id": chat_id, "since": since, "until": until}
+    return {
+        key: [str(id_) for id_ in value] if key == "ids" else _str(value)
+        for key, value in selection.items()
+        if value is not None
+    }
+
+
+def _params(**params) -> dict:
+    return {key: _str(value) for key, value in params.items() if value is not None}
+
+
+class BaseClient:
+    def __init__(self, base_url: str | None, settings: ClientConfig):
+        self.settings = settings
+        self.retry = Retry(
+            settings.RETRIES, settings.RETRY_BACKOFF, settings.RETRY_MAX_BACKOFF
+        )
+        self.etags = (
+            ETagCache(settings.ETAG_CACHE_SIZE) if settings.ETAG_CACHE_SIZE else None
+        )
+        self.stream_timeout = httpx.Timeout(
+            settings.TIMEOUT,
+            connect=settings.CONNECT_TIMEOUT,
+            read=settings.STREAM_READ_TIMEOUT,
+        )
+        self.options = {
+            "base_url": base_url or settings.BASE_URL,
+            "timeout": httpx.Timeout(
+                settings.TIMEOUT, connect=settings.CONNECT_TIMEOUT
+            ),
+            "limits": httpx.Limits(
+                max_connections=settings.MAX_CONNECTIONS,
+                max_keepalive_connections=settings.MAX_CONNECTIONS,
+            ),
+            "http2": settings.HTTP2 and find_spec("h2") is not None,
+        }
+
+
+class ChatClient(BaseClient):
+    """
+    Blocking client of the backend API.
+    It keeps a pool of keep-alive connections: create one per process and
+    reuse it (it is thread safe).
+    """
+
+    def __init__(
+        self, base_url: str | None = None, settings: ClientConfig = client_settings
+    ):
+        super().__init__(base_url, settings)
+        self.http = httpx.Client(**self.options)
+
+    def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request, retrying if allowed; raises on error statuses"""
+        request = self.http.build_request(method, url, **kwargs)
+        cache = self.etags if method == "GET" else None
+        cached = cache.prepare(request) if cache is not None else None
+        for attempt in range(self.retry.attempts):
+            last = attempt + 1 == self.retry.attempts
+            try:
+                response = self.http.send(request)
+            except httpx.TransportError as e:
+                if last or not self.retry.should_retry(method, error=e):
+                    raise
+                time.sleep(self.retry.delay(attempt))
+                continue
+            if last or not self.retry.should_retry(method, response=response):
+                break
+            time.sleep(self.retry.delay(attempt, response))
+        if cache is not None:
+            response = cache.resolve(request, response, cached)
+        response.raise_for_status()
+        return response
+
+    def list_chats(
+        self, limit: int | None = None, cursor: str | None = None
+    ) -> Page[Chat]:
+        """Chats from the newest"""
+        return _chats(
+            self.request("GET", "/chats", params=_params(limit=limit, cursor=cursor))
+        )
+
+    def get_chat(self, chat_id: uuid.UUID) -> Chat:
+        return Chat.model_validate(self.request("GET", f"/chats/{chat_id}").json())
+
+    def create_chat(self, title: str | None = None) -> Chat:
+        response = self.request("POST", "/chats", params=_params(title=title))
+        return Chat.model_validate(response.json())
+
+    def rename_chat(self, chat_id: uuid.UUID, title: str) -> Chat:
+        response = self.request("PATCH", f"/chats/{chat_id}", json={"title": title})
+        return Chat.model_validate(response.json())
+
+    def delete_chat(self, chat_id: uuid.UUID) -> None:
+        self.request("DELETE", f"/chats/{chat_id}")
+
+    def delete_chats(self, before: datetime) -> BatchResult:
+        """Delete the chats without messages since `before`"""
+        response = self.request("DELETE", "/chats", params=_params(before=before))
+        return BatchResult.model_validate(response.json())
+
+    def truncate_chat(
+        self, chat_id: uuid.UUID, after: uuid.UUID | datetime | None = None
+    ) -> BatchResult:
+        """Delete the messages newer than `after` (all of them by default)"""
+        url = f"/chats/{chat_id}/messages"
+        response = self.request("DELETE", url, params=_params(after=after))
+        return BatchResult.model_validate(response.json())
+
+    def messages(
+        self,
+        chat_id: uuid.UUID,
+        limit: int | None = None,
+        cursor: str | None = None,
+        since: uuid.UUID | None = None,
+    ) -> Page[Message]:
+        """Messages of a chat from the newest; with `since`, only newer ones"""
+        params = _params(limit=limit, cursor=cursor, since=since)
+        return _messages(
+            self.request("GET", f"/chats/{chat_id}/messages", params=params)
+        )
+
+    def message_content(self, message_id: uuid.UUID) -> str:
+        """Full content of a message (lists truncate large ones)"""
+        return self.request("GET", f"/messages/{message_id}/content").text
+
+    def iter_message_content(self, message_id: uuid.UUID) -> Iterator[str]:
+        """Full content of a message, as it is received"""
+        url = f"/messages/{message_id}/content"
+        with self.http.stream("GET", url, timeout=self.stream_timeout) as response:
+            if not response.is_success:
+                response.read()
+                response.raise_for_status()
+            yield from response.iter_text()
+
+    def delete_message(self, message_id: uuid.UUID) -> None:
+        self.request("DELETE", f"/messages/{message_id}")
+
+    def delete_messages(
+        self,
+        ids: list[uuid.UUID] | None = None,
+        chat_id: uuid.UUID | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+    ) -> BatchResult:
+        """Delete messages by id and/or chat, created within `[since, until)`"""
+        selection = _selection(ids, chat_id, since, until)
+        response = self.request("POST", "/messages/delete", json=selection)
+        return BatchResult.model_validate(response.json())
+
+    def update_messages(
+        self,
+        content: str,
+        ids: list[uuid.UUID] | None = None,
+        chat_id: uuid.UUID | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+    ) -> BatchResult:
+        """Set the content of messages, selected as for `delete_messages`"""
+        selection = _selection(ids, chat_id, since, until) | {"content": content}
+        response = self.request("PATCH", "/messages", json=selection)
+        return BatchResult.model_validate(response.json())
+
+    def search(self, query: str, limit: int | None = None) -> list[SearchResult]:
+        response = self.request("GET", "/search", params=_params(q=query, limit=limit))
+        return SEARCH_RESULTS.validate_json(response.content)
+
+    def send(self, chat_id: uuid.UUID, content: str) -> str:
+        """Post a message and wait for the whole reply"""
+        response = self.request("POST", f"/chats/{chat_id}", json={"content": content})
+        return response.json()["content"]
+
+    def stream(
+        self, chat_id: uuid.UUID, content: str, persisted_ids: bool = True
+    ) -> Iterator[StreamEvent]:
+        """Post a message and receive the reply as it is generated"""
+        state = StreamState(chat_id, content, persisted_ids)
+        attempts = self.retry.attempts + self.settings.STREAM_RECONNECTS
+        for attempt in range(attempts):
+            method, url, kwargs = state.request()
+            last = attempt + 1 == attempts
+            try:
+                with self.http.stream(
+                    method, url, timeout=self.stream_timeout, **kwargs
+                ) as response:
+                    if not response.is_success:
+                        response.read()
+                        if not last and self.retry.should_retry(
+                            method, response=response
+                        ):
+                            time.sleep(self.retry.delay(attempt, response))
+                            continue
+                        response.raise_for_status()
+                    parser = SSEParser()
+                    for line in response.iter_lines():
+                        if (event := parser.feed(line)) is not None:
+                            finished = state.handle(event)
+                            yield event
+                            if finished:
+                                return
+            except httpx.TransportError as e:
+                resumable = state.stream_id is not None
+                if last or not (resumable or self.retry.should_retry(method, error=e)):
+                    raise
+            time.sleep(self.retry.delay(attempt))
+        raise StreamError("The stream was interrupted too many times")
+
+    def cancel_stream(self, chat_id: uuid.UUID, stream_id: str) -> None:
+        self.request("DELETE", f"/chats/{chat_id}/stream/{stream_id}")
+
+    def close(self) -> None:
+        self.http.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AsyncChatClient(BaseClient):
+    """Same as `ChatClient`, for asyncio applications"""
+
+    def __init__(
+        self, base_url: str | None = None, settings: ClientConfig = client_settings
+    ):
+        super().__init__(base_url, settings)
+        self.http = httpx.AsyncClient(**self.options)
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """Send a request, retrying if allowed; raises on error statuses"""
+        request = self.http.build_request(method, url, **kwargs)
+        cache = self.etags if method == "GET" else None
+        cached = cache.prepare(request) if cache is not None else None
+        for attempt in range(self.retry.attempts):
+            last = attempt + 1 == self.retry.attempts
+            try:
+                response = await self.http.send(request)
+            except httpx.TransportError as e:
+                if last or not self.retry.should_retry(method, error=e):
+                    raise
+                await asyncio.sleep(self.retry.delay(attempt))
+                continue
+            if last or not self.retry.should_retry(method, response=response):
+                break
+            await asyncio.sleep(self.retry.delay(attempt, response))
+        if cache is not None:
+            response = cache.resolve(request, response, cached)
+        response.raise_for_status()
+        return response
+
+    async def list_chats(
+        self, limit: int | None = None, cursor: str | None = None
+    ) -> Page[Chat]:
+        """Chats from the newest"""
+        params = _params(limit=limit, cursor=cursor)
+        return _chats(await self.request("GET", "/chats", params=params))
+
+    async def get_chat(self, chat_id: uuid.UUID) -> Chat:
+        response = await self.request("GET", f"/chats/{chat_id}")
+        return Chat.model_validate(response.json())
+
+    async def create_chat(self, title: str | None = None) -> Chat:
+        response = await self.request("POST", "/chats", params=_params(title=title))
+        return Chat.model_validate(response.json())
+
+    async def rename_chat(self, chat_id: uuid.UUID, title: str) -> Chat:
+        response = await self.request(
+            "PATCH", f"/chats/{chat_id}", json={"title": title}
+        )
+        return Chat.model_validate(response.json())
+
+    async def delete_chat(self, chat_id: uuid.UUID) -> None:
+        await self.request("DELETE", f"/chats/{chat_id}")
+
+    async def delete_chats(self, before: datetime) -> BatchResult:
+        """Delete the chats without messages since `before`"""
+        params = _params(before=before)
+        response = await self.request("DELETE", "/chats", params=params)
+        return BatchResult.model_validate(response.json())
+
+    async def truncate_chat(
+        self, chat_id: uuid.UUID, after: uuid.UUID | datetime | None = None
+    ) -> BatchResult:
+        """Delete the messages newer than `after` (all of them by default)"""
+        url = f"/chats/{chat_id}/messages"
+        response = await self.request("DELETE", url, params=_params(after=after))
+        return BatchResult.model_validate(response.json())
+
+    async def messages(
+        self,
+        chat_id: uuid.UUID,
+        limit: int | None = None,
+        cursor: str | None = None,
+        since: uuid.UUID | None = None,
+    ) -> Page[Message]:
+        """Messages of a chat from the newest; with `since`, only newer ones"""
+        params = _params(limit=limit, cursor=cursor, since=since)
+        url = f"/chats/{chat_id}/messages"
+        return _messages(await self.request("GET", url, params=params))
+
+    async def message_content(self, message_id: uuid.UUID) -> str:
+        """Full content of a message (lists truncate large ones)"""
+        response = await self.request("GET", f"/messages/{message_id}/content")
+        return response.text
+
+    async def iter_message_content(self, message_id: uuid.UUID) -> AsyncIterator[str]:
+        """Full content of a message, as it is received"""
+        url = f"/messages/{message_id}/content"
+        async with self.http.stream(
+            "GET", url, timeout=self.stream_timeout
+        ) as response:
+            if not response.is_success:
+                await response.aread()
+                response.raise_for_status()
+            async for text in response.aiter_text():
+                yield text
+
+    async def delete_message(self, message_id: uuid.UUID) -> None:
+        await self.request("DELETE", f"/messages/{message_id}")
+
+    async def delete_messages(
+        self,
+        ids: list[uuid.UUID] | None = None,
+        chat_id: uuid.UUID | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+    ) -> BatchResult:
+        """Delete messages by id and/or chat, created within `[since, until)`"""
+        selection = _selection(ids, chat_id, since, until)
+        response = await self.request("POST", "/messages/delete", json=selection)
+        return BatchResult.model_validate(response.json())
+
+    async def update_messages(
+        self,
+        content: str,
+        ids: list[uuid.UUID] | None = None,
+        chat_id: uuid.UUID | None = None,
+        since: datetime | None = None,
+        until: datetime | None = None,
+    ) -> BatchResult:
+        """Set the content of messages, selected as for `delete_messages`"""
+        selection = _selection(ids, chat_id, since, until) | {"content": content}
+        response = await self.request("PATCH", "/messages", json=selection)
+        return BatchResult.model_validate(response.json())
+
+    async def search(self, query: str, limit: int | None = None) -> list[SearchResult]:
+        params = _params(q=query, limit=limit)
+        response = await self.request("GET", "/search", params=params)
+        return SEARCH_RESULTS.validate_json(response.content)
+
+    async def send(self, chat_id: uuid.UUID, content: str) -> str:
+        """Post a message and wait for the whole reply"""
+        response = await self.request(
+            "POST", f"/chats/{chat_id}", json={"content": content}
+        )
+        return response.json()["content"]
+
+    async def stream(
+        self, chat_id: uuid.UUID, content: str, persisted_ids: bool = True
+    ) -> AsyncIterator[StreamEvent]:
+        """Post a message and receive the reply as it is generated"""
+        state = StreamState(chat_id, content, persisted_ids)
+        attempts = self.retry.attempts + self.settings.STREAM_RECONNECTS
+        for attempt in range(attempts):
+            method, url, kwargs = state.request()
+            last = attempt + 1 == attempts
+            try:
+                async with self.http.stream(
+                    method, url, timeout=self.stream_timeout, **kwargs
+                ) as response:
+                    if not response.is_success:
+                        await response.aread()
+                        if not last and self.retry.should_retry(
+                            method, response=response
+                        ):
+                            await asyncio.sleep(self.retry.delay(attempt, response))
+                            continue
+                        response.raise_for_status()
+                    parser = SSEParser()
+                    async for line in response.aiter_lines():
+                        if (event := parser.feed(line)) is not None:
+                            finished = state.handle(event)
+                            yield event
+                            if finished:
+                                return
+            except httpx.TransportError as e:
+                resumable = state.stream_id is not None
+                if last or not (resumable or self.retry.should_retry(method, error=e)):
+                    raise
+            await asyncio.sleep(self.retry.delay(attempt))
+        raise StreamError("The stream was interrupted too many times")
+
+    async def cancel_stream(self, chat_id: uuid.UUID, stream_id: str) -> None:
+        await self.request("DELETE", f"/chats/{chat_id}/stream/{stream_id}")
+
+    async def aclose(self) -> None:
+        await self.http.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
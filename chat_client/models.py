@@ -0,0 +1,90 @@
+import json
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from enum import StrEnum
+from typing import Generic, TypeVar
+
+from pydantic import BaseModel, ConfigDict, Field
+
+T = TypeVar("T")
+
+
+def utc_now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class Role(StrEnum):
+    AI = "ai"
+    HUMAN = "human"
+    SYSTEM = "system"
+
+
+class Model(BaseModel):
+    # fields added by newer backends are ignored
+    model_config = ConfigDict(extra="ignore")
+
+
+class Chat(Model):
+    id: uuid.UUID
+    title: str | None = None
+    create_time: datetime
+    update_time: datetime
+    message_count: int = 0
+    last_message_time: datetime | None = None
+    last_message_snippet: str | None = None
+    version: int = 0
+
+
+class Message(Model):
+    id: uuid.UUID
+    chat_id: uuid.UUID
+    role: Role
+    # a preview when `truncated`: the full content is read with `message_content`
+    content: str | None = None
+    content_length: int | None = None
+    content_hash: str | None = None
+    truncated: bool = False
+    # set by the backend, defaults are for messages built from stream events
+    create_time: datetime = Field(default_factory=utc_now)
+    update_time: datetime = Field(default_factory=utc_now)
+
+
+class SearchResult(Model):
+    message_id: uuid.UUID
+    chat_id: uuid.UUID
+    chat_title: str | None
+    role: Role
+    create_time: datetime
+    # matching terms are wrapped in `**`
+    snippet: str
+    rank: float
+
+
+class BatchResult(Model):
+    """Rows affected by a batch operation"""
+
+    chats: int = 0
+    messages: int = 0
+
+
+class Page(Model, Generic[T]):
+    """A page of a list, and the cursor of the next one (None on the last page)"""
+
+    items: list[T]
+    next_cursor: str | None = None
+
+
+@dataclass(frozen=True)
+class StreamEvent:
+    """
+    Server-sent event of a stream: `start` (the stream id), `message` (a chunk),
+    `persisted` (the ids of the stored messages), then `done` or `cancelled`
+    """
+
+    event: str
+    data: str
+    id: int | None = None
+
+    def json(self):
+        return json.loads(self.data)
@@ -0,0 +1,34 @@
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class ClientConfig(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_prefix="BACKEND_",
+        env_file=".env",
+        env_file_encoding="utf-8",
+        extra="ignore",
+    )
+    BASE_URL: str = "http://localhost:8000"
+    # seconds
+    TIMEOUT: float = 30
+    CONNECT_TIMEOUT: float = 5
+    # streams send a heartbeat every 15s: a silent connection is dead
+    STREAM_READ_TIMEOUT: float = 60
+    # connections kept alive and reused by all the requests of a process
+    MAX_CONNECTIONS: int = 20
+    # HTTP/2, if the `h2` package is installed (uvicorn itself speaks HTTP/1.1,
+    # a proxy in front of it may not)
+    HTTP2: bool = True
+    # attempts of idempotent requests, and of requests rejected before being
+    # processed (connection refused, 429); the delay between attempts doubles
+    # from RETRY_BACKOFF up to RETRY_MAX_BACKOFF, with full jitter
+    RETRIES: int = 3
+    RETRY_BACKOFF: float = 0.25
+    RETRY_MAX_BACKOFF: float = 4
+    # times a dropped stream is resumed (with `Last-Event-ID`) before giving up
+    STREAM_RECONNECTS: int = 3
+    # GET responses kept to be revalidated with their ETag (0 disables)
+    ETAG_CACHE_SIZE: int = 64
+
+
+client_settings = ClientConfig()
@@ -1,22 +1,39 @@
+import uuid
+from typing import AsyncIterator
+
 import gradio as gr
-import httpx
+
+from chat_client.client import AsyncChatClient
+
+# one pool of connections, shared by all the sessions
+client = AsyncChatClient()
+# backend chat of each browser session, until the session is closed
+chats: dict[str, uuid.UUID] = {}
+
+
+async def streaming(
+    message: str, hist: list[dict[str, str]], request: gr.Request
+) -> AsyncIterator[str]:
+    """Stream the reply token by token; a cleared history starts a new chat"""
+    session = request.session_hash
+    if not hist or session not in chats:
+        chats[session] = (await client.create_chat()).id
+    # chunks are joined once per update, instead of growing a string with `+=`
+    chunks: list[str] = []
+    async for event in client.stream(chats[session], message, persisted_ids=False):
+        if event.event == "message":
+            chunks.append(event.data)
+            yield "".join(chunks)
 
 
-def streaming(message: str, hist: list[dict[str, str]]):
-    chat_id = "greager"
-    msg = ""
-    with httpx.Client() as client:
-        with client.stream(
-            "POST",
-            f"http://localhost:8000/chats/{chat_id}",
-            json={"message": message},
-        ) as r:
-            for chunk in r.iter_text():
-                msg += chunk
-                yield msg
+def forget_chat(request: gr.Request) -> None:
+    """The tab was closed or reloaded: a new session starts a new chat"""
+    chats.pop(request.session_hash, None)
 
 
-demo = gr.ChatInterface(fn=streaming, type="messages")
+with gr.Blocks() as demo:
+    gr.ChatInterface(fn=streaming, type="messages")
+    demo.unload(forget_chat)
 
 if __name__ == "__main__":
     demo.launch()
@@ -1,26 +1,30 @@
-from uuid import uuid4
+from datetime import datetime
+from typing import Iterator
+from uuid import UUID
 
 import httpx
 import schema
 
 import streamlit as st
-from app.database import database as db
-from settings import backend_settings, ui_settings
+from chat_client.client import ChatClient
+from chat_client.models import Message, Role
+from settings import ui_settings
 
 
 @st.cache_resource
-def get_httpx_client():
-    return httpx.Client(base_url=backend_settings.BASE_URL, timeout=600)
+def get_client() -> ChatClient:
+    # one pool of connections, shared by all the sessions
+    return ChatClient()
 
 
-client = get_httpx_client()
+client = get_client()
 
 
 @st.dialog("Edit Chat Title")
 def set_title(chat_id: str):
     """Set chat title"""
     if title := st.text_input("New Title"):
-        client.patch(f"/chats/{chat_id}", json={"title": title}).json()
+        client.rename_chat(chat_id, title)
         get_chats()
         try:
             if st.session_state.chat.id == chat_id:
@@ -32,18 +36,27 @@ def set_title(chat_id: str):
 
 def create_chat() -> None:
     """Create new chat"""
-    response = client.post("/chats").json()
-    chat = db.Chat.model_validate(response)
+    chat = client.create_chat()
     st.session_state.chats = {chat.id: chat} | st.session_state.chats
     select_chat(chat.id)
     return
 
 
 def get_chats() -> None:
-    """Get chats from db and store in streamlit session state"""
-    chats = client.get("/chats").json()
-    chats = [db.Chat.model_validate(chat) for chat in chats]
-    st.session_state.chats = {chat.id: chat for chat in chats}
+    """Get first page of chats from db and store in streamlit session state"""
+    st.session_state.chats = {}
+    st.session_state.chats_cursor = None
+    load_more_chats()
+    return
+
+
+def load_more_chats() -> None:
+    """Get next page of chats from db and append it to streamlit session state"""
+    page = client.list_chats(
+        limit=ui_settings.CHAT_PAGE_SIZE, cursor=st.session_state.chats_cursor
+    )
+    st.session_state.chats |= {chat.id: chat for chat in page.items}
+    st.session_state.chats_cursor = page.next_cursor
     return
 
 
@@ -51,51 +64,211 @@ def select_chat(chat_id=None) -> None:
     """Update streamlit session state with selected chat details"""
     if chat_id is not None:
         st.session_state.chat = st.session_state.chats[chat_id]
-        history = client.get(f"/chats/{chat_id}/messages").json()
-        st.session_state.history = [
-            db.ChatMessage.model_validate(h) for h in history[::-1]
-        ]
+        limit = min(ui_settings.MESSAGE_PAGE_SIZE, ui_settings.MESSAGE_WINDOW)
+        page = client.messages(chat_id, limit=limit)
+        st.session_state.history = page.items[::-1]
+        st.session_state.history_cursor = page.next_cursor
         st.session_state.title = (
             st.session_state.chat.title or ui_settings.DEFAULT_CHAT_TITLE
         )
     else:
         st.session_state.chat = None
         st.session_state.history = None
+        st.session_state.history_cursor = None
         st.session_state.title = ui_settings.APP_TITLE
     return
 
 
+def load_older_messages() -> None:
+    """Prepend the previous page of messages to the history in session state"""
+    room = ui_settings.MESSAGE_WINDOW - len(st.session_state.history)
+    page = client.messages(
+        st.session_state.chat.id,
+        limit=min(ui_settings.MESSAGE_PAGE_SIZE, room),
+        cursor=st.session_state.history_cursor,
+    )
+    st.session_state.history = page.items[::-1] + st.session_state.history
+    st.session_state.history_cursor = page.next_cursor
+    return
+
+
+def search_messages() -> None:
+    """Search messages matching the query in the sidebar"""
+    query = st.session_state.search_query.strip()
+    if not query:
+        st.session_state.search_results = None
+        return
+    try:
+        results = client.search(query, limit=ui_settings.SEARCH_RESULTS)
+    except httpx.HTTPStatusError:
+        results = []
+    st.session_state.search_results = results
+    return
+
+
+def open_chat(chat_id: UUID) -> None:
+    """Select a chat, even if it is not in the loaded pages of the sidebar"""
+    if chat_id not in st.session_state.chats:
+        chat = client.get_chat(chat_id)
+        st.session_state.chats[chat.id] = chat
+    select_chat(chat_id)
+    return
+
+
+def sync_history() -> None:
+    """Append the messages newer than the last one in streamlit session state"""
+    chat_id = st.session_state.chat.id
+    history = st.session_state.history
+    if not history:
+        return select_chat(chat_id)
+    try:
+        page = client.messages(chat_id, since=history[-1].id)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code != 404:
+            raise
+        # the last message we know of was deleted: reload everything
+        return select_chat(chat_id)
+    history += page.items[::-1]
+    return keep_window()
+
+
+def append_turn(prompt: str, reply: str, persisted: dict[str, str]) -> None:
+    """
+    Append a prompt and its reply to the history in streamlit session state,
+    using the ids sent at the end of the stream (or syncing if they are missing)
+    """
+    if "human" not in persisted or "ai" not in persisted:
+        return sync_history()
+    chat_id = st.session_state.chat.id
+    st.session_state.history += [
+        Message(
+            id=UUID(persisted["human"]),
+            chat_id=chat_id,
+            role=Role.HUMAN,
+            content=prompt,
+        ),
+        Message(
+            id=UUID(persisted["ai"]),
+            chat_id=chat_id,
+            role=Role.AI,
+            content=reply,
+        ),
+    ]
+    return keep_window()
+
+
+def keep_window() -> None:
+    """
+    Keep the history in session state within the window: past it, only the
+    newest page is kept (reloaded, for the cursor of the older messages)
+    """
+    if len(st.session_state.history) > ui_settings.MESSAGE_WINDOW:
+        select_chat(st.session_state.chat.id)
+    return
+
+
+@st.fragment
 def render_chat() -> None:
-    """Render the selected chat in streamlit session state"""
-    chat = st.session_state.chat is not None
-    if chat is None:
+    """
+    Render the selected chat and its prompt input.
+    This is a fragment: sending a prompt, deleting a message or loading older
+    messages only reruns this function, not the sidebar.
+    """
+    if st.session_state.chat is None:
+        st.chat_input("Select a chat", disabled=True)
         return
-    if st.session_state.history is not None:
-        message: db.ChatMessage
-        for message in st.session_state.history:
-            render_message(message)
+    col_older, col_clear = st.columns([0.8, 0.2])
+    if st.session_state.history_cursor is not None:
+        full = len(st.session_state.history) >= ui_settings.MESSAGE_WINDOW
+        with col_older:
+            st.button(
+                "Load older",
+                help=f"At most {ui_settings.MESSAGE_WINDOW} messages are shown"
+                if full
+                else None,
+                icon=":material/expand_less:",
+                on_click=load_older_messages,
+                disabled=full,
+                type="tertiary",
+            )
+    if st.session_state.history:
+        with col_clear:
+            st.button(
+                "Clear",
+                help="Delete all the messages",
+                icon=":material/delete_sweep:",
+                on_click=clear_chat,
+                type="tertiary",
+            )
+    message: Message
+    for message in st.session_state.history:
+        render_message(message)
+    if prompt := st.chat_input():
+        send_prompt(prompt)
+    return
+
+
+def send_prompt(prompt: str) -> None:
+    """Render a prompt and its streamed reply, then add them to the history"""
+    # since we do not know message_id (it is generated by the backend)
+    # initially use a placeholder container to show input, response,
+    # and a fake delete button
+    placeholder = st.empty()
+    with placeholder.container():
+        user_message = schema.ChatMessagePlaceholder(content=prompt, role=Role.HUMAN)
+        render_message(user_message)
+        # Response
+        persisted = {}
+        ai_message = schema.ChatMessagePlaceholder(
+            content=streaming(st.session_state.chat.id, prompt, persisted),
+            role=Role.AI,
+        )
+        reply = render_message(ai_message)
+
+    # add the two messages to the history, with the ids sent by the backend,
+    # and rerender them with the correct ids
+    append_turn(prompt, reply, persisted)
+    for message in st.session_state.history[-2:]:
+        render_message(message)
+    # now remove the placeholder container
+    # (if you put it before the for loop, some weird scroll happens in the ui)
+    placeholder.empty()
     return
 
 
 def delete_chat(chat_id: str) -> None:
     """Delete the chat from db and refresh streamlit session state"""
-    client.delete(f"/chats/{chat_id}")
+    client.delete_chat(chat_id)
     get_chats()
     select_chat(None)
     return
 
 
-def render_message(message: db.ChatMessage | schema.ChatMessagePlaceholder) -> None:
-    """Display a single chat message (either str or Generator)"""
+def render_message(message: Message | schema.ChatMessagePlaceholder) -> str:
+    """Display a single chat message (either str or Generator), returning its text"""
     # Display chat messages from history on app rerun
     role = message.role
     col_message, col_delete = st.columns([0.975, 0.02], vertical_alignment="bottom")
     with col_message:
         with st.chat_message(role):
-            if isinstance(message.content, str):
-                st.markdown(message.content)
+            if isinstance(message, schema.ChatMessagePlaceholder):
+                content = message.content
+                if isinstance(content, str):
+                    st.markdown(content)
+                else:
+                    content = st.write_stream(content)
             else:
-                st.write_stream(message.content)
+                content = message.content or ""
+                render_body(message.id, message.update_time, message.truncated, content)
+                if message.truncated:
+                    st.button(
+                        "Show all",
+                        help=f"{message.content_length} characters",
+                        key=f"expand_{message.id}",
+                        type="tertiary",
+                        on_click=expand_message,
+                        kwargs={"message_id": message.id},
+                    )
     with col_delete:
         if isinstance(message, schema.ChatMessagePlaceholder):
             callback_kwargs = {}
@@ -107,27 +280,66 @@ def render_message(message: db.ChatMessage | schema.ChatMessagePlaceholder) -> N
         st.button(
             ":material/delete:",
             help="Delete",
-            key=f"delete_{message.id}_{uuid4().hex}",
+            # stable keys, so that the widgets are kept between reruns
+            key=f"delete_{message.role}_{message.id}",
             use_container_width=True,
             type="tertiary",
             **callback_kwargs,
         )
+    return content
+
+
+@st.cache_data(max_entries=ui_settings.RENDER_CACHE_SIZE, show_spinner=False)
+def render_body(
+    message_id: UUID, update_time: datetime, truncated: bool, _content: str
+) -> None:
+    """
+    Body of a stored message: the elements are cached and replayed until the
+    message changes (or is expanded), without hashing its content
+    """
+    st.markdown(_content)
+
+
+def expand_message(message_id: UUID) -> None:
+    """Replace the preview of a large message with its full content"""
+    content = client.message_content(message_id)
+    st.session_state.history = [
+        message.model_copy(update={"content": content, "truncated": False})
+        if message.id == message_id
+        else message
+        for message in st.session_state.history
+    ]
+    return
+
+
+def clear_chat() -> None:
+    """Delete all the messages of the selected chat (in one request)"""
+    client.truncate_chat(st.session_state.chat.id)
+    st.session_state.history = []
+    st.session_state.history_cursor = None
     return
 
 
 def delete_message(message_id: str) -> None:
     """Delete a single message from db and refresh streamlit state session"""
-    client.delete(f"messages/{message_id}")
-    select_chat(st.session_state.chat.id)
+    client.delete_message(message_id)
+    st.session_state.history = [
+        message for message in st.session_state.history if message.id != message_id
+    ]
     return None
 
 
-def streaming(chat_id: str, message: str):
-    """Stream response"""
-    with client.stream(
-        "POST",
-        f"/chats/{chat_id}/stream",
-        json={"content": message},
-    ) as r:
-        for chunk in r.iter_text():
-            yield chunk
+def streaming(
+    chat_id: UUID, message: str, persisted: dict[str, str] | None = None
+) -> Iterator[str]:
+    """
+    Stream response (the client resumes the stream if the connection drops).
+    The ids of the stored prompt and reply are written to `persisted`, if given.
+    """
+    for event in client.stream(chat_id, message, persisted_ids=persisted is not None):
+        match event.event:
+            case "message":
+                yield event.data
+            case "persisted":
+                if persisted is not None:
+                    persisted.update(event.json())
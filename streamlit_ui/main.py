@@ -1,8 +1,6 @@
-import schema
 from settings import ui_settings
 
 import streamlit as st
-from app.database import database as db
 
 # this must be run before any other streamlit command
 # even if in other files
@@ -31,11 +29,13 @@ st.subheader(st.session_state.title, divider="red")
 if "chats" not in st.session_state:
     ch.get_chats()
     ch.select_chat(None)
+    st.session_state.search_results = None
 
 
 # -- Sidebar --
 # -------------
 CHAT_LIST_KEY = "chat-list"
+SEARCH_RESULTS_KEY = "search-results"
 with st.sidebar:
     st.button(
         "New Chat",
@@ -45,12 +45,35 @@ with st.sidebar:
         use_container_width=False,
         type="tertiary",
     )
+    st.text_input(
+        "Search",
+        key="search_query",
+        on_change=ch.search_messages,
+        placeholder="Search messages",
+        label_visibility="collapsed",
+        icon=":material/search:",
+    )
+    if st.session_state.search_results is not None:
+        with st.container(key=SEARCH_RESULTS_KEY):
+            if not st.session_state.search_results:
+                st.caption("No messages found")
+            for i, result in enumerate(st.session_state.search_results):
+                st.button(
+                    f"**{result.chat_title or 'New Chat'}**  \n{result.snippet}",
+                    type="tertiary",
+                    use_container_width=True,
+                    on_click=ch.open_chat,
+                    key=f"search_{i}_{result.message_id}",
+                    kwargs={"chat_id": result.chat_id},
+                )
+        st.divider()
     with st.container(key=CHAT_LIST_KEY):
         for chat in st.session_state.chats.values():
             col_title, col_edit, _, col_delete = st.columns([50, 5, 1, 5])
             with col_title:
                 st.button(
                     chat.title or "New Chat",
+                    help=chat.last_message_snippet,
                     type="tertiary",
                     use_container_width=True,
                     on_click=ch.select_chat,
@@ -79,6 +102,13 @@ with st.sidebar:
                     use_container_width=True,
                     type="tertiary",
                 )
+        if st.session_state.chats_cursor is not None:
+            st.button(
+                "Load more",
+                icon=":material/expand_more:",
+                on_click=ch.load_more_chats,
+                type="tertiary",
+            )
 
 
 # custom CSS for chat list
@@ -105,42 +135,4 @@ st.html(f"""
 # -- Main window --
 # -----------------
 
-is_chat_selected = st.session_state.chat is not None
-
-
-if is_chat_selected:
-    ch.render_chat()
-    prompt = st.chat_input()
-
-else:
-    prompt = st.chat_input("Select a chat", disabled=True)
-
-
-# React to user input
-if prompt:
-    # since we do not know message_id (it is generated by the backend)
-    # initially use a placeholder container to show input, response,
-    # and a fake delete button
-    placeholder = st.empty()
-    with placeholder.container():
-        user_message = schema.ChatMessagePlaceholder(
-            content=prompt, role=db.ChatMessageRole.HUMAN
-        )
-        ch.render_message(user_message)
-        # Response
-        ai_message = schema.ChatMessagePlaceholder(
-            content=ch.streaming(st.session_state.chat.id, prompt),
-            role=db.ChatMessageRole.AI,
-        )
-        ch.render_message(ai_message)
-
-    # now query again the db to get the actual list of messages
-    # and rerender the last two messages, with the correct ids
-    # TODO: add an endpoint to get only the last two messages
-    # instead of the whole history from the db
-    ch.select_chat(st.session_state.chat.id)
-    for message in st.session_state.history[-2:]:
-        ch.render_message(message)
-    # now remove the placeholder container
-    # (if you put it before the for loop, some weird scroll happens in the ui)
-    placeholder.empty()
+ch.render_chat()
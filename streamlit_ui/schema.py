@@ -1,15 +1,15 @@
-from app.database import database as db
+from datetime import datetime
 from typing import Iterable
 
 from pydantic import BaseModel, Field
 
-from datetime import datetime
+from chat_client.models import Role, utc_now
 
 
 class ChatMessagePlaceholder(BaseModel):
     id: str = "placeholder_message"
-    create_time: datetime = Field(default_factory=db.utc_now)
-    update_time: datetime = Field(default_factory=db.utc_now)
+    create_time: datetime = Field(default_factory=utc_now)
+    update_time: datetime = Field(default_factory=utc_now)
     chat_id: str = "placeholder_chat"
-    role: db.ChatMessageRole
+    role: Role
     content: str | Iterable[str] = ""
@@ -1,21 +1,24 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
-class BackendConfig(BaseSettings):
-    model_config = SettingsConfigDict(
-        env_prefix="BACKEND", env_file=".env", env_file_encoding="utf-8", extra="ignore"
-    )
-    BASE_URL: str = "http://localhost:8000"
-
-
 class UIConfig(BaseSettings):
     model_config = SettingsConfigDict(
-        env_prefix="UI", env_file=".env", env_file_encoding="utf-8", extra="ignore"
+        env_prefix="UI_", env_file=".env", env_file_encoding="utf-8", extra="ignore"
     )
     APP_TITLE: str = "Chat App"
     APP_FAVICON: str = ":robot_face:"
     DEFAULT_CHAT_TITLE: str = "New Chat"
+    # number of chats fetched at a time in the sidebar
+    CHAT_PAGE_SIZE: int = 30
+    # messages fetched and rendered at a time in the chat ("Load older" for more)
+    MESSAGE_PAGE_SIZE: int = 50
+    # messages kept in the session and rendered, at most: past it, appending
+    # drops the older ones, and no older page is loaded
+    MESSAGE_WINDOW: int = 500
+    # rendered message bodies kept in the cache (shared by all the sessions)
+    RENDER_CACHE_SIZE: int = 1000
+    # number of message search results shown in the sidebar
+    SEARCH_RESULTS: int = 10
 
 
-backend_settings = BackendConfig()
 ui_settings = UIConfig()
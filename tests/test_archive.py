@@ -0,0 +1,55 @@
+from datetime import timedelta
+
+import pytest
+from sqlalchemy import select
+
+from app.database import archive
+from app.database import database as db
+from app.database.bulk import import_chats
+
+pytestmark = pytest.mark.anyio
+
+INACTIVITY = timedelta(days=30)
+
+
+async def import_old_chat() -> db.Chat:
+    start = db.utc_now() - 2 * INACTIVITY
+    messages = [
+        {
+            "role": "human",
+            "content": f"message {i}",
+            "create_time": (start + timedelta(seconds=i)).isoformat(),
+        }
+        for i in range(3)
+    ]
+    chat = {"create_time": start.isoformat(), "messages": messages}
+    assert await import_chats([chat]) == (1, 3)
+    return await get_chat()
+
+
+async def get_chat() -> db.Chat:
+    async with db.engine.connect() as conn:
+        return (await conn.execute(select(db.Chat))).one()
+
+
+async def test_archive_and_restore(database):
+    chat = await import_old_chat()
+    assert await archive.archive_batch(INACTIVITY, 10) == (1, 3)
+    archived = await get_chat()
+    assert archived.archived
+    # the ETag of chat lists changes
+    assert archived.version > chat.version
+    assert archived.update_time == chat.update_time
+    assert await archive.restore(chat.id) == 3
+    restored = await get_chat()
+    assert not restored.archived
+    assert restored.message_count == 3
+    assert restored.last_message_time == chat.last_message_time
+
+
+async def test_restored_chat_is_not_archived_again(database):
+    chat = await import_old_chat()
+    assert await archive.archive_batch(INACTIVITY, 10) == (1, 3)
+    await archive.restore(chat.id)
+    assert await archive.archive_batch(INACTIVITY, 10) == (0, 0)
+    assert not (await get_chat()).archived
@@ -0,0 +1,13 @@
+import pytest
+
+from app.broker import Broker, MemoryBroker
+
+
+def test_incomplete_broker_is_rejected():
+    class GetOnly(Broker):
+        async def get(self, key: str) -> str | None:
+            return None
+
+    with pytest.raises(TypeError, match="abstract"):
+        GetOnly()
+    MemoryBroker()
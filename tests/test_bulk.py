@@ -0,0 +1,45 @@
+import json
+
+import pytest
+
+from app.database import database as db
+from app.database.bulk import Importer, export_lines, import_chats, read_file
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_import_file_and_export(database, tmp_path):
+    path = tmp_path / "chats.jsonl"
+    lines = [
+        {"title": "export", "messages": [{"role": "human", "content": "hi"}]},
+        # ChatML, as a bare list of messages
+        [
+            {"role": "user", "content": "question"},
+            {"role": "assistant", "content": "answer"},
+        ],
+    ]
+    path.write_text("\n".join(json.dumps(line) for line in lines) + "\n\n")
+    # small blocks: lines are read across several of them
+    assert await import_chats(read_file(str(path), block_size=16)) == (2, 3)
+    exported = [json.loads(line) async for line in export_lines()]
+    assert [chat["title"] for chat in exported] == ["export", None]
+    assert [m["content"] for m in exported[1]["messages"]] == ["question", "answer"]
+
+
+async def test_invalid_line(tmp_path):
+    path = tmp_path / "chats.jsonl"
+    path.write_text('{"messages": []}\n\n{"messages": \n')
+    with pytest.raises(ValueError, match="Line 3"):
+        async for _ in read_file(str(path)):
+            pass
+
+
+async def test_empty_chats_are_batched(database):
+    async with db.engine.connect() as conn:
+        importer = Importer(conn, batch_size=10)
+        for _ in range(25):
+            await importer.add({"messages": []})
+            assert len(importer.chats) < 10
+        assert importer.chat_count == 20
+        await importer.flush()
+    assert importer.chat_count == 25
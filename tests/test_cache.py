@@ -0,0 +1,23 @@
+import asyncio
+
+import pytest
+
+from app.cache import Flight
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_failed_flight():
+    async def source():
+        yield "partial"
+        raise RuntimeError("backend unavailable")
+
+    flight = Flight(source())
+    chunks = []
+    with pytest.raises(RuntimeError, match="backend unavailable"):
+        async for chunk in flight.follow():
+            chunks.append(chunk)
+    assert chunks == ["partial"]
+    await asyncio.wait([flight.task])
+    # nothing left to be reported as never retrieved
+    assert flight.task.exception() is None
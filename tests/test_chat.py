@@ -0,0 +1,15 @@
+import uuid
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize(
+    "method, body",
+    [("GET", None), ("PATCH", {"title": "renamed"}), ("DELETE", None)],
+)
+async def test_unknown_chat(client, method, body):
+    r = await client.request(method, f"/chats/{uuid.uuid4()}", json=body)
+    assert r.status_code == 404
+    assert r.json() == {"detail": "Chat not found"}
@@ -0,0 +1,43 @@
+import httpx
+
+from chat_client.client import ChatClient
+
+
+def test_not_modified_after_eviction():
+    client = ChatClient(base_url="http://app")
+    etag = 'W/"1"'
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        if request.headers.get("If-None-Match") == etag:
+            # other requests evicted the entry meanwhile
+            client.etags.entries.clear()
+            return httpx.Response(304, headers={"ETag": etag})
+        return httpx.Response(200, headers={"ETag": etag}, json={"title": "chat"})
+
+    client.http = httpx.Client(
+        base_url="http://app", transport=httpx.MockTransport(handle)
+    )
+    assert client.request("GET", "/chats/1").json() == {"title": "chat"}
+    response = client.request("GET", "/chats/1")
+    assert response.status_code == 200
+    assert response.json() == {"title": "chat"}
+    # and it is cached again
+    assert list(client.etags.entries) == [("*/*", "http://app/chats/1")]
+
+
+def test_representations_are_cached_apart():
+    client = ChatClient(base_url="http://app")
+
+    def handle(request: httpx.Request) -> httpx.Response:
+        if request.headers.get("If-None-Match") is not None:
+            return httpx.Response(304, headers={"ETag": 'W/"1"'})
+        body = request.headers["Accept"].encode()
+        return httpx.Response(200, headers={"ETag": 'W/"1"'}, content=body)
+
+    client.http = httpx.Client(
+        base_url="http://app", transport=httpx.MockTransport(handle)
+    )
+    ndjson = {"Accept": "application/x-ndjson"}
+    assert client.request("GET", "/chats").text == "*/*"
+    assert client.request("GET", "/chats", headers=ndjson).text == ndjson["Accept"]
+    assert client.request("GET", "/chats").text == "*/*"
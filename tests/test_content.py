@@ -0,0 +1,71 @@
+import hashlib
+import json
+
+import pytest
+
+from app.database.bulk import import_chats
+from app.database.content import full_content, iter_content, split
+from app.settings import DatabaseConfig, database_settings
+
+pytestmark = pytest.mark.anyio
+
+# multi-byte characters: chunks of bytes may end within a character
+LARGE = "é€😀 " * (database_settings.CONTENT_THRESHOLD // 4 + 1)
+
+
+@pytest.fixture(params=["gzip", "zstd"])
+def settings(request) -> DatabaseConfig:
+    if request.param == "zstd":
+        pytest.importorskip("zstandard")
+    return DatabaseConfig(CONTENT_COMPRESSION=request.param, CONTENT_CHUNK_SIZE=1_000)
+
+
+@pytest.mark.parametrize("content", [None, "", "short", LARGE])
+def test_split(settings, content):
+    columns, body = split(content, settings)
+    assert (body is not None) == (content == LARGE)
+    assert columns["truncated"] == (body is not None)
+    if content is None:
+        assert columns["content"] is None
+        return
+    assert columns["content_length"] == len(content)
+    assert columns["content_hash"] == hashlib.sha256(content.encode()).hexdigest()
+    if body is not None:
+        assert columns["content"] == content[: settings.CONTENT_PREVIEW]
+        assert body["codec"] == settings.CONTENT_COMPRESSION
+        data = body["codec"], body["data"]
+    else:
+        assert columns["content"] == content
+        data = None, None
+    assert full_content(columns["content"], *data) == content
+    chunks = list(iter_content(columns["content"], *data, settings=settings))
+    assert b"".join(chunks).decode() == content
+    assert all(0 < len(chunk) <= settings.CONTENT_CHUNK_SIZE for chunk in chunks)
+
+
+async def test_content_round_trip(database, client):
+    await import_chats(
+        [{"messages": [{"role": "human", "content": LARGE}, {"role": "ai"}]}]
+    )
+    chat_id = (await client.get("/chats")).json()[0]["id"]
+    messages = (await client.get(f"/chats/{chat_id}/messages")).json()
+    large = next(m for m in messages if m["truncated"])
+    assert large["content"] == LARGE[: database_settings.CONTENT_PREVIEW]
+    assert large["content_length"] == len(LARGE)
+    r = await client.get(f"/messages/{large['id']}/content")
+    assert r.text == LARGE
+    assert r.headers["ETag"] == f'"{large["content_hash"]}"'
+    r = await client.get(
+        f"/messages/{large['id']}/content", headers={"If-None-Match": r.headers["ETag"]}
+    )
+    assert r.status_code == 304
+    # a message without content has no ETag
+    empty = next(m for m in messages if not m["truncated"])
+    r = await client.get(f"/messages/{empty['id']}/content")
+    assert r.text == ""
+    assert "ETag" not in r.headers
+    # and exports carry the full content
+    [chat] = [
+        json.loads(line) for line in (await client.get("/chats/export")).iter_lines()
+    ]
+    assert [m["content"] for m in chat["messages"]] == [LARGE, None]
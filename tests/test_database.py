@@ -0,0 +1,81 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from sqlalchemy import func, insert, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.database import database as db
+from app.database.migrations import MIGRATIONS, run_migrations, schema_version
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_migrations_run_once(database):
+    async with database.begin() as conn:
+        versions = (await conn.execute(select(schema_version.c.version))).scalars()
+        assert sorted(versions) == sorted(m.version for m in MIGRATIONS)
+        assert await conn.run_sync(run_migrations) == []
+
+
+async def test_server_defaults(database):
+    chat_id = uuid.uuid4()
+    async with database.begin() as conn:
+        await conn.execute(insert(db.Chat).values(id=chat_id))
+    async with AsyncSession(database) as session:
+        chat = await session.get(db.Chat, chat_id)
+    assert chat.create_time.tzinfo is not None
+    assert (chat.message_count, chat.version, chat.archived) == (0, 0, False)
+
+
+async def test_times_are_stored_in_utc(database):
+    paris = timezone(timedelta(hours=2))
+    chat = db.Chat(create_time=datetime(2025, 6, 1, 12, tzinfo=paris))
+    async with AsyncSession(database, expire_on_commit=False) as session:
+        session.add(chat)
+        await session.commit()
+    async with AsyncSession(database) as session:
+        stored = await session.get(db.Chat, chat.id)
+    assert stored.create_time == datetime(2025, 6, 1, 10, tzinfo=timezone.utc)
+    assert stored.create_time.utcoffset() == timedelta(0)
+
+
+async def test_chat_summaries(database):
+    chat = db.Chat()
+    start = db.utc_now()
+    messages = [
+        db.ChatMessage(
+            chat_id=chat.id,
+            role=db.ChatMessageRole.HUMAN,
+            content=f"message {i}",
+            create_time=start + timedelta(seconds=i),
+        )
+        for i in range(3)
+    ]
+    async with AsyncSession(database, expire_on_commit=False) as session:
+        session.add(chat)
+        session.add_all(messages)
+        await session.flush()
+        await session.exec(db.update_chat_summaries({chat.id}))
+        await session.commit()
+    async with AsyncSession(database) as session:
+        chat = await session.get(db.Chat, chat.id)
+    assert chat.message_count == 3
+    assert chat.last_message_time == messages[-1].create_time
+    assert chat.last_message_snippet == "message 2"
+    assert chat.version == 1
+
+
+async def test_messages_are_deleted_with_their_chat(database):
+    chat = db.Chat()
+    message = db.ChatMessage(chat_id=chat.id, role=db.ChatMessageRole.AI)
+    message.set_content("x" * (db.database_settings.CONTENT_THRESHOLD + 1))
+    async with AsyncSession(database) as session:
+        session.add_all([chat, message])
+        await session.commit()
+        await session.delete(chat)
+        await session.commit()
+    async with database.connect() as conn:
+        for table in (db.ChatMessage, db.MessageBody):
+            count = await conn.execute(select(func.count()).select_from(table))
+            assert count.scalar() == 0
@@ -0,0 +1,84 @@
+import httpx
+import pytest
+from starlette.requests import Request
+
+from app.database.bulk import import_chats
+from app.etags import if_none_match
+
+pytestmark = pytest.mark.anyio
+
+NDJSON = {"Accept": "application/x-ndjson"}
+
+
+@pytest.mark.parametrize(
+    "header, matches",
+    [
+        (None, False),
+        ("*", True),
+        ('W/"a"', True),
+        ('"a"', True),
+        ('W/"b", W/"a"', True),
+        ('W/"b"', False),
+    ],
+)
+def test_if_none_match(header, matches):
+    headers = [] if header is None else [(b"if-none-match", header.encode())]
+    request = Request({"type": "http", "headers": headers})
+    assert if_none_match(request, 'W/"a"') is matches
+
+
+async def revalidate(client, url: str, etag: str, **kwargs) -> httpx.Response:
+    headers = {"If-None-Match": etag}
+    return await client.get(url, headers=headers, **kwargs)
+
+
+async def test_not_modified_until_changed(database, client):
+    chat = {"messages": [{"role": "human", "content": "hello"}]}
+    await import_chats([chat])
+    chat_id = (await client.get("/chats")).json()[0]["id"]
+    urls = ["/chats", f"/chats/{chat_id}", f"/chats/{chat_id}/messages"]
+    etags = {}
+    for url in urls:
+        r = await client.get(url)
+        assert r.status_code == 200
+        assert r.headers["Cache-Control"] == "no-cache"
+        etags[url] = r.headers["ETag"]
+        r = await revalidate(client, url, etags[url])
+        assert r.status_code == 304
+        assert r.content == b""
+        assert r.headers["ETag"] == etags[url]
+    # the history is another representation of the chat
+    r = await revalidate(client, urls[1], etags[urls[1]], params={"include": "history"})
+    assert r.status_code == 200
+    # any change to the chat or its messages makes new ETags
+    message_id = (await client.get(urls[2])).json()[0]["id"]
+    for change in (
+        client.patch(urls[1], json={"title": "renamed"}),
+        client.patch(f"/messages/{message_id}", params={"content": "edited"}),
+        client.delete(f"/messages/{message_id}"),
+    ):
+        assert (await change).status_code == 200
+        for url in urls:
+            r = await revalidate(client, url, etags[url])
+            assert r.status_code == 200
+            assert r.headers["ETag"] != etags[url]
+            etags[url] = r.headers["ETag"]
+
+
+async def test_etag_depends_on_the_representation(database, client):
+    chat = {"messages": [{"role": "human", "content": "hello"}]}
+    await import_chats([chat])
+    chat_id = (await client.get("/chats")).json()[0]["id"]
+    for url in ("/chats", f"/chats/{chat_id}/messages"):
+        r = await client.get(url)
+        assert r.headers["Vary"] == "Accept"
+        etag = r.headers["ETag"]
+        r = await client.get(url, headers={"If-None-Match": etag})
+        assert r.status_code == 304
+        assert r.headers["Vary"] == "Accept"
+        # another representation, or other parameters
+        r = await client.get(url, headers={"If-None-Match": etag, **NDJSON})
+        assert r.status_code == 200
+        assert r.headers["Content-Type"] == NDJSON["Accept"]
+        r = await client.get(url, params={"limit": 1}, headers={"If-None-Match": etag})
+        assert r.status_code == 200
@@ -0,0 +1,35 @@
+import uuid
+
+import pytest
+
+from app import generation
+from app.llm import scheduler
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_get_response_releases_the_ticket_on_failure(monkeypatch):
+    async def generate(ticket, message):
+        raise RuntimeError("db is locked")
+        yield
+
+    monkeypatch.setattr(generation, "generate", generate)
+    with pytest.raises(RuntimeError):
+        async for _ in generation.get_response("hi", uuid.uuid4()):
+            pass
+    assert scheduler.waiting == 0
+    assert not scheduler._chats
+
+
+async def test_failed_context_releases_the_ticket(database, monkeypatch):
+    async def assemble(chat_id, message):
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(generation.assembler, "assemble", assemble)
+    monkeypatch.setattr(generation.context_settings, "ENABLED", True)
+    ticket = scheduler.reserve(uuid.uuid4())
+    with pytest.raises(RuntimeError):
+        async for _ in generation.llm_reply(ticket, "hi"):
+            pass
+    assert (scheduler.waiting, scheduler.running) == (0, 0)
+    assert not scheduler._chats
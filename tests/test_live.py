@@ -0,0 +1,44 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+
+from app import live
+from app.broker import MemoryBroker
+from app.live import ChatHub
+
+pytestmark = pytest.mark.anyio
+
+
+class FlakyBroker(MemoryBroker):
+    """Shared broker whose first subscription fails"""
+
+    shared = True
+
+    def __init__(self):
+        super().__init__()
+        self.failures = 1
+
+    async def _subscribe(self, channel: str) -> None:
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("broker unavailable")
+
+
+async def test_failed_relay_is_retried_by_the_next_viewer(monkeypatch):
+    broker = FlakyBroker()
+    monkeypatch.setattr(live, "broker", broker)
+    hub = ChatHub()
+    chat_id = uuid.uuid4()
+    async with hub.subscribe(chat_id):
+        # the relay failed: updates of other workers are missed...
+        await asyncio.sleep(0)
+        assert chat_id not in hub.relays
+        # ...until another viewer subscribes again
+        async with hub.subscribe(chat_id) as viewer:
+            assert chat_id in hub.relays
+            update = json.dumps({"type": "chat_deleted"})
+            await broker.publish(live.channel(chat_id), f"other-worker {update}")
+            assert await asyncio.wait_for(viewer.get(), 1) == update
+    assert not hub.relays
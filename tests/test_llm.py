@@ -0,0 +1,55 @@
+import asyncio
+import uuid
+
+import pytest
+
+from app.llm import Scheduler, llm_settings
+
+pytestmark = pytest.mark.anyio
+
+
+class SlowBackend:
+    def __init__(self, chunks: int, delay: float):
+        self.chunks = chunks
+        self.delay = delay
+
+    async def generate(self, messages):
+        for i in range(self.chunks):
+            await asyncio.sleep(self.delay)
+            yield str(i)
+
+    async def aclose(self) -> None:
+        return
+
+
+async def generate(scheduler: Scheduler, chunks: list, consumer_delay: float):
+    async def prompt():
+        return [{"role": "user", "content": "hi"}]
+
+    ticket = scheduler.reserve(uuid.uuid4())
+    async for chunk in scheduler.generate(ticket, prompt):
+        await asyncio.sleep(consumer_delay)
+        chunks.append(chunk)
+
+
+async def test_timeout_does_not_cancel_the_consumer(monkeypatch):
+    monkeypatch.setattr(llm_settings, "REQUEST_TIMEOUT", 0.1)
+    scheduler = Scheduler(SlowBackend(3, 0), 1, 1, 1)
+    chunks = []
+    # the deadline passes while the second chunk is handled
+    with pytest.raises(TimeoutError):
+        await generate(scheduler, chunks, consumer_delay=0.06)
+    assert chunks == ["0", "1"]
+    assert scheduler.timeouts == 1
+    assert (scheduler.waiting, scheduler.running) == (0, 0)
+
+
+async def test_slow_backend_is_timed_out(monkeypatch):
+    monkeypatch.setattr(llm_settings, "REQUEST_TIMEOUT", 0.1)
+    scheduler = Scheduler(SlowBackend(3, 0.06), 1, 1, 1)
+    chunks = []
+    with pytest.raises(TimeoutError):
+        await generate(scheduler, chunks, consumer_delay=0)
+    assert chunks == ["0"]
+    assert scheduler.timeouts == 1
+    assert (scheduler.waiting, scheduler.running) == (0, 0)
@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from app.database.bulk import import_chats
+from app.settings import database_settings
+
+pytestmark = pytest.mark.anyio
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def at(seconds: int) -> str:
+    return (START + timedelta(seconds=seconds)).isoformat()
+
+
+@pytest.fixture
+async def chats(database, client) -> dict[str, list[str]]:
+    """Ids of the messages of chats `a` (created at 0, 1, 2 s) and `b` (at 1 s)"""
+    await import_chats(
+        [
+            {
+                "title": "a",
+                "messages": [
+                    {"role": "human", "content": str(i), "create_time": at(i)}
+                    for i in range(3)
+                ],
+            },
+            {
+                "title": "b",
+                "messages": [{"role": "human", "content": "b", "create_time": at(1)}],
+            },
+        ]
+    )
+    result = {}
+    for chat in (await client.get("/chats")).json():
+        messages = (await client.get(f"/chats/{chat['id']}/messages")).json()
+        # the oldest first
+        result[chat["title"]] = [chat["id"]] + [m["id"] for m in reversed(messages)]
+    return result
+
+
+async def contents(client, chat_id: str) -> list[str]:
+    messages = (await client.get(f"/chats/{chat_id}/messages")).json()
+    return [message["content"] for message in reversed(messages)]
+
+
+async def test_selection_is_required(database, client):
+    r = await client.post("/messages/delete", json={"since": at(0)})
+    assert r.status_code == 422
+
+
+@pytest.mark.parametrize(
+    "selection, counts, left",
+    [
+        # by ids, in several chats
+        (lambda a, b: {"ids": [a[1], b[1]]}, (2, 2), (["1", "2"], [])),
+        # by chat, within [since, until)
+        (
+            lambda a, b: {"chat_id": a[0], "since": at(1), "until": at(2)},
+            (1, 1),
+            (["0", "2"], ["b"]),
+        ),
+        # ids and chat: both must match
+        (
+            lambda a, b: {"ids": [b[1]], "chat_id": a[0]},
+            (0, 0),
+            (["0", "1", "2"], ["b"]),
+        ),
+    ],
+)
+async def test_delete_messages(client, chats, selection, counts, left):
+    a, b = chats["a"], chats["b"]
+    r = await client.post("/messages/delete", json=selection(a, b))
+    assert r.status_code == 200
+    assert r.json() == {"chats": counts[0], "messages": counts[1]}
+    assert (await contents(client, a[0]), await contents(client, b[0])) == left
+    # the summaries of the chats follow
+    chat = (await client.get(f"/chats/{a[0]}")).json()
+    assert chat["message_count"] == len(left[0])
+
+
+async def test_update_messages(client, chats):
+    a, b = chats["a"], chats["b"]
+    selection = {"chat_id": a[0], "since": at(1)}
+    r = await client.patch("/messages", json=selection | {"content": "edited"})
+    assert r.json() == {"chats": 1, "messages": 2}
+    assert await contents(client, a[0]) == ["0", "edited", "edited"]
+    assert await contents(client, b[0]) == ["b"]
+    # a large content is stored compressed, for each message
+    large = "x" * (database_settings.CONTENT_THRESHOLD + 1)
+    r = await client.patch("/messages", json={"ids": a[1:3], "content": large})
+    assert r.json() == {"chats": 1, "messages": 2}
+    messages = (await client.get(f"/chats/{a[0]}/messages")).json()
+    assert [m["truncated"] for m in messages] == [False, True, True]
+    for message_id in a[1:3]:
+        r = await client.get(f"/messages/{message_id}/content")
+        assert r.text == large
@@ -0,0 +1,58 @@
+import uuid
+
+import pytest
+from sqlalchemy import delete, insert, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.database import database as db
+from app.database.migrations import run_migrations, schema_version
+
+pytestmark = pytest.mark.anyio
+
+
+async def drop_search_index(conn: AsyncConnection) -> None:
+    triggers = await conn.execute(
+        text("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+    )
+    for name in triggers.scalars().all():
+        await conn.execute(text(f"DROP TRIGGER {name}"))
+    await conn.execute(text("DROP TABLE chatmessage_fts"))
+    await conn.execute(text("DROP VIEW chatmessage_text"))
+
+
+@pytest.mark.parametrize(
+    "version, table, column",
+    [
+        (2, "chat", "last_message_time"),
+        (5, "chat", "archived"),
+        (6, "chatmessage", "truncated"),
+    ],
+)
+async def test_upgrade_adds_column(database, version, table, column):
+    """A db created before the migration is upgraded, on every backend"""
+    versions = [version]
+    async with database.begin() as conn:
+        if table == "chatmessage" and conn.dialect.name == "sqlite":
+            # the search index reads the columns of messages: it is created again
+            await drop_search_index(conn)
+            versions.append(7)
+        await conn.execute(text(f"ALTER TABLE {table} DROP COLUMN {column}"))
+        await conn.execute(
+            delete(schema_version).where(schema_version.c.version.in_(versions))
+        )
+    async with database.begin() as conn:
+        assert await conn.run_sync(run_migrations) == versions
+    chat_id, message_id = uuid.uuid4(), uuid.uuid4()
+    async with database.begin() as conn:
+        await conn.execute(insert(db.Chat).values(id=chat_id))
+        await conn.execute(
+            insert(db.ChatMessage).values(
+                id=message_id, chat_id=chat_id, role=db.ChatMessageRole.HUMAN
+            )
+        )
+        chat = await conn.execute(select(db.Chat).where(db.Chat.id == chat_id))
+        assert chat.one().archived is False
+        message = await conn.execute(
+            select(db.ChatMessage).where(db.ChatMessage.id == message_id)
+        )
+        assert message.one().truncated is False
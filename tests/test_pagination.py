@@ -0,0 +1,72 @@
+import uuid
+from datetime import datetime, timezone
+
+import httpx
+import pytest
+
+from app.database.bulk import import_chats
+from app.pagination import NEXT_CURSOR_HEADER
+from app.schema import Cursor
+
+pytestmark = pytest.mark.anyio
+
+# rows created at the same time are ordered by id
+TIME = "2024-01-01T00:00:00+00:00"
+
+
+def test_cursor_round_trip():
+    cursor = Cursor(create_time=datetime.now(timezone.utc), id=uuid.uuid4())
+    assert Cursor.decode(cursor.encode()) == cursor
+    with pytest.raises(ValueError, match="Invalid cursor"):
+        Cursor.decode("not a cursor")
+
+
+async def pages(client: httpx.AsyncClient, url: str, limit: int) -> list[list[str]]:
+    """Ids of the pages of a list, following the cursors"""
+    result = []
+    params = {"limit": limit}
+    while True:
+        r = await client.get(url, params=params)
+        assert r.status_code == 200
+        result.append([row["id"] for row in r.json()])
+        if NEXT_CURSOR_HEADER not in r.headers:
+            return result
+        params["cursor"] = r.headers[NEXT_CURSOR_HEADER]
+
+
+@pytest.mark.parametrize("count, sizes", [(5, [2, 2, 1]), (4, [2, 2, 0])])
+async def test_chat_pages(database, client, count, sizes):
+    await import_chats([{"create_time": TIME} for _ in range(count)])
+    everything = [chat["id"] for chat in (await client.get("/chats")).json()]
+    result = await pages(client, "/chats", limit=2)
+    assert [len(page) for page in result] == sizes
+    assert sum(result, []) == everything
+
+
+async def test_message_pages(database, client):
+    messages = [
+        {"role": "human", "content": str(i), "create_time": TIME} for i in range(3)
+    ]
+    messages += [{"role": "ai", "content": "later"}]
+    await import_chats([{"messages": messages}])
+    chat_id = (await client.get("/chats")).json()[0]["id"]
+    url = f"/chats/{chat_id}/messages"
+    everything = [message["id"] for message in (await client.get(url)).json()]
+    result = await pages(client, url, limit=3)
+    assert [len(page) for page in result] == [3, 1]
+    assert sum(result, []) == everything
+    # the newest first: `since` the second oldest returns the two newest
+    r = await client.get(url, params={"since": everything[-2]})
+    assert [message["id"] for message in r.json()] == everything[:2]
+
+
+@pytest.mark.parametrize(
+    "params",
+    [
+        {"cursor": "not a cursor"},
+        {"offset": 1, "cursor": Cursor(create_time=TIME, id=uuid.uuid4()).encode()},
+    ],
+)
+async def test_invalid_pagination(database, client, params):
+    r = await client.get("/chats", params=params)
+    assert r.status_code == 422
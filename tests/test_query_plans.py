@@ -0,0 +1,72 @@
+"""
+The hot queries are served by the indexes: EXPLAIN must show the index,
+with no full scan and no sort.
+PostgreSQL prefers sequential (or bitmap) scans on small tables, so they are
+disabled to check that an ordered scan of the index can be used.
+"""
+
+import uuid
+
+import pytest
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlmodel import select
+
+from app.database import database as db
+from app.pagination import paginate
+from app.schema import Cursor, PaginationParameters
+from app.serialization import columns
+
+pytestmark = pytest.mark.anyio
+
+CHAT_ID = uuid.UUID(int=1)
+CURSOR = Cursor(create_time=db.utc_now(), id=uuid.UUID(int=0)).encode()
+CHAT_INDEX = "ix_chat_create_time_id"
+MESSAGE_INDEX = "ix_chatmessage_chat_id_create_time_id"
+
+
+def chats(**pagination):
+    query = select(*columns(db.Chat))
+    return paginate(query, db.Chat, PaginationParameters(limit=50, **pagination))
+
+
+def messages(**pagination):
+    query = select(*columns(db.ChatMessage)).where(db.ChatMessage.chat_id == CHAT_ID)
+    return paginate(query, db.ChatMessage, PaginationParameters(limit=50, **pagination))
+
+
+QUERIES = {
+    "chats": (chats(), CHAT_INDEX),
+    "chats (cursor)": (chats(cursor=CURSOR), CHAT_INDEX),
+    "messages": (messages(), MESSAGE_INDEX),
+    "messages (cursor)": (messages(cursor=CURSOR), MESSAGE_INDEX),
+}
+
+
+async def explain(conn: AsyncConnection, query) -> list[str]:
+    compiled = query.compile(
+        dialect=conn.dialect, compile_kwargs={"literal_binds": True}
+    )
+    if conn.dialect.name == "sqlite":
+        plan = await conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}")
+        return [row[-1] for row in plan]
+    await conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+    await conn.exec_driver_sql("SET LOCAL enable_bitmapscan = off")
+    plan = await conn.exec_driver_sql(f"EXPLAIN {compiled}")
+    return [row[0].strip() for row in plan]
+
+
+def full_scan_or_sort(step: str) -> bool:
+    # SQLite: "SCAN chat" (not "SCAN chat USING INDEX ..."), "USE TEMP B-TREE"
+    # PostgreSQL: "Seq Scan on chat", "Sort", "Incremental Sort"
+    if step.startswith("SCAN") and "INDEX" not in step:
+        return True
+    return "TEMP B-TREE" in step or "Seq Scan" in step or "Sort" in step
+
+
+@pytest.mark.parametrize("name", QUERIES)
+async def test_query_uses_index(database, name):
+    query, index = QUERIES[name]
+    async with database.begin() as conn:
+        plan = await explain(conn, query)
+    assert any(index in step for step in plan), plan
+    assert not any(full_scan_or_sort(step) for step in plan), plan
@@ -0,0 +1,139 @@
+import httpx
+import pytest
+from sqlalchemy import select, text
+
+from app.database import database as db
+from app.database.bulk import import_chats
+from app.database.search import match_query
+from app.pagination import NEXT_CURSOR_HEADER
+from app.settings import database_settings
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture(autouse=True)
+def sqlite_only(database):
+    if database.dialect.name != "sqlite":
+        pytest.skip("Search requires SQLite (FTS5)")
+
+
+def large(term: str) -> str:
+    """A content stored compressed, with `term` past its preview"""
+    padding = "lorem " * (database_settings.CONTENT_THRESHOLD // 6)
+    return f"{padding}{term} ipsum"
+
+
+async def check_index(database) -> None:
+    async with database.begin() as conn:
+        await conn.execute(
+            text(
+                "INSERT INTO chatmessage_fts (chatmessage_fts, rank) "
+                "VALUES ('integrity-check', 1)"
+            )
+        )
+
+
+async def search(client: httpx.AsyncClient, q: str) -> list[dict]:
+    r = await client.get("/search", params={"q": q})
+    assert r.status_code == 200
+    return r.json()
+
+
+async def test_search_past_the_preview(database, client):
+    chat = {"messages": [{"role": "human", "content": large("needle")}]}
+    await import_chats([chat])
+    async with database.connect() as conn:
+        message = (await conn.execute(select(db.ChatMessage))).one()
+    assert message.truncated
+    assert "needle" not in message.content
+    [result] = await search(client, "needle")
+    assert result["message_id"] == str(message.id)
+    assert "**needle**" in result["snippet"]
+    # large to small, small to large, large to large, large to small
+    for content, found in [
+        ("short", "short"),
+        (large("haystack"), "haystack"),
+        (large("pin"), "pin"),
+        ("short again", "short"),
+    ]:
+        r = await client.patch(f"/messages/{message.id}", params={"content": content})
+        assert r.status_code == 200
+        await check_index(database)
+        for term in ("needle", "haystack", "pin", "short"):
+            assert len(await search(client, term)) == (term == found)
+    r = await client.delete(f"/chats/{message.chat_id}")
+    assert r.status_code == 200
+    await check_index(database)
+    assert await search(client, "short") == []
+
+
+@pytest.mark.parametrize(
+    "words, query",
+    [
+        ("pyth*", '"pyth"*'),
+        ("two  words", '"two" "words"'),
+        ('NOT "quoted', '"NOT" """quoted"'),
+        ("*", '"*"'),
+    ],
+)
+async def test_match_query(words, query):
+    assert match_query(words) == query
+
+
+def contents(results: list[dict]) -> list[str]:
+    return sorted(result["snippet"].replace("**", "") for result in results)
+
+
+async def test_search(database, client):
+    chats = [
+        {
+            "title": "first",
+            "messages": [
+                {"role": "human", "content": "python generators"},
+                {"role": "ai", "content": "Pythön is a language"},
+                {"role": "human", "content": "generators of rust"},
+            ],
+        },
+        {"title": "second", "messages": [{"role": "human", "content": "python"}]},
+    ]
+    await import_chats(chats)
+    # all the words, diacritics and case ignored, prefixes with `*`
+    assert contents(await search(client, "python generators")) == ["python generators"]
+    assert len(await search(client, "python")) == 3
+    assert len(await search(client, "pyth*")) == 3
+    assert len(await search(client, "pyth")) == 0
+    assert await search(client, 'NOT "') == []
+    first = next(
+        c for c in (await client.get("/chats")).json() if c["title"] == "first"
+    )
+    r = await client.get("/search", params={"q": "python", "chat_id": first["id"]})
+    assert {result["chat_title"] for result in r.json()} == {"first"}
+    assert len(r.json()) == 2
+    # pages of one result, following the cursors
+    results, params = [], {"q": "python", "limit": 1}
+    while True:
+        r = await client.get("/search", params=params)
+        results += r.json()
+        if NEXT_CURSOR_HEADER not in r.headers:
+            break
+        params["cursor"] = r.headers[NEXT_CURSOR_HEADER]
+    assert results == await search(client, "python")
+
+
+async def test_index_follows_deletions(database, client):
+    chats = [
+        {"title": str(i), "messages": [{"role": "human", "content": f"term {i}"}]}
+        for i in range(3)
+    ]
+    await import_chats(chats)
+    ids = {chat["title"]: chat["id"] for chat in (await client.get("/chats")).json()}
+    r = await client.delete(f"/chats/{ids['0']}/messages")
+    assert r.status_code == 200
+    r = await client.post("/messages/delete", json={"chat_id": ids["1"]})
+    assert r.status_code == 200
+    await check_index(database)
+    assert contents(await search(client, "term")) == ["term 2"]
+    r = await client.delete("/chats", params={"before": db.utc_now().isoformat()})
+    assert r.status_code == 200
+    await check_index(database)
+    assert await search(client, "term") == []
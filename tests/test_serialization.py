@@ -0,0 +1,60 @@
+import json
+
+import pytest
+from pydantic import TypeAdapter
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import serialization
+from app.database import database as db
+from app.database.bulk import import_chats
+
+pytestmark = pytest.mark.anyio
+
+NDJSON = {"Accept": serialization.NDJSON}
+
+
+async def pydantic_json(model: type[db.Base], *conditions) -> list[dict]:
+    """What the response model returned, before orjson"""
+    query = select(model).where(*conditions)
+    query = query.order_by(model.create_time.desc(), model.id.desc())
+    async with AsyncSession(db.engine) as session:
+        rows = (await session.exec(query)).all()
+    return TypeAdapter(list[model]).dump_python(rows, mode="json")
+
+
+async def test_rows_match_the_response_models(database, client, monkeypatch):
+    # several NDJSON chunks
+    monkeypatch.setattr(serialization, "NDJSON_BATCH", 2)
+    await import_chats(
+        [
+            {"title": "empty", "create_time": "2024-01-01T00:00:00+00:00"},
+            {
+                "messages": [
+                    {"role": "human", "content": "é\n\"quoted\""},
+                    {"role": "ai", "create_time": "2024-01-01T12:30:00.123456"},
+                    {"role": "system", "content": "x" * 20_000},
+                ]
+            },
+        ]
+    )
+    chats = await pydantic_json(db.Chat)
+    chat_id = next(chat["id"] for chat in chats if chat["message_count"])
+    messages = await pydantic_json(db.ChatMessage)
+    for url, expected in [
+        ("/chats", chats),
+        (f"/chats/{chat_id}/messages", messages),
+    ]:
+        r = await client.get(url)
+        assert r.headers["Content-Type"] == serialization.JSON
+        assert r.json() == expected
+        r = await client.get(url, headers=NDJSON)
+        assert r.headers["Content-Type"] == serialization.NDJSON
+        assert [json.loads(line) for line in r.text.splitlines()] == expected
+
+
+async def test_empty_rows(database, client):
+    r = await client.get("/chats")
+    assert r.content == b"[]"
+    r = await client.get("/chats", headers=NDJSON)
+    assert r.content == b""
@@ -0,0 +1,92 @@
+import asyncio
+import uuid
+
+import httpx
+import pytest
+
+from app import streams
+from app.llm import scheduler
+from app.main import app
+from app.streams import Event, Stream
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize(
+    "data, fields",
+    [
+        ("", [""]),
+        ("one", ["one"]),
+        ("one\ntwo", ["one", "two"]),
+        ("one\r\ntwo\rthree", ["one", "two", "three"]),
+        ("one\r", ["one", ""]),
+        ("\n\n", ["", "", ""]),
+        # not line endings in SSE
+        ("one two\x0c", ["one two\x0c"]),
+    ],
+)
+def test_event_data_fields(data, fields):
+    encoded = Event(id=3, data=data, event="message").encode().decode()
+    lines = encoded.removesuffix("\n\n").split("\n")
+    assert lines[:2] == ["id: 3", "event: message"]
+    assert lines[2:] == [f"data: {field}" for field in fields]
+
+
+async def test_stream_to_unknown_chat(database):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://app") as client:
+        r = await client.post(f"/chats/{uuid.uuid4()}/stream", json={"content": "hi"})
+    assert r.status_code == 404
+    assert scheduler.waiting == 0
+
+
+async def finish(stream: Stream) -> None:
+    await asyncio.gather(stream.task, return_exceptions=True)
+    assert stream.finished
+
+
+async def test_ticket_is_released_when_cancelled_before_start():
+    stream = Stream(uuid.uuid4(), "hi", scheduler.reserve(uuid.uuid4()))
+    stream.cancel()
+    await finish(stream)
+    assert stream.events[-1].event == "cancelled"
+    assert scheduler.waiting == 0
+    assert not scheduler._chats
+
+
+async def test_follower_is_woken_when_cancelled_before_start():
+    stream = Stream(uuid.uuid4(), "hi", scheduler.reserve(uuid.uuid4()))
+
+    async def follow() -> list[str]:
+        return [event.event async for event in stream.follow()]
+
+    # waiting before the stream task is done
+    follower = asyncio.create_task(follow())
+    stream.cancel()
+    assert await asyncio.wait_for(follower, 1) == ["cancelled"]
+
+
+async def test_ticket_is_released_when_failing_before_generation(monkeypatch):
+    async def generate(ticket, message):
+        raise RuntimeError("db is locked")
+        yield
+
+    monkeypatch.setattr(streams, "generate", generate)
+    stream = Stream(uuid.uuid4(), "hi", scheduler.reserve(uuid.uuid4()))
+    await finish(stream)
+    assert stream.events[-1].event == "error"
+    assert scheduler.waiting == 0
+    assert not scheduler._chats
+
+
+async def test_ticket_is_released_when_cancelled_before_first_chunk(database):
+    stream = Stream(uuid.uuid4(), "hi", scheduler.reserve(uuid.uuid4()))
+    async for event in stream.follow():
+        assert event.event == "start"
+        break
+    stream.cancel()
+    await finish(stream)
+    assert [e.event for e in stream.events] == ["start", "cancelled"]
+    assert scheduler.waiting == 0
+    assert scheduler.running == 0
+    assert not scheduler._chats
@@ -0,0 +1,51 @@
+import uuid
+
+import pytest
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.database import database as db
+from app.database.writer import MessageWriter
+
+pytestmark = pytest.mark.anyio
+
+
+def turn(chat_id: uuid.UUID) -> list[db.ChatMessage]:
+    return [
+        db.ChatMessage(chat_id=chat_id, role=db.ChatMessageRole.HUMAN, content="hi"),
+        db.ChatMessage(chat_id=chat_id, role=db.ChatMessageRole.AI, content="hello"),
+    ]
+
+
+async def test_turns_are_written_in_batches(database):
+    chat = db.Chat()
+    async with AsyncSession(database, expire_on_commit=False) as session:
+        session.add(chat)
+        await session.commit()
+    writer = MessageWriter(queue_size=10, batch_size=3, flush_interval=1)
+    await writer.start()
+    turns = [await writer.put(turn(chat.id)) for _ in range(3)]
+    for written in turns:
+        await written.done
+    await writer.stop()
+    assert writer.stats()["flush_count"] == 1
+    assert writer.stats()["flushed_turns"] == 3
+    async with AsyncSession(database) as session:
+        assert (await session.get(db.Chat, chat.id)).message_count == 6
+
+
+async def test_failed_turns_are_not_counted_as_flushed(database):
+    chat = db.Chat()
+    async with AsyncSession(database, expire_on_commit=False) as session:
+        session.add(chat)
+        await session.commit()
+    writer = MessageWriter(queue_size=10, batch_size=2, flush_interval=1)
+    await writer.start()
+    # the unknown chat fails the batch, then the turns are retried one by one
+    written = await writer.put(turn(chat.id))
+    failed = await writer.put(turn(uuid.uuid4()))
+    await written.done
+    with pytest.raises(Exception):
+        await failed.done
+    await writer.stop()
+    stats = writer.stats()
+    assert (stats["flushed_turns"], stats["failed_turns"]) == (1, 1)